@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Benchmark compressione
+
+ Confronta byte trasferiti e tempi di download dei file di fixture con la
+ compressione del server di fixture disattivata e attivata, usando lo
+ stesso percorso di download in streaming del plugin (non richiede QGIS).
+
+ Uso:
+     python benchmarks/bench_compression.py FIXTURES_DIR [--bandwidth 1000000] [--json risultati.json]
+ ***************************************************************************/
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fixture_server import FixtureServer  # noqa: E402
+from istat_boundaries_downloader_http import download  # noqa: E402
+
+
+def fixture_files(fixtures_dir):
+    """Percorsi relativi di tutti i file di fixture"""
+    for root, _, files in os.walk(fixtures_dir):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, fixtures_dir).replace(os.sep, "/")
+
+
+def run(fixtures_dir, compress, bandwidth, latency):
+    """Scarica tutte le fixture e restituisce le misure per file"""
+    server = FixtureServer(fixtures_dir, latency=latency, bandwidth=bandwidth, compress=compress).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for relative in fixture_files(fixtures_dir):
+                stats = {}
+                start = time.perf_counter()
+                written = download(server.base_url + relative, os.path.join(temp_dir, "file"), stats=stats)
+                results.append({
+                    "file": relative,
+                    "bytes": written,
+                    "wire_bytes": stats["wire_bytes"],
+                    "encoding": stats["encoding"],
+                    "seconds": time.perf_counter() - start,
+                })
+    finally:
+        server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Risparmio di banda con la compressione negoziata")
+    parser.add_argument("fixtures_dir")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Banda simulata in byte/s")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--json", help="Salva i risultati in un file JSON")
+    args = parser.parse_args()
+
+    off = run(args.fixtures_dir, False, args.bandwidth, args.latency)
+    on = run(args.fixtures_dir, True, args.bandwidth, args.latency)
+
+    print(f"{'file':<50}{'MB':>8}{'MB rete':>10}{'s senza':>10}{'s con':>10}")
+    for plain, compressed in zip(off, on):
+        print(f"{plain['file']:<50}{plain['bytes'] / 1048576:>8.2f}{compressed['wire_bytes'] / 1048576:>10.2f}"
+              f"{plain['seconds']:>10.3f}{compressed['seconds']:>10.3f}")
+    total_off = sum(r["wire_bytes"] for r in off)
+    total_on = sum(r["wire_bytes"] for r in on)
+    if total_off:
+        print(f"Byte in rete: {total_off} -> {total_on} ({100 * (1 - total_on / total_off):.1f}% risparmiati)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"without_compression": off, "with_compression": on}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
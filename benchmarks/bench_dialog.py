@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Benchmark del dialogo
+
+ Misura i tempi di download_boundaries, populate_region_combo,
+ populate_province_combo, filter_provinces e del caricamento dei layer
+ contro il server di fixture locale. I risultati vengono aggiunti a un
+ file JSON lines per confrontare le esecuzioni nel tempo.
+
+ Da eseguire con l'interprete Python di QGIS:
+     python benchmarks/bench_dialog.py FIXTURES_DIR [--latency 0.1] [--bandwidth 2000000]
+                                       [--error-rate 0] [--output benchmarks/results.jsonl]
+
+ Con --fetch le fixture mancanti vengono scaricate dalle API reali.
+ ***************************************************************************/
+"""
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(PLUGIN_DIR))
+
+from fixture_server import FixtureServer  # noqa: E402
+
+from qgis.core import QgsApplication, QgsProject, QgsVectorLayer  # noqa: E402
+from qgis.PyQt.QtWidgets import QMessageBox  # noqa: E402
+
+API_URL = "https://www.confini-amministrativi.it/api/v2/it/"
+DATE = "20260101"
+DOWNLOADS = [
+    ("Regioni", "Shapefile (.zip)"),
+    ("Regioni", "GeoPackage (.gpkg)"),
+    ("Unità Territoriali Sovracomunali (Province)", "GeoPackage (.gpkg)"),
+    ("Comuni", "GeoPackage (.gpkg)"),
+    ("Comuni", "KML (.kml)"),
+]
+LOOKUPS = ["regioni.csv", "unita-territoriali-sovracomunali.csv"]
+
+
+def fetch_fixtures(fixtures_dir, plugin):
+    """Scarica dalle API reali le fixture mancanti"""
+    names = set(LOOKUPS)
+    for type_label, format_label in DOWNLOADS:
+        names.add(f"{plugin.boundary_types[type_label]}.{plugin.formats[format_label]}")
+    os.makedirs(os.path.join(fixtures_dir, DATE), exist_ok=True)
+    for name in sorted(names):
+        path = os.path.join(fixtures_dir, DATE, name)
+        if not os.path.exists(path):
+            print(f"Download fixture {name}...")
+            urllib.request.urlretrieve(f"{API_URL}{DATE}/{name}", path)
+
+
+def git_revision():
+    """Commit corrente del plugin, se disponibile"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PLUGIN_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+class StageTimer:
+    """Avvolge funzioni e metodi accumulando i tempi per fase"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+        setattr(owner, name, timed)
+
+    def reset(self):
+        self.stages = {}
+
+
+def wait_for_task(app, dlg, timeout=600):
+    """Attende la fine del task in background del dialogo"""
+    start = time.perf_counter()
+    while dlg.post_download_task is not None and time.perf_counter() - start < timeout:
+        app.processEvents()
+        time.sleep(0.01)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del dialogo ISTAT Boundaries Downloader")
+    parser.add_argument("fixtures_dir")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--fetch", action="store_true", help="Scarica le fixture mancanti dalle API reali")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results.jsonl"))
+    args = parser.parse_args()
+
+    app = QgsApplication([], True)
+    app.initQgis()
+
+    package = os.path.basename(PLUGIN_DIR)
+    plugin_module = importlib.import_module(f"{package}.istat_boundaries_downloader")
+    dialog_module = importlib.import_module(f"{package}.istat_boundaries_downloader_dialog")
+
+    # I messaggi modali bloccherebbero il benchmark
+    QMessageBox.information = staticmethod(lambda *a, **k: None)
+    QMessageBox.critical = staticmethod(lambda *a, **k: None)
+
+    plugin = plugin_module.IstatBoundariesDownloader(None)
+    if args.fetch:
+        fetch_fixtures(args.fixtures_dir, plugin)
+
+    server = FixtureServer(args.fixtures_dir, latency=args.latency, bandwidth=args.bandwidth,
+                           error_rate=args.error_rate).start()
+    timer = StageTimer()
+    timer.wrap(dialog_module.DownloaderDialog, "check_url_exists", "head")
+    timer.wrap(dialog_module, "download", "transfer")
+    timer.wrap(dialog_module.DownloaderDialog, "complete_download", "layer_load")
+
+    output_dir = os.path.join(args.fixtures_dir, "_output")
+    os.makedirs(output_dir, exist_ok=True)
+    dlg = dialog_module.DownloaderDialog(plugin.boundary_types, plugin.formats, server.base_url, None, PLUGIN_DIR)
+    dlg.download_path = output_dir
+    # Il prefetch renderebbe i download successivi dei semplici accessi alla cache
+    dlg.prefetch_check.setChecked(False)
+    # Dati originali senza riproiezione, senza modificare l'impostazione salvata
+    dlg.crs_combo.blockSignals(True)
+    dlg.crs_combo.setCurrentIndex(0)
+    dlg.crs_combo.blockSignals(False)
+    dlg.date_combo.setCurrentText(DATE)
+
+    results = []
+    for _ in range(args.repeat):
+        timer.reset()
+        results.append({"operation": "populate_region_combo", "seconds": timed(dlg.populate_region_combo), "stages": dict(timer.stages)})
+        timer.reset()
+        results.append({"operation": "populate_province_combo", "seconds": timed(dlg.populate_province_combo), "stages": dict(timer.stages)})
+        results.append({"operation": "filter_provinces", "seconds": timed(dlg.filter_provinces, "ro")})
+        results.append({"operation": "filter_provinces_clear", "seconds": timed(dlg.filter_provinces, "")})
+
+        for type_label, format_label in DOWNLOADS:
+            dlg.type_combo.setCurrentText(type_label)
+            dlg.format_combo.setCurrentText(format_label)
+            timer.reset()
+            start = time.perf_counter()
+            dlg.download_boundaries()
+            foreground = time.perf_counter() - start
+            wait_for_task(app, dlg)
+            dlg.layer_loader.flush()
+            results.append({
+                "operation": "download_boundaries",
+                "type": plugin.boundary_types[type_label],
+                "format": plugin.formats[format_label],
+                "seconds": time.perf_counter() - start,
+                "foreground_seconds": foreground,
+                "stages": dict(timer.stages),
+                "phases": dlg.last_metrics.phases if dlg.last_metrics else [],
+            })
+
+        for name in os.listdir(output_dir):
+            path = os.path.join(output_dir, name)
+            if name.endswith((".gpkg", ".kml")):
+                start = time.perf_counter()
+                layer = QgsVectorLayer(path, name, "ogr")
+                layer.featureCount()
+                results.append({"operation": "layer_open", "file": name, "seconds": time.perf_counter() - start})
+        QgsProject.instance().removeAllMapLayers()
+
+    run = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "date": DATE,
+        "latency": args.latency,
+        "bandwidth": args.bandwidth,
+        "error_rate": args.error_rate,
+        "server": server.stats,
+        "results": results,
+    }
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+
+    for result in results:
+        label = " ".join(str(result[key]) for key in ("operation", "type", "format", "file") if key in result)
+        print(f"{label:<60}{result['seconds']:>10.3f} s")
+    print(f"Risultati aggiunti a {args.output}")
+
+    server.stop()
+    app.exitQgis()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Benchmark formati
+
+ Confronta dimensione dei file e tempi di caricamento tramite OGR (lo stesso
+ motore del provider "ogr" di QGIS) dei formati disponibili sul layer
+ nazionale dei comuni.
+
+ Uso:
+     python benchmarks/bench_formats.py [--date 20260101] [--workdir DIR] [--json risultati.json]
+ ***************************************************************************/
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+import zipfile
+
+from osgeo import ogr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from istat_boundaries_downloader_convert import LOCAL_FORMATS, convert, is_format_available  # noqa: E402
+
+BASE_URL = "https://www.confini-amministrativi.it/api/v2/it/"
+API_FORMATS = ["zip", "gpkg", "kml", "kmz"]
+
+
+def file_size(path):
+    """Dimensione su disco di un file o di una cartella"""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def prepare_files(date_str, workdir):
+    """Scarica i formati delle API e produce localmente quelli convertiti"""
+    paths = {}
+    for file_format in API_FORMATS:
+        path = os.path.join(workdir, f"comuni.{file_format}")
+        if not os.path.exists(path):
+            print(f"Download comuni.{file_format}...")
+            urllib.request.urlretrieve(f"{BASE_URL}{date_str}/comuni.{file_format}", path)
+        paths[file_format] = path
+
+    shp_dir = os.path.join(workdir, "comuni_shp")
+    if not os.path.exists(shp_dir):
+        with zipfile.ZipFile(paths["zip"]) as zip_ref:
+            zip_ref.extractall(shp_dir)
+    paths["zip"] = shp_dir
+
+    kmz_dir = os.path.join(workdir, "comuni_kmz")
+    if not os.path.exists(kmz_dir):
+        with zipfile.ZipFile(paths["kmz"]) as kmz:
+            kmz.extractall(kmz_dir)
+    kml_files = [f for f in os.listdir(kmz_dir) if f.endswith(".kml")]
+    paths["kmz"] = os.path.join(kmz_dir, kml_files[0])
+
+    for file_format in LOCAL_FORMATS:
+        if not is_format_available(file_format):
+            print(f"Driver non disponibile per {file_format}, formato saltato")
+            continue
+        path = os.path.join(workdir, f"comuni.{file_format}")
+        if not os.path.exists(path):
+            convert(paths["gpkg"], path, file_format)
+        paths[file_format] = path
+    return paths
+
+
+def measure(path, repeat):
+    """Tempi di apertura, lettura completa e interrogazione per bbox (migliore su repeat)"""
+    best = {"open": None, "read": None, "bbox": None}
+    features = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ds = ogr.Open(path)
+        layer = ds.GetLayer(0)
+        layer.GetExtent()
+        opened = time.perf_counter()
+
+        features = 0
+        for feature in layer:
+            feature.GetGeometryRef()
+            features += 1
+        read = time.perf_counter()
+
+        # Area di Roma: misura l'uso dell'indice spaziale
+        layer.SetSpatialFilterRect(12.3, 41.8, 12.6, 42.0)
+        for feature in layer:
+            pass
+        layer.SetSpatialFilter(None)
+        bbox = time.perf_counter()
+        ds = None
+
+        for key, value in (("open", opened - start), ("read", read - opened), ("bbox", bbox - read)):
+            if best[key] is None or value < best[key]:
+                best[key] = value
+    return features, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dei formati sul layer nazionale dei comuni")
+    parser.add_argument("--date", default="20260101")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "istat_bench_formats"))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="Salva i risultati in un file JSON")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    paths = prepare_files(args.date, args.workdir)
+
+    results = []
+    print(f"{'formato':<10}{'MB':>10}{'feature':>10}{'apertura s':>12}{'lettura s':>12}{'bbox s':>10}")
+    for file_format, path in paths.items():
+        features, best = measure(path, args.repeat)
+        size_mb = file_size(path) / 1048576
+        results.append({"format": file_format, "size_mb": round(size_mb, 2), "features": features,
+                        "open_s": best["open"], "read_s": best["read"], "bbox_s": best["bbox"]})
+        print(f"{file_format:<10}{size_mb:>10.1f}{features:>10}{best['open']:>12.3f}{best['read']:>12.3f}{best['bbox']:>10.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"date": args.date, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
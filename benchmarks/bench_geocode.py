@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Benchmark geocodifica
+
+ Misura i punti al secondo della geocodifica (lettura CSV a blocchi,
+ localizzazione in parallelo, scrittura dei codici) sui comuni di una data
+ dell'archivio locale o, senza archivio, su una griglia sintetica con lo
+ stesso numero di comuni. Indica il motore usato (STRtree di shapely o
+ indice a griglia OGR) e confronta il risultato con la soglia richiesta.
+
+ Uso:
+     python benchmarks/bench_geocode.py [--points 1000000] [--store DIR --date 20260101] [--json risultati.json]
+ ***************************************************************************/
+"""
+
+import argparse
+import csv
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from osgeo import ogr, osr
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(REPO_DIR))
+
+# I moduli del plugin usano import relativi: si importano dal pacchetto
+geocode = importlib.import_module(f"{os.path.basename(REPO_DIR)}.istat_boundaries_downloader_geocode")
+store_module = importlib.import_module(f"{os.path.basename(REPO_DIR)}.istat_boundaries_downloader_store")
+
+# Inviluppo dell'Italia in EPSG:4326 e numero di comuni al 2026
+EXTENT = (6.6, 18.6, 36.6, 47.1)
+COMUNI = 7896
+TARGET = 200000
+
+
+def synthetic_index(count=COMUNI):
+    """Indice di comuni quadrati che coprono EXTENT, con codici gerarchici fittizi"""
+    minx, maxx, miny, maxy = EXTENT
+    side = int(count ** 0.5) + 1
+    dx, dy = (maxx - minx) / side, (maxy - miny) / side
+    codes, wkbs = [], []
+    for i in range(side):
+        for j in range(side):
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            x, y = minx + i * dx, miny + j * dy
+            for px, py in ((x, y), (x + dx, y), (x + dx, y + dy), (x, y + dy), (x, y)):
+                ring.AddPoint_2D(px, py)
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            n = len(codes)
+            codes.append((n + 1, n // 100 + 1, n // 100 + 1, n // 400 + 1, n // 2000 + 1))
+            wkbs.append(bytes(polygon.ExportToIsoWkb()))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    return geocode.ComuniIndex(list(geocode.HIERARCHY_FIELDS), codes, wkbs, srs.ExportToWkt())
+
+
+def write_points(path, count, seed=0):
+    """CSV di punti casuali nell'inviluppo dell'Italia"""
+    minx, maxx, miny, maxy = EXTENT
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "lon", "lat"])
+        for i in range(count):
+            writer.writerow([i, f"{rng.uniform(minx, maxx):.6f}", f"{rng.uniform(miny, maxy):.6f}"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Punti al secondo della geocodifica sui comuni")
+    parser.add_argument("--points", type=int, default=1000000)
+    parser.add_argument("--store", help="Cartella dell'archivio locale (istat_boundaries_downloader/store)")
+    parser.add_argument("--date", default="20260101")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--target", type=int, default=TARGET, help="Soglia in punti al secondo")
+    parser.add_argument("--json", help="Salva i risultati in un file JSON")
+    args = parser.parse_args()
+
+    engine = "STRtree (shapely)" if geocode.shapely is not None else "indice a griglia OGR"
+    if geocode.shapely is None:
+        print("Attenzione: shapely non è installato, si misura l'indice a griglia OGR (molto più lento)")
+
+    start = time.perf_counter()
+    if args.store:
+        index = geocode.ComuniIndex.from_store(store_module.BoundaryStore(args.store), args.date)
+        source = f"archivio {args.date}"
+    else:
+        index = synthetic_index()
+        source = "griglia sintetica"
+    index_seconds = time.perf_counter() - start
+    print(f"Indice di {len(index.codes)} comuni ({source}, {engine}) in {index_seconds:.2f} s")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        points_path = os.path.join(temp_dir, "punti.csv")
+        out_path = os.path.join(temp_dir, "punti_codici.csv")
+        write_points(points_path, args.points)
+
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            counts = geocode.geocode_points(index, points_path, None, "lon", "lat", out_path, workers=args.workers)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+    rate = args.points / best
+    outcome = "OK" if rate >= args.target else "sotto la soglia"
+    print(f"{args.points} punti in {best:.2f} s: {rate:,.0f} punti/s ({outcome}, soglia {args.target:,} punti/s)")
+    print(f"Localizzati: {counts['localizzati']}, non localizzati: {counts['non_localizzati']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"engine": engine, "source": source, "comuni": len(index.codes), "points": args.points,
+                       "index_seconds": index_seconds, "seconds": best, "points_per_second": rate,
+                       "target": args.target}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Server di fixture
+
+ Server HTTP locale che imita le API di confini-amministrativi.it servendo
+ file di fixture con la stessa struttura di URL di base_url
+ (/api/v2/it/{data}/{tipo}.{formato}) e con latenza, banda, errori e
+ compressione gzip/deflate dei formati testuali configurabili. Come un server
+ reale dichiara "Accept-Ranges: bytes" ed ETag e risponde 206 alle richieste
+ Range, rispettando If-Range.
+
+ Uso:
+     python benchmarks/fixture_server.py FIXTURES_DIR [--port 8765] [--latency 0.2]
+                                         [--bandwidth 1000000] [--error-rate 0.05] [--compress]
+                                         [--no-ranges]
+ ***************************************************************************/
+"""
+
+import argparse
+import gzip
+import io
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+API_PREFIX = "/api/v2/it/"
+CHUNK_SIZE = 16384
+TEXT_EXTENSIONS = (".csv", ".kml", ".json", ".geojson")
+
+
+class FixtureRequestHandler(SimpleHTTPRequestHandler):
+    """Serve i file di fixture applicando latenza, limite di banda ed errori"""
+
+    def translate_path(self, path):
+        path = path.split("?", 1)[0].split("#", 1)[0]
+        if not path.startswith(API_PREFIX):
+            return os.path.join(self.server.fixtures_dir, "__non_esiste__")
+        relative = path[len(API_PREFIX):].lstrip("/")
+        return os.path.join(self.server.fixtures_dir, *relative.split("/"))
+
+    def inject(self):
+        """Applica latenza ed errori; restituisce False se la richiesta è stata rifiutata"""
+        self.server.stats["requests"] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.stats["errors"] += 1
+            self.send_error(503, "Errore simulato")
+            return False
+        return True
+
+    def do_HEAD(self):
+        if self.inject():
+            super().do_HEAD()
+
+    def compressed_payload(self):
+        """Contenuto compresso e codifica se il client li accetta, altrimenti None"""
+        if not self.server.compress:
+            return None
+        path = self.translate_path(self.path)
+        if not path.endswith(TEXT_EXTENSIONS) or not os.path.isfile(path):
+            return None
+        accepted = [value.strip() for value in self.headers.get("Accept-Encoding", "").split(",")]
+        encoding = "gzip" if "gzip" in accepted else "deflate" if "deflate" in accepted else None
+        if encoding is None:
+            return None
+        key = (path, encoding)
+        if key not in self.server.compressed:
+            with open(path, "rb") as f:
+                data = f.read()
+            self.server.compressed[key] = gzip.compress(data) if encoding == "gzip" else zlib.compress(data)
+        return self.server.compressed[key], encoding
+
+    def send_head(self):
+        """Intestazioni del file richiesto con ETag e, per le richieste Range valide, risposta 206"""
+        path = self.translate_path(self.path)
+        if not self.server.ranges or not os.path.isfile(path):
+            return super().send_head()
+        f = open(path, "rb")
+        stat = os.fstat(f.fileno())
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = self.date_time_string(stat.st_mtime)
+        byte_range = self.requested_range(stat.st_size, etag, last_modified)
+        if byte_range is False:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{stat.st_size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if byte_range is None:
+            self.send_response(200)
+            length = stat.st_size
+            body = f
+        else:
+            start, end = byte_range
+            self.server.stats["ranges"] += 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+            length = end - start + 1
+            f.seek(start)
+            body = io.BytesIO(f.read(length))
+            f.close()
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        return body
+
+    def requested_range(self, size, etag, last_modified):
+        """Byte (inizio, fine) richiesti con Range; None per il file intero, False se non soddisfacibile
+
+        Con If-Range diverso dall'ETag o dalla data del file si serve il file intero.
+        """
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", "").strip())
+        if match is None or match.groups() == ("", ""):
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (etag, last_modified):
+            return None
+        first, last = match.groups()
+        if first == "":
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return False
+        return start, end
+
+    def do_GET(self):
+        if not self.inject():
+            return
+        compressed = self.compressed_payload()
+        if compressed is not None:
+            payload, encoding = compressed
+            self.send_response(200)
+            self.send_header("Content-Type", self.guess_type(self.path))
+            self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.copy_throttled(io.BytesIO(payload))
+            return
+        f = self.send_head()
+        if f is None:
+            return
+        try:
+            self.copy_throttled(f)
+        finally:
+            f.close()
+
+    def copy_throttled(self, f):
+        """Copia il file sulla connessione rispettando la banda configurata"""
+        start = time.monotonic()
+        sent = 0
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if self.server.bandwidth:
+                delay = sent / self.server.bandwidth - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        self.server.stats["bytes"] += sent
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """Server di fixture avviabile in un thread separato"""
+
+    daemon_threads = True
+
+    def __init__(self, fixtures_dir, port=0, latency=0.0, bandwidth=0, error_rate=0.0, compress=False, verbose=False,
+                 ranges=True):
+        super().__init__(("127.0.0.1", port), FixtureRequestHandler)
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.compress = compress
+        self.compressed = {}
+        self.verbose = verbose
+        self.ranges = ranges
+        self.stats = {"requests": 0, "errors": 0, "bytes": 0, "ranges": 0}
+        self.thread = None
+
+    @property
+    def base_url(self):
+        """URL equivalente a base_url del plugin"""
+        return f"http://127.0.0.1:{self.server_address[1]}{API_PREFIX}"
+
+    def start(self):
+        """Avvia il server in un thread in background"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Arresta il server"""
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server HTTP locale con le fixture delle API confini-amministrativi")
+    parser.add_argument("fixtures_dir")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Latenza per richiesta in secondi")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Banda in byte/s (0 = illimitata)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilità di risposta 503")
+    parser.add_argument("--compress", action="store_true", help="Comprime CSV/KML se il client lo accetta")
+    parser.add_argument("--no-ranges", action="store_true", help="Ignora le richieste Range come un server senza supporto")
+    args = parser.parse_args()
+
+    server = FixtureServer(args.fixtures_dir, args.port, args.latency, args.bandwidth, args.error_rate,
+                           args.compress, verbose=True, ranges=not args.no_ranges)
+    print(f"Fixture servite su {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
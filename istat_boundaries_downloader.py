@@ -23,10 +23,15 @@
 
 import os
 
+from qgis.PyQt.QtCore import QSettings
 from qgis.PyQt.QtWidgets import QAction
 from qgis.PyQt.QtGui import QIcon
+from qgis.core import QgsApplication, Qgis, QgsMessageLog
 
 from .istat_boundaries_downloader_dialog import DownloaderDialog
+from .istat_boundaries_downloader_mirror import BASE_URL_SETTING, DEFAULT_BASE_URL
+from .istat_boundaries_downloader_server import SERVICE_SETTING, FeatureService
+from .istat_boundaries_downloader_store import BoundaryStore
 
 
 class IstatBoundariesDownloader:
@@ -35,9 +40,10 @@ class IstatBoundariesDownloader:
     def __init__(self, iface):
         self.iface = iface
         self.plugin_dir = os.path.dirname(__file__)
+        self.service = None
 
-        # Set up the base URL for API requests
-        self.base_url = "https://www.confini-amministrativi.it/api/v2/it/"
+        # Set up the base URL for API requests (can be overridden by an offline mirror)
+        self.base_url = DEFAULT_BASE_URL
 
         # Define available boundary types
         self.boundary_types = {
@@ -53,7 +59,9 @@ class IstatBoundariesDownloader:
             "GeoPackage (.gpkg)": "gpkg",
             "CSV (.csv)": "csv",
             "KML (.kml)": "kml",
-            "KMZ (.kmz)": "kmz"
+            "KMZ (.kmz)": "kmz",
+            "FlatGeobuf (.fgb)": "fgb",
+            "GeoParquet (.parquet)": "parquet"
         }
 
     def initGui(self):
@@ -66,13 +74,42 @@ class IstatBoundariesDownloader:
         self.action.triggered.connect(self.run)
         self.iface.addToolBarIcon(self.action)
         self.iface.addPluginToMenu("ISTAT Boundaries Downloader", self.action)
+        self.update_service()
 
     def unload(self):
         """Removes the plugin menu item and icon from QGIS GUI"""
         self.iface.removePluginMenu("ISTAT Boundaries Downloader", self.action)
         self.iface.removeToolBarIcon(self.action)
+        if self.service is not None:
+            self.service.stop()
+            self.service = None
+
+    def update_service(self):
+        """Avvia, riavvia o ferma il servizio locale secondo le impostazioni"""
+        port = int(QSettings().value(SERVICE_SETTING, 0) or 0)
+        if self.service is not None and self.service.port == port:
+            return
+        if self.service is not None:
+            self.service.stop()
+            self.service = None
+        if port <= 0:
+            return
+        store = BoundaryStore(os.path.join(QgsApplication.qgisSettingsDirPath(), "istat_boundaries_downloader", "store"))
+        service = FeatureService(store, port=port)
+        try:
+            service.start()
+        except OSError as e:
+            QgsMessageLog.logMessage(f"Servizio locale non avviato sulla porta {port}: {e}", "ISTAT Downloader",
+                                     Qgis.MessageLevel.Warning)
+            return
+        self.service = service
+        QgsMessageLog.logMessage(f"Servizio locale attivo su {service.url}", "ISTAT Downloader", Qgis.MessageLevel.Info)
 
     def run(self):
         """Run method that performs all the real work"""
-        dlg = DownloaderDialog(self.boundary_types, self.formats, self.base_url, self.iface, self.plugin_dir)
+        base_url = QSettings().value(BASE_URL_SETTING, self.base_url) or self.base_url
+        if not base_url.endswith("/"):
+            base_url += "/"
+        dlg = DownloaderDialog(self.boundary_types, self.formats, base_url, self.iface, self.plugin_dir)
         dlg.exec()
+        self.update_service()
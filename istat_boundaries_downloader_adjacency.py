@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Adjacency
+
+ Grafo di adiacenza (contiguità queen: confini con almeno un punto in
+ comune) delle unità amministrative, calcolato con un indice spaziale e
+ salvato in forma CSR nel GeoPackage, con esportazione dei pesi GAL.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import ogr
+
+from .istat_boundaries_downloader_diff import GridIndex
+from .istat_boundaries_downloader_store import CODE_FIELD_BY_TYPE
+
+try:
+    import shapely
+except ImportError:
+    shapely = None
+
+# Tabelle CSR: unità (codice, inizio e numero dei vicini) e indici dei vicini
+UNITS_SUFFIX = "adiacenza"
+INDICES_SUFFIX = "adiacenza_indici"
+CHUNK_SIZE = 500
+
+
+def adjacency_tables(layer_name):
+    """Nomi delle tabelle CSR del grafo di un layer"""
+    return f"{layer_name}_{UNITS_SUFFIX}", f"{layer_name}_{INDICES_SUFFIX}"
+
+
+def default_code_field(layer):
+    """Campo codice del livello più dettagliato presente nel layer"""
+    defn = layer.GetLayerDefn()
+    for name in reversed(list(CODE_FIELD_BY_TYPE.values())):
+        if defn.GetFieldIndex(name) >= 0:
+            return name
+    raise ValueError(f"Nessun campo codice ISTAT nel layer {layer.GetName()}")
+
+
+def neighbor_pairs(wkbs, workers=None):
+    """Coppie (i, j), i < j, di geometrie WKB con almeno un punto in comune
+
+    Con shapely la ricerca avviene in blocco su uno STRtree; altrimenti i
+    candidati del GridIndex sono verificati con OGR a blocchi in parallelo.
+    """
+    if shapely is not None:
+        geoms = shapely.from_wkb(wkbs)
+        left, right = shapely.STRtree(geoms).query(geoms, predicate="intersects")
+        return {(int(i), int(j)) for i, j in zip(left, right) if i < j}
+
+    geoms = [ogr.CreateGeometryFromWkb(wkb) for wkb in wkbs]
+    envelopes = [geom.GetEnvelope() for geom in geoms]
+    width = max(e[1] for e in envelopes) - min(e[0] for e in envelopes)
+    grid = GridIndex(width / 200.0 or 1.0)
+    for i, envelope in enumerate(envelopes):
+        grid.insert(i, envelope)
+
+    def chunk_pairs(start):
+        pairs = set()
+        for i in range(start, min(start + CHUNK_SIZE, len(geoms))):
+            minx, maxx, miny, maxy = envelopes[i]
+            for j in grid.query(envelopes[i]):
+                if j <= i:
+                    continue
+                other = envelopes[j]
+                if other[0] > maxx or other[1] < minx or other[2] > maxy or other[3] < miny:
+                    continue
+                if geoms[i].Intersects(geoms[j]):
+                    pairs.add((i, j))
+        return pairs
+
+    pairs = set()
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for chunk in pool.map(chunk_pairs, range(0, len(geoms), CHUNK_SIZE)):
+            pairs |= chunk
+    return pairs
+
+
+class AdjacencyGraph:
+    """Grafo di adiacenza in forma CSR indicizzato per codice ISTAT
+
+    I vicini dell'unità in posizione i sono codes[k] per k in
+    indices[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, codes, indptr, indices, code_field=None):
+        self.codes = codes
+        self.indptr = indptr
+        self.indices = indices
+        self.code_field = code_field
+        self.position = {code: i for i, code in enumerate(codes)}
+
+    @classmethod
+    def from_pairs(cls, codes, pairs, code_field=None):
+        """Grafo non orientato dalle coppie di posizioni adiacenti"""
+        neighbors = [[] for _ in codes]
+        for i, j in pairs:
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+        indptr, indices = [0], []
+        for row in neighbors:
+            indices += sorted(row)
+            indptr.append(len(indices))
+        return cls(list(codes), indptr, indices, code_field)
+
+    @classmethod
+    def from_layer(cls, src_uri, code_field=None, workers=None):
+        """Calcola il grafo del layer src_uri (URI OGR con eventuale "|layername=")"""
+        path, _, layer_name = src_uri.partition("|layername=")
+        ds = ogr.Open(path)
+        if ds is None:
+            raise IOError(f"Impossibile leggere {path}")
+        layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+        code_field = code_field or default_code_field(layer)
+        codes, wkbs = [], []
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None or geom.IsEmpty():
+                continue
+            codes.append(feature.GetField(code_field))
+            wkbs.append(bytes(geom.ExportToIsoWkb()))
+        ds = None
+        return cls.from_pairs(codes, neighbor_pairs(wkbs, workers), code_field)
+
+    @classmethod
+    def read(cls, path, layer_name=None):
+        """Legge il grafo di layer_name dalle tabelle CSR del GeoPackage path
+
+        Senza layer_name si usa il primo grafo presente nel file.
+        """
+        ds = ogr.Open(path)
+        if layer_name is None and ds is not None:
+            suffix = f"_{UNITS_SUFFIX}"
+            names = [ds.GetLayer(i).GetName() for i in range(ds.GetLayerCount())]
+            layer_name = next((name[:-len(suffix)] for name in names if name.endswith(suffix)), None)
+        units_name, indices_name = adjacency_tables(layer_name)
+        units = ds.GetLayerByName(units_name) if ds is not None else None
+        if units is None:
+            raise ValueError(f"Grafo di adiacenza di {layer_name} non presente in {path}")
+        codes, indptr = [], [0]
+        result = ds.ExecuteSQL(f'SELECT code, start, degree FROM "{units_name}" ORDER BY fid')
+        try:
+            for feature in result:
+                codes.append(feature.GetField("code"))
+                indptr.append(feature.GetField("start") + feature.GetField("degree"))
+        finally:
+            ds.ReleaseResultSet(result)
+        result = ds.ExecuteSQL(f'SELECT neighbor FROM "{indices_name}" ORDER BY fid')
+        try:
+            indices = [feature.GetField(0) for feature in result]
+        finally:
+            ds.ReleaseResultSet(result)
+        code_field = units.GetMetadataItem("CODE_FIELD")
+        ds = None
+        return cls(codes, indptr, indices, code_field)
+
+    def write(self, path, layer_name):
+        """Scrive (sostituendole) le tabelle CSR del grafo nel GeoPackage path"""
+        driver = ogr.GetDriverByName("GPKG")
+        ds = driver.Open(path, 1) if os.path.exists(path) else driver.CreateDataSource(path)
+        if ds is None:
+            raise IOError(f"Impossibile scrivere {path}")
+        names = adjacency_tables(layer_name)
+        for i in reversed(range(ds.GetLayerCount())):
+            if ds.GetLayer(i).GetName() in names:
+                ds.DeleteLayer(i)
+        integer_codes = all(isinstance(code, int) for code in self.codes)
+        ds.StartTransaction()
+        units = ds.CreateLayer(names[0], None, ogr.wkbNone)
+        units.SetMetadataItem("CODE_FIELD", self.code_field or "")
+        units.CreateField(ogr.FieldDefn("code", ogr.OFTInteger64 if integer_codes else ogr.OFTString))
+        units.CreateField(ogr.FieldDefn("start", ogr.OFTInteger))
+        units.CreateField(ogr.FieldDefn("degree", ogr.OFTInteger))
+        defn = units.GetLayerDefn()
+        for i, code in enumerate(self.codes):
+            feature = ogr.Feature(defn)
+            if code is not None:
+                feature.SetField("code", code)
+            feature.SetField("start", self.indptr[i])
+            feature.SetField("degree", self.indptr[i + 1] - self.indptr[i])
+            units.CreateFeature(feature)
+        indices = ds.CreateLayer(names[1], None, ogr.wkbNone)
+        indices.CreateField(ogr.FieldDefn("neighbor", ogr.OFTInteger))
+        defn = indices.GetLayerDefn()
+        for neighbor in self.indices:
+            feature = ogr.Feature(defn)
+            feature.SetField("neighbor", neighbor)
+            indices.CreateFeature(feature)
+        ds.CommitTransaction()
+        ds.ExecuteSQL(f'CREATE UNIQUE INDEX IF NOT EXISTS "idx_{names[0]}_code" ON "{names[0]}" (code)')
+        ds = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.position
+
+    def neighbors(self, code):
+        """Codici delle unità confinanti con code"""
+        i = self.position[code]
+        return [self.codes[k] for k in self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def degree(self, code):
+        i = self.position[code]
+        return self.indptr[i + 1] - self.indptr[i]
+
+    def islands(self):
+        """Codici delle unità senza vicini (es. isole minori)"""
+        return [code for i, code in enumerate(self.codes) if self.indptr[i] == self.indptr[i + 1]]
+
+    def to_gal(self, path, layer_name=""):
+        """Esporta i pesi di contiguità nel formato GAL (GeoDa, PySAL)"""
+        with open(path, "w", encoding="utf-8", newline="\n") as f:
+            f.write(f"0 {len(self.codes)} {layer_name or 'istat'} {self.code_field or 'code'}\n")
+            for i, code in enumerate(self.codes):
+                row = self.indices[self.indptr[i]:self.indptr[i + 1]]
+                f.write(f"{code} {len(row)}\n")
+                f.write(" ".join(str(self.codes[k]) for k in row) + "\n")
+
+
+def build_adjacency(src_uri, graph_path=None, gal_path=None, code_field=None, workers=None):
+    """Calcola il grafo di src_uri e lo salva in forma CSR e, se richiesto, in GAL
+
+    Le tabelle sono scritte nello stesso GeoPackage della sorgente o, per gli
+    altri formati, in graph_path.
+    """
+    path, _, layer_name = src_uri.partition("|layername=")
+    ds = ogr.Open(path)
+    if ds is None:
+        raise IOError(f"Impossibile leggere {path}")
+    layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+    layer_name = layer.GetName()
+    same_file = ds.GetDriver().GetName() == "GPKG"
+    ds = None
+
+    graph = AdjacencyGraph.from_layer(src_uri, code_field, workers)
+    graph_path = path if same_file else (graph_path or f"{os.path.splitext(path)[0]}_adiacenza.gpkg")
+    graph.write(graph_path, layer_name)
+    if gal_path:
+        graph.to_gal(gal_path, layer_name)
+    return {"unita": len(graph), "coppie": len(graph.indices) // 2, "isolate": len(graph.islands()),
+            "percorso": graph_path, "tabella": adjacency_tables(layer_name)[0]}
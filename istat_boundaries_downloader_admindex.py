@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Admin index
+
+ Indice binario compatto di regioni, UTS e comuni (codici, nomi e codice
+ del livello superiore) per tutte le date di riferimento, letto con mmap:
+ i filtri del dialogo si popolano senza accedere alla rete.
+
+ Rigenerazione da riga di comando:
+     python istat_boundaries_downloader_admindex.py data/admin_index.bin
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import argparse
+import csv
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+import urllib.error
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .istat_boundaries_downloader_http import download
+    from .istat_boundaries_downloader_mirror import DATES, DEFAULT_BASE_URL
+except ImportError:
+    # Esecuzione da riga di comando fuori dal pacchetto del plugin
+    from istat_boundaries_downloader_http import download
+    from istat_boundaries_downloader_mirror import DATES, DEFAULT_BASE_URL
+
+INDEX_NAME = "admin_index.bin"
+MAGIC = b"ISTATIDX"
+VERSION = 1
+
+LEVEL_REGIONI = 1
+LEVEL_UTS = 2
+LEVEL_COMUNI = 3
+
+# Intestazione: magic, versione, numero di date e di unità, byte dei nomi, data di creazione
+HEADER = struct.Struct("<8sHxxIIII")
+DATE = struct.Struct("<8s")
+# Unità: livello, codice, codice del livello superiore, codice alternativo, posizione e lunghezza del nome
+UNIT = struct.Struct("<B3xIIIIH2x")
+
+Unit = namedtuple("Unit", "level code parent alt_code name")
+
+# Tabella delle API, colonne di codice, livello superiore, codice alternativo e nome per livello
+LEVEL_SOURCES = {
+    LEVEL_REGIONI: ("regioni", ("cod_reg",), ("cod_rip",), (), ("den_reg",)),
+    LEVEL_UTS: ("unita-territoriali-sovracomunali", ("cod_uts", "cod_prov"), ("cod_reg",), ("cod_prov",),
+                ("den_prov", "den_pcm", "den_ita", "den_uts", "den_cm", "sigla")),
+    LEVEL_COMUNI: ("comuni", ("pro_com",), ("cod_uts", "cod_prov"), ("cod_prov",), ("comune", "den_com")),
+}
+
+
+class AdminIndex:
+    """Lettura dell'indice binario mappato in memoria
+
+    Le unità sono ordinate per livello, codice superiore e codice; per ogni
+    data un insieme di bit indica le unità presenti.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, date_count, self.unit_count, strings_size, self.built = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"Indice amministrativo non valido: {path}")
+        except BaseException:
+            self.file.close()
+            raise
+        offset = HEADER.size
+        self.dates = [DATE.unpack_from(self.map, offset + i * DATE.size)[0].decode("ascii") for i in range(date_count)]
+        self.units_offset = offset + date_count * DATE.size
+        self.bitset_size = (self.unit_count + 7) // 8
+        self.bitsets_offset = self.units_offset + self.unit_count * UNIT.size
+        self.strings_offset = self.bitsets_offset + date_count * self.bitset_size
+
+    @classmethod
+    def open(cls, path):
+        return cls(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def unit(self, i):
+        level, code, parent, alt_code, name_offset, name_size = UNIT.unpack_from(self.map, self.units_offset + i * UNIT.size)
+        start = self.strings_offset + name_offset
+        return Unit(level, code, parent, alt_code, self.map[start:start + name_size].decode("utf-8"))
+
+    def level_range(self, level):
+        """Intervallo [inizio, fine) delle unità di un livello (ricerca binaria)"""
+        def lower_bound(value):
+            lo, hi = 0, self.unit_count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.map[self.units_offset + mid * UNIT.size] < value:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        return lower_bound(level), lower_bound(level + 1)
+
+    def units(self, date_str, level, parent=None):
+        """Unità di un livello presenti alla data, eventualmente di un solo codice superiore"""
+        bitset = self.bitsets_offset + self.dates.index(date_str) * self.bitset_size
+        result = []
+        for i in range(*self.level_range(level)):
+            if not self.map[bitset + i // 8] & (1 << (i % 8)):
+                continue
+            if parent is not None:
+                unit_parent = struct.unpack_from("<I", self.map, self.units_offset + i * UNIT.size + 8)[0]
+                if unit_parent != int(parent):
+                    continue
+            result.append(self.unit(i))
+        return result
+
+
+def find_admin_index(paths):
+    """Tra gli indici esistenti in paths restituisce il più recente, o None"""
+    best, best_built = None, -1
+    for path in paths:
+        try:
+            with AdminIndex.open(path) as index:
+                built = index.built
+        except (OSError, ValueError, struct.error):
+            continue
+        if built > best_built:
+            best, best_built = path, built
+    return best
+
+
+def write_admin_index(units_by_date, out_path):
+    """Scrive l'indice da {data: insieme di Unit} e restituisce il numero di unità"""
+    dates = sorted(units_by_date, reverse=True)
+    units = sorted(set().union(*units_by_date.values()), key=lambda u: (u.level, u.parent, u.code, u.name))
+    position = {unit: i for i, unit in enumerate(units)}
+    strings = bytearray()
+    name_offsets = {}
+    records = bytearray()
+    for unit in units:
+        if unit.name not in name_offsets:
+            name_offsets[unit.name] = len(strings)
+            strings += unit.name.encode("utf-8")
+        name_size = len(unit.name.encode("utf-8"))
+        records += UNIT.pack(unit.level, unit.code, unit.parent, unit.alt_code, name_offsets[unit.name], name_size)
+    bitset_size = (len(units) + 7) // 8
+    bitsets = bytearray(bitset_size * len(dates))
+    for d, date_str in enumerate(dates):
+        for unit in units_by_date[date_str]:
+            i = position[unit]
+            bitsets[d * bitset_size + i // 8] |= 1 << (i % 8)
+
+    temp_path = f"{out_path}.part"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(dates), len(units), len(strings), int(time.time())))
+        for date_str in dates:
+            f.write(DATE.pack(date_str.encode("ascii")))
+        f.write(records)
+        f.write(bitsets)
+        f.write(strings)
+    os.replace(temp_path, out_path)
+    return len(units)
+
+
+def first_value(row, names):
+    """Primo valore non vuoto (e diverso da "-") tra le colonne names"""
+    for name in names:
+        value = (row.get(name) or "").strip()
+        if value and value != "-":
+            return value
+    return None
+
+
+def read_units(level, path):
+    """Unità di un livello dalla tabella CSV delle API"""
+    _, code_fields, parent_fields, alt_fields, name_fields = LEVEL_SOURCES[level]
+    units = set()
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            row = {key.strip().lower(): value for key, value in row.items() if key}
+            code = first_value(row, code_fields)
+            if code is None or not code.isdigit():
+                continue
+            parent = first_value(row, parent_fields)
+            alt_code = first_value(row, alt_fields)
+            name = first_value(row, name_fields) or code
+            units.add(Unit(level, int(code), int(parent) if parent and parent.isdigit() else 0,
+                           int(alt_code) if alt_code and alt_code.isdigit() else 0, name))
+    return units
+
+
+def build_admin_index(out_path, base_url=DEFAULT_BASE_URL, dates=DATES, fetch=None, workers=8):
+    """Rigenera l'indice scaricando le tabelle CSV di tutti i livelli e di tutte le date
+
+    fetch(url) restituisce il percorso locale della tabella (es. DownloadCache.fetch);
+    le tabelle non disponibili per una data vengono saltate.
+    """
+    temp_dir = tempfile.mkdtemp()
+
+    def fetch_to_temp(url):
+        path = os.path.join(temp_dir, url.replace(base_url, "").replace("/", "_"))
+        download(url, path)
+        return path
+
+    def date_units(date_str):
+        units = set()
+        for level, source in LEVEL_SOURCES.items():
+            url = f"{base_url}{date_str}/{source[0]}.csv"
+            try:
+                units |= read_units(level, (fetch or fetch_to_temp)(url))
+            except urllib.error.HTTPError as e:
+                if e.code != 404:
+                    raise
+            except urllib.error.URLError as e:
+                # Tabella assente in un mirror locale (file:///)
+                if not isinstance(e.reason, FileNotFoundError):
+                    raise
+        return date_str, units
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            units_by_date = {date_str: units for date_str, units in pool.map(date_units, dates) if units}
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    if not units_by_date:
+        raise ValueError("Nessuna tabella disponibile per costruire l'indice amministrativo")
+    return {"date": len(units_by_date), "unita": write_admin_index(units_by_date, out_path)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indice amministrativo compatto per i filtri del plugin")
+    parser.add_argument("out_path", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", INDEX_NAME))
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    parser.add_argument("--dates", nargs="+", default=DATES)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.out_path)), exist_ok=True)
+    stats = build_admin_index(args.out_path, args.base_url, args.dates, workers=args.workers)
+    print(f"Indice scritto in {args.out_path}: {stats['date']} date, {stats['unita']} unità, "
+          f"{os.path.getsize(args.out_path) / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Cache
+
+ Cache su disco dei file scaricati dalle API, indicizzata per URL.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from .istat_boundaries_downloader_http import download
+
+# I dati delle API cambiano raramente: una settimana di validità
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+# Oltre questa dimensione complessiva vengono eliminate le voci meno recenti
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# File temporanei di scritture interrotte
+STALE_PART_AGE = 24 * 3600
+
+
+def file_hash(path):
+    """SHA-1 del contenuto di un file letto a blocchi"""
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class DownloadCache:
+    """Cache dei file scaricati; ogni voce è il file più un JSON di metadati"""
+
+    def __init__(self, cache_dir, max_age=DEFAULT_MAX_AGE, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def key(self, url, variant=""):
+        """Chiave della voce di cache per url (ed eventuale variante)"""
+        return hashlib.sha1(f"{url}|{variant}".encode("utf-8")).hexdigest()
+
+    def path(self, url, variant=""):
+        """Percorso del file in cache, con l'estensione della variante o dell'URL"""
+        extension = os.path.splitext(variant)[1] or os.path.splitext(url.split("?", 1)[0])[1]
+        return os.path.join(self.cache_dir, self.key(url, variant) + extension)
+
+    def meta_path(self, url, variant=""):
+        return os.path.join(self.cache_dir, self.key(url, variant) + ".json")
+
+    def get(self, url, variant=""):
+        """Percorso del file in cache se presente e valido, altrimenti None"""
+        path = self.path(url, variant)
+        meta_path = self.meta_path(url, variant)
+        if not (os.path.exists(path) and os.path.exists(meta_path)):
+            return None
+        if self.max_age and time.time() - os.path.getmtime(meta_path) > self.max_age:
+            self.remove(url, variant)
+            return None
+        return path
+
+    def remove(self, url, variant=""):
+        """Elimina una voce dalla cache"""
+        for path in (self.meta_path(url, variant), self.path(url, variant)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def metadata(self, url, variant=""):
+        """Metadati della voce di cache (URL, dimensione, data)"""
+        try:
+            with open(self.meta_path(url, variant), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def temp_path(self, url, variant=""):
+        """Percorso temporaneo univoco per scrivere una nuova voce"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return f"{self.path(url, variant)}.{uuid.uuid4().hex}.part"
+
+    def commit(self, url, temp_path, variant="", **meta):
+        """Rende definitiva una voce scritta in temp_path"""
+        path = self.path(url, variant)
+        with self.lock:
+            os.replace(temp_path, path)
+            meta.update({"url": url, "variant": variant, "size": os.path.getsize(path), "fetched": time.time()})
+            with open(self.meta_path(url, variant), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            self.prune(keep=path)
+        return path
+
+    def prune(self, keep=None):
+        """Elimina le voci scadute, i temporanei abbandonati e, oltre max_bytes, le voci meno recenti"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            file_path = os.path.join(self.cache_dir, name)
+            try:
+                if name.endswith(".part"):
+                    if now - os.path.getmtime(file_path) > STALE_PART_AGE:
+                        os.remove(file_path)
+                    continue
+                if not name.endswith(".json"):
+                    continue
+                with open(file_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+                url, variant = meta["url"], meta.get("variant", "")
+                if self.max_age and now - os.path.getmtime(file_path) > self.max_age:
+                    self.remove(url, variant)
+                else:
+                    entries.append((meta.get("fetched", 0), meta.get("size", 0), url, variant))
+            except (OSError, ValueError, KeyError):
+                continue
+        total = sum(entry[1] for entry in entries)
+        for _, size, url, variant in sorted(entries):
+            if not self.max_bytes or total <= self.max_bytes:
+                break
+            if self.path(url, variant) == keep:
+                continue
+            self.remove(url, variant)
+            total -= size
+
+    def fetch(self, url, stats=None, control=None):
+        """Restituisce il file in cache scaricandolo se necessario"""
+        cached = self.get(url)
+        if cached:
+            return cached
+        temp_path = self.temp_path(url)
+        try:
+            download(url, temp_path, stats=stats, control=control)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.commit(url, temp_path)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Convert
+
+ Conversione locale dei dati scaricati in formati non offerti dalle API
+ (FlatGeobuf, GeoParquet).
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from osgeo import gdal, ogr
+
+# Formati prodotti localmente: estensione -> (driver OGR, formato scaricato dalle API, opzioni layer)
+LOCAL_FORMATS = {
+    "fgb": ("FlatGeobuf", "gpkg", ["SPATIAL_INDEX=YES"]),
+    "parquet": ("Parquet", "gpkg", ["COMPRESSION=ZSTD", "WRITE_COVERING_BBOX=YES"]),
+}
+
+
+def api_format(file_format):
+    """Restituisce il formato da richiedere alle API per il formato scelto"""
+    if file_format in LOCAL_FORMATS:
+        return LOCAL_FORMATS[file_format][1]
+    return file_format
+
+
+def is_format_available(file_format):
+    """Verifica che il driver GDAL necessario al formato sia disponibile"""
+    if file_format not in LOCAL_FORMATS:
+        return True
+    return ogr.GetDriverByName(LOCAL_FORMATS[file_format][0]) is not None
+
+
+def supported_options(driver_name, options):
+    """Filtra le opzioni di creazione non supportate dalla versione di GDAL in uso"""
+    driver = ogr.GetDriverByName(driver_name)
+    option_list = (driver.GetMetadataItem("DS_LAYER_CREATIONOPTIONLIST") or "") if driver else ""
+    return [option for option in options if f'name="{option.split("=")[0]}"' in option_list]
+
+
+def convert(src_path, dest_path, file_format):
+    """Converte il primo layer di src_path nel formato locale richiesto"""
+    driver_name, _, layer_options = LOCAL_FORMATS[file_format]
+
+    src_ds = ogr.Open(src_path)
+    if src_ds is None or src_ds.GetLayerCount() == 0:
+        raise IOError(f"Impossibile leggere i dati da convertire: {src_path}")
+    layer_name = src_ds.GetLayer(0).GetName()
+    src_ds = None
+
+    result = gdal.VectorTranslate(
+        dest_path, src_path,
+        format=driver_name,
+        layers=[layer_name],
+        layerCreationOptions=supported_options(driver_name, layer_options))
+    if result is None:
+        raise IOError(f"Conversione in {driver_name} non riuscita: {gdal.GetLastErrorMsg()}")
+    result = None
+    return dest_path
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Crosswalk
+
+ Corrispondenze tra i codici ISTAT delle diverse date di riferimento,
+ ricavate dalle tabelle degli attributi e salvate in cache, per ricodificare
+ in blocco tabelle con codici storici senza accedere alla rete.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import csv
+import json
+import os
+import re
+import unicodedata
+import urllib.error
+
+from osgeo import ogr
+
+from .istat_boundaries_downloader_diff import NO_CODE_PREFIX, date_versions, spatial_matches
+from .istat_boundaries_downloader_join import normalize_code, open_table
+from .istat_boundaries_downloader_store import CODE_FIELD_BY_TYPE, VERSIONS_TABLE
+
+NAME_FIELDS = ("comune", "den_com", "den_uts", "den_prov", "den_pcm", "den_reg", "den_rip")
+OUTPUT_DRIVERS = {".csv": "CSV", ".xlsx": "XLSX", ".gpkg": "GPKG"}
+
+
+def normalize_name(name):
+    """Denominazione senza accenti, maiuscole, spazi e punteggiatura"""
+    text = unicodedata.normalize("NFKD", name or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"[^a-z0-9]", "", text.lower())
+
+
+def read_codes(path, code_field):
+    """Codici normalizzati -> denominazione normalizzata da una tabella CSV delle API"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        fields = {name.strip('"').lower(): name for name in reader.fieldnames or []}
+        if code_field not in fields:
+            raise ValueError(f"Campo {code_field} non trovato in {os.path.basename(path)}")
+        name_field = next((fields[name] for name in NAME_FIELDS if name in fields), None)
+        codes = {}
+        for row in reader:
+            code = normalize_code(row[fields[code_field]])
+            if code is not None:
+                codes[code] = normalize_name(row[name_field]) if name_field else ""
+        return codes
+
+
+def link_dates(codes_a, codes_b, spatial=None):
+    """Corrispondenze dei codici di codes_a che non esistono in codes_b
+
+    I codici scomparsi sono associati per denominazione (cambi di provincia)
+    e, se disponibile, tramite spatial (codice -> codici sovrapposti alla data
+    successiva, anche già esistenti) per fusioni, incorporazioni e scorpori.
+    I codici senza corrispondenza mappano su [].
+    """
+    removed = [code for code in codes_a if code not in codes_b]
+    added_by_name = {}
+    for code in codes_b:
+        if code not in codes_a and codes_b[code]:
+            added_by_name.setdefault(codes_b[code], []).append(code)
+    links = {}
+    for code in removed:
+        candidates = added_by_name.get(codes_a[code], [])
+        if len(candidates) == 1:
+            links[code] = candidates
+        else:
+            links[code] = sorted((spatial or {}).get(code, []))
+    return links
+
+
+class Crosswalk:
+    """Corrispondenze dei codici di un tipo di confine tra date di riferimento
+
+    Per ogni coppia di date consecutive sono salvati solo i codici che cambiano;
+    mapping() compone i passaggi in un dizionario per ricerche O(1).
+    """
+
+    def __init__(self, boundary_type, dates, codes, steps):
+        self.boundary_type = boundary_type
+        self.dates = dates
+        self.codes = codes
+        self.steps = steps
+        self._mappings = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["boundary_type"], data["dates"],
+                   {date: set(codes) for date, codes in data["codes"].items()}, data["steps"])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = {
+            "boundary_type": self.boundary_type,
+            "dates": self.dates,
+            "codes": {date: sorted(codes) for date, codes in self.codes.items()},
+            "steps": self.steps,
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+    def step(self, date_from, date_to):
+        """Codici che cambiano passando tra due date consecutive (in entrambe le direzioni)"""
+        i, j = self.dates.index(date_from), self.dates.index(date_to)
+        if j == i + 1:
+            return self.steps[i]
+        inverse = {}
+        for code, targets in self.steps[j].items():
+            for target in targets:
+                inverse.setdefault(target, []).append(code)
+        # Un codice che ha incorporato altri comuni resta tra i propri predecessori
+        for target, codes in inverse.items():
+            if target in self.codes[date_to]:
+                codes.append(target)
+            codes.sort()
+        # I codici nuovi senza predecessore non esistevano alla data precedente
+        for code in self.codes[date_from]:
+            if code not in self.codes[date_to] and code not in inverse:
+                inverse[code] = []
+        return inverse
+
+    def mapping(self, date_from, date_to):
+        """Dizionario codice alla data date_from -> tupla di codici alla data date_to"""
+        key = (date_from, date_to)
+        for date_str in key:
+            if date_str not in self.dates:
+                raise ValueError(f"Data {date_str} non disponibile nelle corrispondenze dei codici")
+        if key not in self._mappings:
+            i, j = self.dates.index(date_from), self.dates.index(date_to)
+            direction = 1 if j >= i else -1
+            current = {code: {code} for code in self.codes[date_from]}
+            for k in range(i, j, direction):
+                changes = self.step(self.dates[k], self.dates[k + direction])
+                for code, targets in current.items():
+                    if targets & changes.keys():
+                        current[code] = {new for old in targets
+                                         for new in (changes[old] if old in changes else [old])}
+            self._mappings[key] = {code: tuple(sorted(targets)) for code, targets in current.items()}
+        return self._mappings[key]
+
+    def lookup(self, code, date_from, date_to):
+        """Codici alla data date_to corrispondenti a code alla data date_from"""
+        return self.mapping(date_from, date_to).get(normalize_code(code), ())
+
+
+def build_crosswalk(boundary_type, dates, table_paths, store=None):
+    """Costruisce le corrispondenze dalle tabelle CSV degli attributi delle date
+
+    table_paths associa a ogni data il percorso della tabella; se store contiene
+    entrambe le date di un passaggio, i codici non associati per denominazione
+    vengono associati per sovrapposizione geometrica con le unità della data
+    successiva, nuove o già esistenti (incorporazioni).
+    """
+    dates = sorted(dates)
+    code_field = CODE_FIELD_BY_TYPE[boundary_type]
+    codes = {date: read_codes(table_paths[date], code_field) for date in dates}
+
+    archived = set(store.dates(boundary_type)) if store is not None else set()
+    ds = ogr.Open(store.path(boundary_type)) if archived else None
+    steps = []
+    for date_a, date_b in zip(dates, dates[1:]):
+        spatial = None
+        if ds is not None and date_a in archived and date_b in archived:
+            rows_a = {normalize_code(code): row for code, row in date_versions(ds, date_a).items()}
+            rows_b = {normalize_code(code): row for code, row in date_versions(ds, date_b).items()}
+            removed = {code: row for code, row in rows_a.items() if code not in rows_b}
+            targets = {code: row for code, row in rows_b.items() if not code.startswith(NO_CODE_PREFIX)}
+            spatial = spatial_matches(ds.GetLayerByName(VERSIONS_TABLE), removed, targets)
+        steps.append(link_dates(codes[date_a], codes[date_b], spatial))
+    return Crosswalk(boundary_type, dates, {date: set(c) for date, c in codes.items()}, steps)
+
+
+def cached_crosswalk(path, boundary_type, dates, base_url, download_cache, store=None):
+    """Crosswalk salvato in path, ricostruito se mancano date
+
+    Le tabelle CSV delle date vengono lette dalla cache dei download e scaricate
+    solo la prima volta; le date non disponibili nelle API vengono ignorate.
+    """
+    if os.path.exists(path):
+        crosswalk = Crosswalk.load(path)
+        if set(dates) <= set(crosswalk.dates):
+            return crosswalk
+    table_paths = {}
+    for date_str in dates:
+        try:
+            table_paths[date_str] = download_cache.fetch(f"{base_url}{date_str}/{boundary_type}.csv")
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+    crosswalk = build_crosswalk(boundary_type, list(table_paths), table_paths, store)
+    crosswalk.save(path)
+    return crosswalk
+
+
+def remap_table(crosswalk, table_path, table_layer_name, key_field, date_from, date_to, out_path):
+    """Scrive la tabella con i codici ricodificati alla data date_to
+
+    Aggiunge le colonne "codice_<date_to>" (più codici separati da virgola in
+    caso di scorporo) e "corrispondenza". Restituisce i conteggi per tipo.
+    """
+    mapping = crosswalk.mapping(date_from, date_to)
+    table_ds = open_table(table_path)
+    table = table_ds.GetLayerByName(table_layer_name) if table_layer_name else table_ds.GetLayer(0)
+    key_index = table.GetLayerDefn().GetFieldIndex(key_field)
+    if key_index < 0:
+        raise ValueError(f"Campo chiave {key_field} non trovato nella tabella")
+
+    driver_name = OUTPUT_DRIVERS.get(os.path.splitext(out_path)[1].lower(), "GPKG")
+    driver = ogr.GetDriverByName(driver_name)
+    if os.path.exists(out_path):
+        driver.DeleteDataSource(out_path)
+    out_ds = driver.CreateDataSource(out_path)
+    out = out_ds.CreateLayer(os.path.splitext(os.path.basename(out_path))[0], None, ogr.wkbNone)
+    table_defn = table.GetLayerDefn()
+    for i in range(table_defn.GetFieldCount()):
+        out.CreateField(table_defn.GetFieldDefn(i))
+    code_column = f"codice_{date_to}"
+    out.CreateField(ogr.FieldDefn(code_column, ogr.OFTString))
+    out.CreateField(ogr.FieldDefn("corrispondenza", ogr.OFTString))
+    out_defn = out.GetLayerDefn()
+
+    counts = {}
+    out_ds.StartTransaction()
+    for feature in table:
+        code = normalize_code(feature.GetField(key_index))
+        if code not in mapping:
+            targets, kind = (), "codice non presente"
+        else:
+            targets = mapping[code]
+            kind = ("soppresso" if not targets else
+                    "identico" if targets == (code,) else
+                    "scorporato" if len(targets) > 1 else "ricodificato")
+        out_feature = ogr.Feature(out_defn)
+        out_feature.SetFrom(feature)
+        out_feature.SetField(code_column, ",".join(targets))
+        out_feature.SetField("corrispondenza", kind)
+        out.CreateFeature(out_feature)
+        counts[kind] = counts.get(kind, 0) + 1
+    out_ds.CommitTransaction()
+    out_ds = None
+    return counts
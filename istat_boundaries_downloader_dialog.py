@@ -19,8 +19,8 @@
  ***************************************************************************/
 """
 
+import hashlib
 import os
-import urllib.request
 import urllib.error
 import zipfile
 import tempfile
@@ -28,16 +28,38 @@ import http.client
 from datetime import datetime
 import shutil
 
-from qgis.PyQt.QtCore import Qt, QUrl, QSize, QTimer
+from qgis.PyQt.QtCore import Qt, QUrl, QSize, QTimer, QSettings
 from qgis.PyQt.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout,
                                QLabel, QComboBox, QPushButton,
                                QProgressBar, QMessageBox, QApplication,
                                QFileDialog, QCheckBox, QWidget, QLineEdit,
                                QFrame, QFormLayout, QGroupBox, QGridLayout)
 from qgis.PyQt.QtGui import QIcon, QCursor, QDesktopServices
-from qgis.core import QgsProject, QgsVectorLayer, Qgis, QgsMessageLog
-
+from qgis.core import QgsApplication, QgsProject, QgsRelation, QgsVectorLayer, QgsVectorTileLayer, Qgis, QgsMessageLog
+
+from .istat_boundaries_downloader_adjacency import build_adjacency
+from .istat_boundaries_downloader_admindex import INDEX_NAME, LEVEL_REGIONI, LEVEL_UTS, AdminIndex, find_admin_index
+from .istat_boundaries_downloader_cache import DownloadCache, file_hash
+from .istat_boundaries_downloader_convert import LOCAL_FORMATS, api_format, convert, is_format_available
+from .istat_boundaries_downloader_crosswalk import NAME_FIELDS
+from .istat_boundaries_downloader_dissolve import DERIVED_TYPES, derive_levels, derived_layer_name
 from .istat_boundaries_downloader_help import HelpDialog
+from .istat_boundaries_downloader_http import SEGMENTS, download, open_url
+from .istat_boundaries_downloader_indexes import build_indexes
+from .istat_boundaries_downloader_kml import download_kml, ingest_kml_file
+from .istat_boundaries_downloader_labels import LABEL_FIELDS, compute_label_points
+from .istat_boundaries_downloader_layers import (LayerLoader, configure_label_placement, date_group_name, find_layers,
+                                                 layer_tag, tag_layer)
+from .istat_boundaries_downloader_metrics import OperationMetrics
+from .istat_boundaries_downloader_package import (PACKAGE_RELATIONS, PACKAGE_TYPES, build_package, fetch_sources,
+                                                  package_layer_name, relation_name)
+from .istat_boundaries_downloader_prefetch import Prefetcher
+from .istat_boundaries_downloader_reproject import TARGET_CRS, TARGET_CRS_SETTING, crs_variant, reproject
+from .istat_boundaries_downloader_store import BoundaryStore, CODE_FIELD_BY_TYPE, view_name
+from .istat_boundaries_downloader_tasks import OPTIONAL, PostDownloadTask
+from .istat_boundaries_downloader_tiles import build_mbtiles, tiles_available
+from .istat_boundaries_downloader_tools import ToolsDialog
+from .istat_boundaries_downloader_watchdog import StallWatchdog
 
 
 class DownloaderDialog(QDialog):
@@ -48,6 +70,20 @@ class DownloaderDialog(QDialog):
         self.base_url = base_url
         self.iface = iface
         self.plugin_dir = plugin_dir
+        self.post_download_task = None
+        # URL e intestazioni dell'ultima verifica HEAD, riusate dal download a segmenti
+        self.last_head = (None, None)
+        self.data_dir = os.path.join(QgsApplication.qgisSettingsDirPath(), "istat_boundaries_downloader")
+        self.store = BoundaryStore(os.path.join(self.data_dir, "store"))
+        self.metrics_path = os.path.join(self.data_dir, "metrics.jsonl")
+        self.last_metrics = None
+        self.cache = DownloadCache(os.path.join(self.data_dir, "cache"))
+        self.prefetcher = Prefetcher(self.cache, self)
+        self.layer_loader = LayerLoader(iface, self)
+        self.watchdog = StallWatchdog.from_settings(self)
+        # Indice amministrativo mappato una sola volta e sostituito dopo un aggiornamento
+        self.admin_index = None
+        self.load_admin_index()
         self.setWindowTitle("ISTAT Boundaries Downloader")
         self.setup_ui()
 
@@ -167,8 +203,10 @@ class DownloaderDialog(QDialog):
         format_label = QLabel("Formato disponibile:")
         format_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
         self.format_combo = QComboBox()
-        for label in self.formats.keys():
-            self.format_combo.addItem(label)
+        for label, file_format in self.formats.items():
+            # I formati prodotti localmente richiedono il relativo driver GDAL
+            if is_format_available(file_format):
+                self.format_combo.addItem(label)
         self.format_combo.setMinimumWidth(300)
         form_grid.addWidget(format_label, 4, 0)
         form_grid.addWidget(self.format_combo, 4, 1)
@@ -224,6 +262,64 @@ class DownloaderDialog(QDialog):
         self.save_only_check = QCheckBox("Solo salvataggio locale (non caricare in QGIS)")
         save_layout.addWidget(self.save_only_check, 1, 1, 1, 2)
 
+        # Checkbox archivio locale versionato
+        self.store_check = QCheckBox("Archivia nell'archivio locale versionato (date già archiviate senza rete)")
+        self.store_check.setToolTip(f"Archivio deduplicato per data di riferimento in:\n{self.store.store_dir}\n"
+                                    "Si applica ai formati scaricati come GeoPackage (GeoPackage, FlatGeobuf, GeoParquet)")
+        save_layout.addWidget(self.store_check, 2, 1, 1, 2)
+
+        # Checkbox prefetch in background della selezione corrente
+        self.prefetch_check = QCheckBox("Anticipa in background il download della selezione corrente")
+        self.prefetch_check.setToolTip(f"Dopo una breve pausa scarica l'URL in anteprima con banda limitata in:\n{self.cache.cache_dir}")
+        self.prefetch_check.toggled.connect(self.update_url_preview)
+        save_layout.addWidget(self.prefetch_check, 3, 1, 1, 2)
+
+        # Checkbox livelli derivati dai comuni
+        self.derive_check = QCheckBox("Con i comuni nazionali, ricava anche regioni, province e ripartizioni")
+        self.derive_check.setToolTip("Un solo download: gli altri livelli sono ottenuti localmente dissolvendo i comuni\n"
+                                     "e condividono esattamente i confini dei comuni")
+        save_layout.addWidget(self.derive_check, 4, 1, 1, 2)
+
+        # Checkbox tile vettoriali
+        self.tiles_check = QCheckBox("Genera anche tile vettoriali MBTiles (zoom 0-12)")
+        self.tiles_check.setToolTip("File .mbtiles pubblicabile su web map e caricato in QGIS come layer di tile vettoriali")
+        self.tiles_check.setEnabled(tiles_available())
+        save_layout.addWidget(self.tiles_check, 5, 1, 1, 2)
+
+        # Sistema di riferimento di destinazione
+        crs_label = QLabel("Riproietta in:")
+        crs_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.crs_combo = QComboBox()
+        for epsg, description in TARGET_CRS.items():
+            self.crs_combo.addItem(description, epsg)
+        self.crs_combo.setToolTip("I confini vengono riproiettati una sola volta dopo il download;\n"
+                                  "la copia riproiettata resta in cache e viene riusata senza rete")
+        saved_epsg = QSettings().value(TARGET_CRS_SETTING, 0, type=int)
+        self.crs_combo.setCurrentIndex(max(0, self.crs_combo.findData(saved_epsg or None)))
+        self.crs_combo.currentIndexChanged.connect(
+            lambda: QSettings().setValue(TARGET_CRS_SETTING, self.crs_combo.currentData() or 0))
+        save_layout.addWidget(crs_label, 6, 0)
+        save_layout.addWidget(self.crs_combo, 6, 1, 1, 2)
+
+        # Checkbox pacchetto completo della data
+        self.package_check = QCheckBox("Pacchetto completo della data (tutti i livelli in un GeoPackage)")
+        self.package_check.setToolTip("Ripartizioni, regioni, UTS e comuni scaricati in parallelo in un solo GeoPackage\n"
+                                      "con indici e relazioni, caricati nel progetto come un unico gruppo")
+        self.package_check.toggled.connect(self.update_package_mode)
+        save_layout.addWidget(self.package_check, 7, 1, 1, 2)
+
+        # Checkbox punti etichetta precalcolati
+        self.labels_check = QCheckBox("Precalcola punti etichetta e centroidi (etichette interne ai confini)")
+        self.labels_check.setToolTip("Polo di inaccessibilità e centroide di ogni confine salvati come layer puntuali;\n"
+                                     "GeoPackage e Shapefile ricevono i campi label_x/label_y usati per posizionare le etichette")
+        save_layout.addWidget(self.labels_check, 8, 1, 1, 2)
+
+        # Checkbox grafo di adiacenza
+        self.adjacency_check = QCheckBox("Calcola il grafo di adiacenza (confinanti e pesi .gal)")
+        self.adjacency_check.setToolTip("Unità confinanti salvate come tabelle CSR indicizzate per codice ISTAT\n"
+                                        "e file di pesi di contiguità .gal per GeoDa e PySAL")
+        save_layout.addWidget(self.adjacency_check, 9, 1, 1, 2)
+
         # Imposta le proporzioni delle colonne
         save_layout.setColumnStretch(0, 0)  # Etichetta
         save_layout.setColumnStretch(1, 1)  # Campo di testo
@@ -301,6 +397,21 @@ class DownloaderDialog(QDialog):
         self.help_button.clicked.connect(self.show_help)
         buttons_layout.addWidget(self.help_button)
 
+        # Pulsante Strumenti
+        self.tools_button = QPushButton("Strumenti")
+        self.tools_button.setIcon(QIcon(":/images/themes/default/mActionOptions.svg"))
+        self.tools_button.setStyleSheet("padding: 8px 15px;")
+        self.tools_button.clicked.connect(self.show_tools)
+        buttons_layout.addWidget(self.tools_button)
+
+        # Pulsante dettagli ultima esecuzione
+        self.last_run_button = QPushButton("Ultima esecuzione")
+        self.last_run_button.setToolTip("Tempi per fase e byte trasferiti dell'ultima operazione")
+        self.last_run_button.setStyleSheet("padding: 8px 15px;")
+        self.last_run_button.setEnabled(False)
+        self.last_run_button.clicked.connect(self.show_last_run)
+        buttons_layout.addWidget(self.last_run_button)
+
         # Aggiunge spaziatore
         buttons_layout.addStretch(1)
 
@@ -391,7 +502,7 @@ class DownloaderDialog(QDialog):
         date_str = self.date_combo.currentText()
         boundary_type = self.boundary_types[self.type_combo.currentText()]
         file_format = self.formats[self.format_combo.currentText()]
-        url = f"{self.base_url}{date_str}/{boundary_type}.{file_format}"
+        url = f"{self.base_url}{date_str}/{boundary_type}.{api_format(file_format)}"
 
         if self.check_url_exists(url):
             QApplication.restoreOverrideCursor()
@@ -408,9 +519,10 @@ class DownloaderDialog(QDialog):
     def check_url_exists(self, url):
         """Check if a URL exists without downloading the full content"""
         try:
-            request = urllib.request.Request(url, method='HEAD')
-            urllib.request.urlopen(request)
-            return True
+            # Senza compressione le intestazioni dicono anche se il download a segmenti è possibile
+            with open_url(url, method='HEAD', headers={"Accept-Encoding": "identity"}) as response:
+                self.last_head = (url, response.headers)
+                return True
         except urllib.error.HTTPError as e:
             QgsMessageLog.logMessage(f"URL check failed: {url} - {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
             return False
@@ -420,6 +532,11 @@ class DownloaderDialog(QDialog):
 
     def download_boundaries(self):
         """Download and load the selected boundaries"""
+        if self.package_check.isChecked():
+            self.download_package()
+            return
+        metrics = OperationMetrics("download_boundaries")
+        waiting_prefetch = False
         try:
             # Change cursor to wait cursor
             QApplication.setOverrideCursor(QCursor(Qt.CursorShape.WaitCursor))
@@ -471,15 +588,110 @@ class DownloaderDialog(QDialog):
             else:
                 display_type = boundary_type
 
+            # Construct the URL
+            url = f"{self.base_url}{date_str}/{boundary_type}.{api_format(file_format)}"
+            metrics.url = url
+
+            # Una richiesta già caricata nel progetto non viene scaricata di nuovo
+            source_key = url if file_format not in LOCAL_FORMATS else f"{url}#{file_format}"
+            target_epsg = self.crs_combo.currentData() if file_format != "csv" else None
+            if target_epsg:
+                source_key = f"{source_key}@EPSG:{target_epsg}"
+            if not save_only and self.reuse_loaded_layer(source_key):
+                metrics.finish("layer già caricato")
+                return
+
+            safe_boundary_name = boundary_type.replace('/', '_')
+            file_name = f"ISTAT_{safe_boundary_name}_{date_str}"
+            layer_name = f"ISTAT_{boundary_type}_{date_str}"
+            projected_path = None
+            if target_epsg:
+                projected_path = os.path.join(self.download_path, f"{file_name}_{file_format}_EPSG{target_epsg}.gpkg")
+                layer_name = f"{layer_name} (EPSG:{target_epsg})"
+                if not os.path.exists(self.download_path):
+                    os.makedirs(self.download_path)
+
+                # Una copia già riproiettata in cache viene caricata senza rete né trasformazioni
+                projected_cached = self.cache.get(url, crs_variant(target_epsg))
+                if projected_cached:
+                    QgsMessageLog.logMessage(f"Dati {boundary_type} del {date_str} in EPSG:{target_epsg} caricati dalla cache", "ISTAT Downloader", Qgis.MessageLevel.Info)
+                    self.copy_file(metrics, projected_cached, projected_path)
+                    cached_hash = self.cache.metadata(url, crs_variant(target_epsg)).get("content_hash")
+                    stages, load_results = self.optional_stages(projected_path, date_str, boundary_type, file_name, file_format)
+                    if stages:
+                        def on_cached_finished(result, task):
+                            label_placement, modified = load_results(task, layer_name, save_only)
+                            self.complete_download(date_str, boundary_type, file_format, projected_path, "ogr", layer_name,
+                                                   save_only, metrics, source_key, cached_hash,
+                                                   label_placement=label_placement, modified=modified,
+                                                   warnings=task.warnings)
+                        self.start_post_download_task(stages, on_cached_finished, metrics=metrics)
+                        return
+                    self.complete_download(date_str, boundary_type, file_format, projected_path, "ogr", layer_name, save_only,
+                                           metrics, source_key, cached_hash)
+                    return
+
+            # Con l'archivio versionato una data già archiviata è una interrogazione locale
+            archive = (self.store_check.isChecked() and
+                       boundary_type in CODE_FIELD_BY_TYPE and
+                       api_format(file_format) == "gpkg")
+            if archive and not save_only and self.store.has_date(boundary_type, date_str):
+                QgsMessageLog.logMessage(f"Dati {boundary_type} del {date_str} caricati dall'archivio locale", "ISTAT Downloader", Qgis.MessageLevel.Info)
+                store_uri = metrics.url = self.store.layer_uri(boundary_type, date_str)
+                store_source = store_uri
+                stages = []
+                if projected_path:
+                    stages.append(("riproiezione", lambda: reproject(store_uri, projected_path, target_epsg)))
+                    store_source = projected_path
+                elif self.labels_check.isChecked() or self.adjacency_check.isChecked():
+                    # L'archivio resta in sola lettura: punti etichetta e grafo si scrivono in una copia della data
+                    export_path = os.path.join(self.download_path, f"{file_name}.gpkg")
+                    if not os.path.exists(self.download_path):
+                        os.makedirs(self.download_path)
+                    stages.append(("copia dall'archivio", lambda: self.store.export(boundary_type, date_str, export_path)))
+                    store_source = f"{export_path}|layername={view_name(boundary_type, date_str)}"
+                optional, load_results = self.optional_stages(store_source, date_str, boundary_type, file_name, file_format)
+                stages += optional
+                if projected_path:
+                    stages.append(("cache riproiezione", lambda: self.cache_projection(url, projected_path, target_epsg), OPTIONAL))
+                if stages:
+                    def on_store_finished(result, task):
+                        label_placement, modified = load_results(task, layer_name, save_only)
+                        self.complete_download(date_str, boundary_type, file_format, store_source, "ogr", layer_name,
+                                               save_only, metrics, source_key,
+                                               label_placement=label_placement, modified=modified,
+                                               warnings=task.warnings)
+                    self.start_post_download_task(stages, on_store_finished, metrics=metrics)
+                    return
+                self.complete_download(date_str, boundary_type, file_format, store_source, "ogr", layer_name, save_only,
+                                       metrics, source_key)
+                return
+
             # Verifica che la cartella di destinazione esista
             if not os.path.exists(self.download_path):
                 os.makedirs(self.download_path)
 
-            # Construct the URL
-            url = f"{self.base_url}{date_str}/{boundary_type}.{file_format}"
+            # Un prefetch in corso prosegue senza limite di banda e il download riprende al suo termine
+            if self.prefetcher.claim(url, lambda: self.resume_after_prefetch(url)):
+                waiting_prefetch = True
+                self.download_button.setEnabled(False)
+                QgsMessageLog.logMessage(f"In attesa del download anticipato di {url}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+                return
+
+            # Un prefetch completato evita verifica e trasferimento
+            with metrics.phase("prefetch") as phase:
+                cached_path = self.cache.get(url)
+                if cached_path:
+                    phase["bytes"] = os.path.getsize(cached_path)
 
             # First check if the URL exists
-            if not self.check_url_exists(url):
+            if cached_path:
+                url_exists = True
+            else:
+                with metrics.phase("verifica URL"):
+                    url_exists = self.check_url_exists(url)
+            if not url_exists:
+                metrics.finish("API non disponibile")
                 QApplication.restoreOverrideCursor()
                 self.progress_bar.setVisible(False)
                 QMessageBox.critical(
@@ -493,11 +705,30 @@ class DownloaderDialog(QDialog):
             self.progress_bar.setValue(20)
 
             temp_dir = tempfile.mkdtemp()
-            safe_boundary_name = boundary_type.replace('/', '_')
-            temp_file_path = os.path.join(temp_dir, f"{safe_boundary_name}.{file_format}")
-
+            temp_file_path = os.path.join(temp_dir, f"{safe_boundary_name}.{api_format(file_format)}")
+
+            # KML e KMZ vengono caricati da un GeoPackage indicizzato convertito in streaming;
+            # un KML dalla rete è scaricato e convertito insieme nel task in background
+            kml_gpkg_path = None
+            kml_transfer = False
+            if file_format in ("kml", "kmz") and not save_only:
+                kml_gpkg_path = os.path.join(self.download_path, f"ISTAT_{safe_boundary_name}_{date_str}_{file_format}.gpkg")
+                kml_transfer = file_format == "kml" and not cached_path
+
+            # Hash del contenuto per riconoscere dati identici già caricati da altre sorgenti
+            content_hash = None
             try:
-                urllib.request.urlretrieve(url, temp_file_path)
+                if cached_path:
+                    # Il file in cache viene solo letto dalle fasi successive
+                    temp_file_path = cached_path
+                    content_hash = file_hash(cached_path)
+                elif not kml_transfer:
+                    hasher = hashlib.sha1()
+                    with metrics.phase("trasferimento") as phase:
+                        head = self.last_head[1] if self.last_head[0] == url else None
+                        phase["bytes"] = download(url, temp_file_path, stats=phase, on_chunk=hasher.update,
+                                                  segments=SEGMENTS, head=head)
+                    content_hash = hasher.hexdigest()
             except urllib.error.HTTPError as e:
                 if e.code == 404:
                     QApplication.restoreOverrideCursor()
@@ -508,14 +739,12 @@ class DownloaderDialog(QDialog):
 
             self.progress_bar.setValue(50)
 
-            file_name = f"ISTAT_{safe_boundary_name}_{date_str}"
-
             if file_format == "zip":
                 dest_zip_path = os.path.join(self.download_path, f"{file_name}.zip")
-                shutil.copyfile(temp_file_path, dest_zip_path)
+                self.copy_file(metrics, temp_file_path, dest_zip_path)
 
                 try:
-                    with zipfile.ZipFile(temp_file_path, 'r') as zip_ref:
+                    with metrics.phase("estrazione"), zipfile.ZipFile(temp_file_path, 'r') as zip_ref:
                         zip_ref.extractall(temp_dir)
 
                     shp_files = [f for f in os.listdir(temp_dir) if f.endswith('.shp')]
@@ -531,7 +760,7 @@ class DownloaderDialog(QDialog):
                     if not os.path.exists(dest_dir):
                         os.makedirs(dest_dir)
 
-                    with zipfile.ZipFile(dest_zip_path, 'r') as zip_ref:
+                    with metrics.phase("estrazione"), zipfile.ZipFile(dest_zip_path, 'r') as zip_ref:
                         zip_ref.extractall(dest_dir)
 
                 except zipfile.BadZipFile:
@@ -540,7 +769,7 @@ class DownloaderDialog(QDialog):
                     return
             elif file_format == "csv":
                 dest_csv_path = os.path.join(self.download_path, f"{file_name}.csv")
-                shutil.copyfile(temp_file_path, dest_csv_path)
+                self.copy_file(metrics, temp_file_path, dest_csv_path)
 
                 if not save_only:
                     uri = f"file:///{dest_csv_path}?delimiter=,"
@@ -549,104 +778,473 @@ class DownloaderDialog(QDialog):
                     qgis_file_path = dest_csv_path
             elif file_format == "kml":
                 dest_kml_path = os.path.join(self.download_path, f"{file_name}.kml")
-                shutil.copyfile(temp_file_path, dest_kml_path)
-                qgis_file_path = dest_kml_path
+                if not kml_transfer:
+                    self.copy_file(metrics, temp_file_path, dest_kml_path)
+                qgis_file_path = kml_gpkg_path or dest_kml_path
             elif file_format == "kmz":
                 dest_kmz_path = os.path.join(self.download_path, f"{file_name}.kmz")
-                shutil.copyfile(temp_file_path, dest_kmz_path)
+                self.copy_file(metrics, temp_file_path, dest_kmz_path)
 
-                if not save_only:
-                    try:
-                        with zipfile.ZipFile(temp_file_path, 'r') as kmz:
-                            kml_file = None
-                            for file in kmz.namelist():
-                                if file.endswith('.kml'):
-                                    kml_file = file
-                                    break
-
-                            if kml_file:
-                                kmz.extract(kml_file, temp_dir)
-                                qgis_file_path = os.path.join(temp_dir, kml_file)
-                            else:
-                                qgis_file_path = dest_kmz_path
-                    except zipfile.BadZipFile:
-                        QApplication.restoreOverrideCursor()
-                        QMessageBox.critical(self, "Error", "Il file KMZ scaricato non è valido.")
-                        return
-                else:
-                    qgis_file_path = dest_kmz_path
+                if not save_only and not zipfile.is_zipfile(temp_file_path):
+                    QApplication.restoreOverrideCursor()
+                    QMessageBox.critical(self, "Error", "Il file KMZ scaricato non è valido.")
+                    return
+                qgis_file_path = kml_gpkg_path or dest_kmz_path
+            elif file_format in LOCAL_FORMATS:
+                # FlatGeobuf e GeoParquet vengono prodotti localmente dal GeoPackage scaricato
+                qgis_file_path = os.path.join(self.download_path, f"{file_name}.{file_format}")
             else:
                 dest_path = os.path.join(self.download_path, f"{file_name}.{file_format}")
-                shutil.copyfile(temp_file_path, dest_path)
+                self.copy_file(metrics, temp_file_path, dest_path)
                 qgis_file_path = dest_path
 
             self.progress_bar.setValue(80)
 
-            if not save_only:
-                layer_name = f"ISTAT_{boundary_type}_{date_str}"
+            if file_format == "csv":
+                layer_source, provider_key = qgis_file_path, "delimitedtext"
+            elif file_format == "zip":
+                layer_source, provider_key = os.path.join(dest_dir, shp_files[0]), "ogr"
+            else:
+                layer_source, provider_key = qgis_file_path, "ogr"
 
-                if file_format == "csv":
-                    vector_layer = QgsVectorLayer(uri, layer_name, "delimitedtext")
-                elif file_format in ["kml", "kmz"]:
-                    vector_layer = QgsVectorLayer(qgis_file_path, layer_name, "ogr")
-                else:
-                    if file_format == "zip":
-                        extracted_shp = os.path.join(dest_dir, shp_files[0])
-                        vector_layer = QgsVectorLayer(extracted_shp, layer_name, "ogr")
-                    else:
-                        vector_layer = QgsVectorLayer(qgis_file_path, layer_name, "ogr")
-
-                if (selected_type == "Unità Territoriali Sovracomunali (Province)" and
-                    hasattr(self, 'province_filter_container') and
-                    self.province_filter_container.isVisible() and
-                    self.province_combo.count() > 0 and
-                    self.province_combo.currentText() != "Caricamento province..." and
-                    self.province_combo.currentText() != "Errore nel caricare le province" and
-                    self.province_comuni_check.isChecked()):
-
-                    province_code = self.province_combo.currentData()
-                    province_name = self.province_combo.currentText().split('-', 1)[1] if '-' in self.province_combo.currentText() else self.province_combo.currentText()
-                    boundary_type = f"unita-territoriali-sovracomunali/{province_code}/comuni"
-                    display_type = f"comuni della provincia di {province_name}"
+            # Fasi successive al download eseguite in background (indici, conversioni, archivio)
+            stages = []
+            if file_format == "zip":
+                stages.append(("indici", lambda: build_indexes(dest_dir), OPTIONAL))
+            elif file_format == "gpkg":
+                stages.append(("indici", lambda: build_indexes(qgis_file_path), OPTIONAL))
+            elif file_format in LOCAL_FORMATS:
+                stages.append(("conversione", lambda: convert(temp_file_path, qgis_file_path, file_format)))
+            elif kml_gpkg_path:
+                if kml_transfer:
+                    def transfer_kml():
+                        result = download_kml(url, temp_file_path, kml_gpkg_path, safe_boundary_name)
+                        shutil.copyfile(temp_file_path, dest_kml_path)
+                        return result
+                    stages.append(("trasferimento e conversione KML", transfer_kml))
                 else:
-                    display_type = boundary_type
+                    stages.append(("conversione KML", lambda: ingest_kml_file(temp_file_path, kml_gpkg_path, safe_boundary_name)))
+                stages.append(("indici", lambda: build_indexes(kml_gpkg_path), OPTIONAL))
+            if archive:
+                # Si archivia sempre il GeoPackage delle API, con lo stesso schema per tutte le date
+                archive_source = temp_file_path if file_format in LOCAL_FORMATS else layer_source
+                stages.append(("archivio", lambda: self.store.ingest(archive_source, boundary_type, date_str), OPTIONAL))
+
+            def original_hash(results):
+                """Hash dei dati scaricati, calcolato dal task per i KML convertiti durante il trasferimento"""
+                return results["trasferimento e conversione KML"]["hash"] if kml_transfer else content_hash
+
+            # L'archivio resta nei dati originali; il resto usa la copia riproiettata
+            load_source = layer_source
+            if projected_path:
+                stages.append(("riproiezione", lambda: reproject(layer_source, projected_path, target_epsg), OPTIONAL))
+                load_source = projected_path
+
+            optional, load_results = self.optional_stages(load_source, date_str, boundary_type, file_name, file_format)
+            stages += optional
+
+            if projected_path:
+                # La copia in cache comprende i risultati delle fasi precedenti (es. campi label_x/label_y)
+                def cache_stage():
+                    results = self.post_download_task.results
+                    if results["riproiezione"] is None:
+                        return None
+                    return self.cache_projection(url, projected_path, target_epsg, original_hash(results))
+                stages.append(("cache riproiezione", cache_stage, OPTIONAL))
+
+            if stages:
+                def on_finished(result, task):
+                    source, key, source_hash = load_source, provider_key, original_hash(task.results)
+                    name, request_key = layer_name, source_key
+                    if projected_path and task.results["riproiezione"] is None:
+                        # Riproiezione non riuscita: si caricano i dati originali
+                        source = layer_source
+                        name, request_key = layer_name.rsplit(" (EPSG:", 1)[0], source_key.rsplit("@EPSG:", 1)[0]
+                    elif projected_path:
+                        key, source_hash = "ogr", f"{source_hash}@EPSG:{target_epsg}"
+                    label_placement, modified = load_results(task, name, save_only)
+                    self.complete_download(date_str, boundary_type, file_format, source, key,
+                                           name, save_only, metrics, request_key, source_hash,
+                                           label_placement=label_placement, modified=modified,
+                                           warnings=task.warnings)
+
+                self.start_post_download_task(stages, on_finished, temp_dir, metrics)
+                return
 
-                if vector_layer.isValid():
-                    QgsProject.instance().addMapLayer(vector_layer)
-                    QgsMessageLog.logMessage(f"Dati caricati con successo: {layer_name}", "ISTAT Downloader", Qgis.MessageLevel.Info)
-                else:
-                    QMessageBox.critical(self, "Error", f"Il file {file_format} scaricato non è valido.")
-                    self.progress_bar.setVisible(False)
-                    QApplication.restoreOverrideCursor()
-                    return
+            self.complete_download(date_str, boundary_type, file_format, layer_source, provider_key, layer_name, save_only,
+                                   metrics, source_key, content_hash)
+
+        except Exception as e:
+            metrics.finish(f"errore: {str(e)}")
+            QgsMessageLog.logMessage(f"Errore: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
+            QMessageBox.critical(self, "Error", f"Si è verificato un errore: {str(e)}")
 
+        finally:
+            # Le operazioni interrotte senza task in background vengono comunque registrate
+            if self.post_download_task is None and metrics.outcome is None and not waiting_prefetch:
+                metrics.finish("interrotto")
+            if metrics.outcome is not None and self.last_metrics is not metrics:
+                self.record_metrics(metrics)
+
+            # Se il task in background è avviato la cartella temporanea viene rimossa al suo termine
+            if self.post_download_task is None and not waiting_prefetch:
+                try:
+                    shutil.rmtree(temp_dir)
+                except:
+                    pass
+
+                self.progress_bar.setVisible(False)
+            QApplication.restoreOverrideCursor()
+
+    def download_package(self):
+        """Scarica tutti i livelli della data in un solo GeoPackage e li carica come un gruppo"""
+        date_str = self.date_combo.currentText()
+        save_only = self.save_only_check.isChecked()
+        package_path = os.path.join(self.download_path, f"ISTAT_pacchetto_{date_str}.gpkg")
+        metrics = OperationMetrics("download_package", f"{self.base_url}{date_str}/")
+        if not os.path.exists(self.download_path):
+            os.makedirs(self.download_path)
+
+        # I livelli già archiviati non vengono scaricati di nuovo
+        local_sources = {}
+        if self.store_check.isChecked():
+            local_sources = {boundary_type: self.store.layer_uri(boundary_type, date_str)
+                             for boundary_type in PACKAGE_TYPES if self.store.has_date(boundary_type, date_str)}
+
+        temp_dir = tempfile.mkdtemp()
+        stages = [
+            ("download livelli", lambda: fetch_sources(self.base_url, date_str, temp_dir, local_sources)),
+            ("pacchetto", lambda: build_package(self.post_download_task.results["download livelli"], package_path)),
+        ]
+
+        def on_finished(result, task):
+            counts = task.results["pacchetto"]
+            if not save_only:
+                with metrics.phase("caricamento layer"):
+                    self.load_package(package_path, date_str)
+            metrics.finish("completato")
+            self.record_metrics(metrics)
             self.progress_bar.setValue(100)
+            summary = "\n".join(f"{boundary_type}: {count}" for boundary_type, count in counts["feature"].items())
+            QMessageBox.information(self, "Operazione completata",
+                                    f"Pacchetto del {date_str[:4]}-{date_str[4:6]}-{date_str[6:]} salvato in:\n{package_path}\n\n{summary}")
+
+        self.progress_bar.setValue(10)
+        self.progress_bar.setVisible(True)
+        self.start_post_download_task(stages, on_finished, temp_dir, metrics)
+
+    def load_package(self, package_path, date_str):
+        """Carica i livelli del pacchetto in un solo gruppo e ne registra le relazioni nel progetto"""
+        layers = {}
+        # Inseriti in cima al gruppo uno dopo l'altro: i comuni restano in fondo
+        for boundary_type in reversed(PACKAGE_TYPES):
+            layer = QgsVectorLayer(f"{package_path}|layername={package_layer_name(boundary_type)}",
+                                   f"ISTAT_{boundary_type}_{date_str}", "ogr")
+            if layer.isValid():
+                tag_layer(layer, date=date_str, boundary_type=boundary_type)
+                self.layer_loader.add(layer, (date_group_name(date_str), "pacchetto completo"))
+                layers[boundary_type] = layer
+        self.layer_loader.flush()
+
+        manager = QgsProject.instance().relationManager()
+        for child_type, parent_type, field in PACKAGE_RELATIONS:
+            if child_type not in layers or parent_type not in layers:
+                continue
+            relation = QgsRelation()
+            relation.setId(f"istat_{relation_name(child_type, parent_type)}_{date_str}_{layers[child_type].id()}")
+            relation.setName(f"{package_layer_name(child_type)} -> {package_layer_name(parent_type)} ({date_str})")
+            relation.setReferencingLayer(layers[child_type].id())
+            relation.setReferencedLayer(layers[parent_type].id())
+            relation.addFieldPair(field, field)
+            if relation.isValid():
+                manager.addRelation(relation)
+
+    def update_package_mode(self, checked):
+        """Con il pacchetto completo tipo di confine, formato e filtri non si applicano"""
+        self.type_combo.setEnabled(not checked)
+        self.format_combo.setEnabled(not checked)
+        self.region_filter_container.setEnabled(not checked)
+        if hasattr(self, 'province_filter_container'):
+            self.province_filter_container.setEnabled(not checked)
+
+    def start_post_download_task(self, stages, on_finished, temp_dir=None, metrics=None):
+        """Avvia il task in background con le fasi successive al download"""
+        def finish(result, task):
+            self.post_download_task = None
+            self.download_button.setEnabled(True)
+            if metrics is not None:
+                for name, elapsed in task.timings:
+                    metrics.add_phase(name, elapsed)
+            try:
+                if result:
+                    on_finished(result, task)
+                else:
+                    if metrics is not None:
+                        metrics.finish(f"errore: {task.error or 'operazione annullata'}")
+                        self.record_metrics(metrics)
+                    QMessageBox.critical(self, "Error", f"Elaborazione dei dati scaricati non riuscita: {task.error or 'operazione annullata'}")
+            finally:
+                if temp_dir:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                self.progress_bar.setVisible(False)
 
-            if save_only:
-                message = f"Dati {boundary_type} del {date_str[:4]}-{date_str[4:6]}-{date_str[6:]} scaricati con successo in:\n{self.download_path}"
+        self.post_download_task = PostDownloadTask("ISTAT Downloader: elaborazione dati scaricati", stages, finish)
+        self.post_download_task.progressChanged.connect(
+            lambda progress: self.progress_bar.setValue(80 + int(progress * 0.2)))
+        self.download_button.setEnabled(False)
+        QgsApplication.taskManager().addTask(self.post_download_task)
+
+    def complete_download(self, date_str, boundary_type, file_format, layer_source, provider_key, layer_name, save_only,
+                          metrics=None, source_key=None, content_hash=None, label_placement=False, modified=False,
+                          warnings=()):
+        """Carica il layer scaricato nel progetto e mostra il messaggio finale
+
+        Se nel progetto c'è già un layer con lo stesso contenuto, formato e provider, il nuovo layer ne
+        condivide la sorgente dati. Con modified le fasi successive hanno scritto nel file, che non
+        corrisponde più all'hash e non viene condiviso.
+        Con label_placement le etichette usano i punti precalcolati nei campi label_x/label_y;
+        warnings elenca le elaborazioni facoltative non riuscite.
+        """
+        metrics = metrics or OperationMetrics("download_boundaries", layer_source)
+        if modified:
+            content_hash = None
+        if not save_only:
+            with metrics.phase("caricamento layer"):
+                same_content = [layer for layer in find_layers("content_hash", content_hash)
+                                if layer.providerType() == provider_key and
+                                layer_tag(layer, "file_format") == file_format] if content_hash else []
+                if same_content:
+                    layer_source = same_content[0].source()
+                vector_layer = QgsVectorLayer(layer_source, layer_name, provider_key)
+                if vector_layer.isValid():
+                    tag_layer(vector_layer, source_url=source_key, content_hash=content_hash, file_format=file_format,
+                              date=date_str, boundary_type=boundary_type)
+                    if label_placement:
+                        configure_label_placement(vector_layer, NAME_FIELDS, LABEL_FIELDS)
+                    self.layer_loader.add(vector_layer, (date_group_name(date_str), boundary_type))
+
+            if vector_layer.isValid():
+                QgsMessageLog.logMessage(f"Dati caricati con successo: {layer_name}", "ISTAT Downloader", Qgis.MessageLevel.Info)
             else:
-                message = f"Dati {boundary_type} del {date_str[:4]}-{date_str[4:6]}-{date_str[6:]} scaricati con successo in:\n{self.download_path}\n\ne caricati nel progetto QGIS."
+                metrics.finish("file non valido")
+                self.record_metrics(metrics)
+                QMessageBox.critical(self, "Error", f"Il file {file_format} scaricato non è valido.")
+                return
 
-            QMessageBox.information(self, "Operazione completata", message)
+        metrics.finish("completato")
+        self.record_metrics(metrics)
+        self.progress_bar.setValue(100)
 
-        except Exception as e:
-            QgsMessageLog.logMessage(f"Errore: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
-            QMessageBox.critical(self, "Error", f"Si è verificato un errore: {str(e)}")
+        if save_only:
+            message = f"Dati {boundary_type} del {date_str[:4]}-{date_str[4:6]}-{date_str[6:]} scaricati con successo in:\n{self.download_path}"
+        else:
+            message = f"Dati {boundary_type} del {date_str[:4]}-{date_str[4:6]}-{date_str[6:]} scaricati con successo in:\n{self.download_path}\n\ne caricati nel progetto QGIS."
+        if warnings:
+            message += "\n\nElaborazioni facoltative non riuscite (dettagli nei messaggi di log):\n" + "\n".join(warnings)
 
+        QMessageBox.information(self, "Operazione completata", message)
+
+    def resume_after_prefetch(self, url):
+        """Riprende il download atteso al termine del prefetch, se la selezione non è cambiata"""
+        self.download_button.setEnabled(True)
+        self.progress_bar.setVisible(False)
+        if self.current_url != url:
+            QgsMessageLog.logMessage(f"Selezione cambiata durante il download anticipato di {url}: download non ripreso",
+                                     "ISTAT Downloader", Qgis.MessageLevel.Info)
+            return
+        self.download_boundaries()
+
+    def optional_stages(self, source, date_str, boundary_type, file_name, file_format):
+        """Elaborazioni facoltative sui dati da caricare, da download, cache o archivio
+
+        Restituisce le fasi e la funzione load_results(task, layer_name, save_only)
+        che a task concluso carica nel progetto i risultati riusciti e restituisce
+        (label_placement, modified): se le etichette possono usare i punti
+        precalcolati e se le fasi hanno scritto campi o tabelle nella sorgente.
+        """
+        derived_path = os.path.join(self.download_path, f"ISTAT_livelli_{date_str}.gpkg")
+        labels_path = os.path.join(self.download_path, f"{file_name}_etichette.gpkg")
+        graph_path = os.path.join(self.download_path, f"{file_name}_adiacenza.gpkg")
+        gal_path = os.path.join(self.download_path, f"{file_name}.gal")
+        tiles_path = os.path.join(self.download_path, f"{file_name}.mbtiles")
+        stages = []
+        if file_format != "csv":
+            if self.derive_check.isChecked() and boundary_type == "comuni":
+                stages.append(("livelli", lambda: derive_levels(source, derived_path, self.fetch_lookup_tables(date_str)), OPTIONAL))
+            if self.labels_check.isChecked():
+                stages.append(("punti etichetta", lambda: compute_label_points(source, labels_path), OPTIONAL))
+            if self.adjacency_check.isChecked():
+                code_field = CODE_FIELD_BY_TYPE.get(boundary_type.split('/')[-1])
+                stages.append(("adiacenza", lambda: build_adjacency(source, graph_path, gal_path, code_field), OPTIONAL))
+            if self.tiles_check.isChecked():
+                tile_layer_name = boundary_type.split('/')[-1].replace('-', '_')
+                stages.append(("tile vettoriali", lambda: build_mbtiles(source, tiles_path, tile_layer_name), OPTIONAL))
+
+        def load_results(task, layer_name, save_only):
+            graph = task.results.get("adiacenza")
+            if graph is not None:
+                QgsMessageLog.logMessage(f"Grafo di adiacenza: {graph['unita']} unità, {graph['coppie']} coppie confinanti, "
+                                         f"{graph['isolate']} senza confinanti; tabella {graph['tabella']} in {graph['percorso']}, "
+                                         f"pesi in {gal_path}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+            label_points = task.results.get("punti etichetta")
+            if label_points is not None:
+                QgsMessageLog.logMessage(f"Punti etichetta salvati in {label_points['percorso']}",
+                                         "ISTAT Downloader", Qgis.MessageLevel.Info)
+            modified = label_points is not None or graph is not None
+            if save_only:
+                return False, modified
+            if task.results.get("livelli") is not None:
+                self.load_derived_levels(derived_path, date_str)
+            if task.results.get("tile vettoriali") is not None:
+                tile_layer = QgsVectorTileLayer(f"type=mbtiles&url={tiles_path}", f"{layer_name} (tile)")
+                if tile_layer.isValid():
+                    self.layer_loader.add(tile_layer, (date_group_name(date_str), boundary_type))
+            return bool(label_points and label_points["campi"]), modified
+
+        return stages, load_results
+
+    def cache_projection(self, url, projected_path, epsg, content_hash=None):
+        """Conserva in cache una copia di projected_path con chiave (URL, sistema di riferimento)"""
+        temp_path = self.cache.temp_path(url, crs_variant(epsg))
+        shutil.copyfile(projected_path, temp_path)
+        return self.cache.commit(url, temp_path, crs_variant(epsg),
+                                 content_hash=f"{content_hash}@EPSG:{epsg}" if content_hash else None)
+
+    def copy_file(self, metrics, src_path, dest_path):
+        """Copia il file scaricato nella cartella di destinazione misurandone il tempo"""
+        with metrics.phase("copia") as phase:
+            shutil.copyfile(src_path, dest_path)
+            phase["bytes"] = os.path.getsize(dest_path)
+
+    def load_admin_index(self):
+        """Mappa in memoria l'indice amministrativo al posto di quello aperto
+
+        Si usa l'indice più recente tra quello aggiornato nella cartella dati e quello
+        pacchettizzato nella cartella data del plugin.
+        """
+        self.close_admin_index()
+        path = find_admin_index([os.path.join(self.data_dir, INDEX_NAME),
+                                 os.path.join(self.plugin_dir, "data", INDEX_NAME)])
+        if path is None:
+            return
+        try:
+            self.admin_index = AdminIndex.open(path)
+        except (OSError, ValueError) as e:
+            QgsMessageLog.logMessage(f"Indice amministrativo non leggibile: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+
+    def close_admin_index(self):
+        """Rilascia l'indice amministrativo mappato"""
+        if self.admin_index is not None:
+            self.admin_index.close()
+            self.admin_index = None
+
+    def install_admin_index(self, new_path, out_path):
+        """Sostituisce l'indice out_path con new_path e lo mappa al posto del precedente"""
+        # Su Windows un file mappato in memoria non può essere sostituito
+        self.close_admin_index()
+        try:
+            os.replace(new_path, out_path)
         finally:
-            try:
-                shutil.rmtree(temp_dir)
-            except:
-                pass
+            self.load_admin_index()
+
+    def admin_units(self, date_str, level, parent=None):
+        """Unità dell'indice amministrativo locale alla data, o None se la data non è indicizzata"""
+        if self.admin_index is None or date_str not in self.admin_index.dates:
+            return None
+        return self.admin_index.units(date_str, level, parent)
+
+    def fetch_lookup(self, url, metrics):
+        """Scarica una tabella di riferimento in un file temporaneo"""
+        fd, temp_file = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        with metrics.phase("trasferimento") as phase:
+            phase["bytes"] = download(url, temp_file, stats=phase)
+        return temp_file
+
+    def reuse_loaded_layer(self, source_key):
+        """Propone di riusare un layer già caricato per la stessa richiesta
+
+        Restituisce True se il layer esistente è stato selezionato o duplicato.
+        """
+        existing = find_layers("source_url", source_key)
+        if not existing:
+            return False
+        layer = existing[0]
+        QApplication.restoreOverrideCursor()
+        box = QMessageBox(QMessageBox.Icon.Question, "Layer già caricato",
+                          f"Il layer \"{layer.name()}\" per questa richiesta è già nel progetto.", parent=self)
+        focus_button = box.addButton("Seleziona il layer esistente", QMessageBox.ButtonRole.AcceptRole)
+        clone_button = box.addButton("Aggiungi una copia", QMessageBox.ButtonRole.ActionRole)
+        box.addButton("Scarica di nuovo", QMessageBox.ButtonRole.RejectRole)
+        box.exec()
+        if box.clickedButton() is focus_button:
+            self.layer_loader.focus(layer)
+            return True
+        if box.clickedButton() is clone_button:
+            # La copia condivide sorgente dati e stile senza riscaricare nulla
+            copy = layer.clone()
+            tag_layer(copy, source_url=source_key, content_hash=layer_tag(layer, "content_hash"),
+                      file_format=layer_tag(layer, "file_format"), date=layer_tag(layer, "date"), boundary_type=layer_tag(layer, "boundary_type"))
+            self.layer_loader.add(copy, (date_group_name(layer_tag(layer, "date")), layer_tag(layer, "boundary_type")))
+            self.layer_loader.flush()
+            return True
+        return False
 
-            self.progress_bar.setVisible(False)
-            QApplication.restoreOverrideCursor()
+    def fetch_lookup_tables(self, date_str):
+        """Tabelle CSV dei livelli derivati dalla cache dei download; eseguita nel task"""
+        tables = {}
+        for boundary_type in DERIVED_TYPES:
+            try:
+                tables[boundary_type] = self.cache.fetch(f"{self.base_url}{date_str}/{boundary_type}.csv")
+            except urllib.error.URLError as e:
+                QgsMessageLog.logMessage(f"Attributi di {boundary_type} non disponibili: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+        return tables
+
+    def load_derived_levels(self, derived_path, date_str):
+        """Accoda al caricamento i livelli ricavati dai comuni"""
+        for boundary_type in DERIVED_TYPES:
+            layer = QgsVectorLayer(f"{derived_path}|layername={derived_layer_name(boundary_type)}",
+                                   f"ISTAT_{boundary_type}_{date_str} (da comuni)", "ogr")
+            if layer.isValid():
+                self.layer_loader.add(layer, (date_group_name(date_str), boundary_type))
+
+    def record_metrics(self, metrics, last_run=True):
+        """Registra le metriche nel log dei messaggi e nel file JSON lines"""
+        if last_run:
+            self.last_metrics = metrics
+            self.last_run_button.setEnabled(True)
+        metrics.log()
+        try:
+            metrics.append_to(self.metrics_path)
+        except OSError as e:
+            QgsMessageLog.logMessage(f"Impossibile scrivere le metriche: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+
+    def show_last_run(self):
+        """Mostra il dettaglio dei tempi per fase dell'ultima operazione"""
+        if self.last_metrics is not None:
+            QMessageBox.information(self, "Dettagli ultima esecuzione",
+                                    f"{self.last_metrics.summary()}\n\nStorico completo in:\n{self.metrics_path}")
+
+    def done(self, result):
+        """Annulla il prefetch in corso alla chiusura del dialogo"""
+        self.prefetcher.cancel()
+        self.close_admin_index()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        super().done(result)
 
     def show_help(self):
         """Apre il dialogo di guida"""
         dlg = HelpDialog(self)
         dlg.exec()
 
+    def show_tools(self):
+        """Apre il dialogo degli strumenti di analisi"""
+        dates = [self.date_combo.itemText(i) for i in range(self.date_combo.count())]
+        dlg = ToolsDialog(self.boundary_types, dates, self.base_url, self.store, self.cache, self.download_path,
+                          self.layer_loader, self, install_admin_index=self.install_admin_index)
+        dlg.exec()
+
     def browse_folder(self):
         """Browse for a folder to save the downloaded files"""
         folder = QFileDialog.getExistingDirectory(self, "Seleziona cartella di destinazione", self.download_path)
@@ -720,14 +1318,31 @@ class DownloaderDialog(QDialog):
 
             date_str = self.date_combo.currentText()
 
+            regions_url = f"{self.base_url}{date_str}/regioni.csv"
+            metrics = OperationMetrics("populate_region_combo", regions_url)
+
+            # L'indice amministrativo locale evita ogni accesso alla rete
+            with metrics.phase("indice locale"):
+                regions = self.admin_units(date_str, LEVEL_REGIONI)
+            if regions:
+                regions.sort(key=lambda unit: unit.code)
+                for unit in regions:
+                    self.region_combo.addItem(unit.name, str(unit.code))
+                self.region_combo.currentIndexChanged.connect(self.update_url_preview)
+                self.region_data_combo.currentIndexChanged.connect(self.update_url_preview)
+                self.update_region_filter_state(self.region_filter_check.isChecked())
+                metrics.finish("indice locale")
+                self.record_metrics(metrics, last_run=False)
+                return
+
             self.region_combo.addItem("Caricamento regioni...")
             QApplication.processEvents()
 
-            regions_url = f"{self.base_url}{date_str}/regioni.csv"
-            url_disponibile = self.check_url_exists(regions_url)
+            with metrics.phase("verifica URL"):
+                url_disponibile = self.check_url_exists(regions_url)
 
             if url_disponibile:
-                temp_file, _ = urllib.request.urlretrieve(regions_url)
+                temp_file = self.fetch_lookup(regions_url, metrics)
                 available_regions = set()
 
                 with open(temp_file, 'r', encoding='utf-8') as f:
@@ -754,6 +1369,9 @@ class DownloaderDialog(QDialog):
 
             self.update_region_filter_state(self.region_filter_check.isChecked())
 
+            metrics.finish("completato" if url_disponibile else "elenco predefinito")
+            self.record_metrics(metrics, last_run=False)
+
         except Exception as e:
             QgsMessageLog.logMessage(f"Errore nel caricare le regioni: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
             self.region_combo.clear()
@@ -793,9 +1411,13 @@ class DownloaderDialog(QDialog):
                 else:
                     boundary_type = f"unita-territoriali-sovracomunali/{province_code}"
 
-            url = f"{self.base_url}{date_str}/{boundary_type}.{file_format}"
+            url = f"{self.base_url}{date_str}/{boundary_type}.{api_format(file_format)}"
             self.current_url = url
             self.url_preview.setText(url)
+            if self.prefetch_check.isChecked():
+                self.prefetcher.schedule(url)
+            else:
+                self.prefetcher.stop()
 
         except Exception as e:
             self.url_preview.setText(f"Errore nell'aggiornare l'URL: {str(e)}")
@@ -899,91 +1521,22 @@ class DownloaderDialog(QDialog):
         if hasattr(self, 'province_search'):
             self.province_search.clear()
 
-        self.province_combo.addItem("Caricamento province...")
-        QApplication.processEvents()
-
         try:
             date_str = self.date_combo.currentText()
             provinces_url = f"{self.base_url}{date_str}/unita-territoriali-sovracomunali.csv"
-            url_disponibile = self.check_url_exists(provinces_url)
-
-            if not url_disponibile:
-                QgsMessageLog.logMessage(f"URL province non disponibile: {provinces_url}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
-                self.province_combo.clear()
-                self.province_combo.addItem("Dati non disponibili per questa data")
-                return
-
-            province_from_api = []
-
-            try:
-                temp_file, _ = urllib.request.urlretrieve(provinces_url)
-
-                with open(temp_file, 'r', encoding='utf-8') as f:
-                    header_line = next(f)
-                    header = header_line.strip().split(',')
-
-                    col_indices = {}
-                    for i, col in enumerate(header):
-                        col_clean = col.strip('"')
-                        if col_clean in ['cod_prov', 'cod_ut', 'cod_provincia']:
-                            col_indices['cod_prov'] = i
-                        elif col_clean in ['cod_uts']:
-                            col_indices['cod_uts'] = i
-                        elif col_clean in ['den_prov', 'den_uts', 'den_provincia']:
-                            col_indices['den_prov'] = i
-                        elif col_clean in ['den_pcm', 'den_ita']:
-                            col_indices['den_pcm'] = i
-                        elif col_clean in ['sigla_prov', 'sigla', 'sigla_provincia']:
-                            col_indices['sigla'] = i
-
-                    if 'cod_prov' not in col_indices:
-                        col_indices['cod_prov'] = 0
-
-                    for line in f:
-                        parts = line.strip().split(',')
-                        if len(parts) <= col_indices['cod_prov']:
-                            continue
-
-                        cod_prov = parts[col_indices['cod_prov']].strip('"')
-                        # L'API usa cod_uts come chiave URL (diverso da cod_prov per le città metropolitane)
-                        uts_idx = col_indices.get('cod_uts', col_indices['cod_prov'])
-                        url_code = parts[uts_idx].strip('"') if len(parts) > uts_idx else cod_prov
-                        nome_prov = None
-
-                        if 'den_prov' in col_indices and len(parts) > col_indices['den_prov']:
-                            nome_temp = parts[col_indices['den_prov']].strip('"')
-                            if nome_temp and nome_temp != "-":
-                                nome_prov = nome_temp
-
-                        if (nome_prov is None or nome_prov == "-") and 'den_pcm' in col_indices and len(parts) > col_indices['den_pcm']:
-                            nome_temp = parts[col_indices['den_pcm']].strip('"')
-                            if nome_temp and nome_temp != "-":
-                                nome_prov = nome_temp
-
-                        if (nome_prov is None or nome_prov == "-") and 'sigla' in col_indices and len(parts) > col_indices['sigla']:
-                            nome_temp = parts[col_indices['sigla']].strip('"')
-                            if nome_temp and nome_temp != "-":
-                                nome_prov = nome_temp
-
-                        if nome_prov is None or nome_prov == "-":
-                            nome_prov = f"Provincia {cod_prov}"
-
-                        display_text = f"{cod_prov}-{nome_prov}"
-                        province_from_api.append((display_text, url_code))
-
-                if province_from_api:
-                    self.province_combo.clear()
-                    province_from_api.sort(key=lambda x: int(x[1]) if x[1].isdigit() else float('inf'))
-                    for display_text, cod_prov in province_from_api:
-                        self.province_combo.addItem(display_text, cod_prov)
-                else:
-                    self.province_combo.clear()
-                    self.province_combo.addItem("Nessuna provincia trovata per questa data")
-
-            except Exception as e:
-                QgsMessageLog.logMessage(f"Errore nel processare CSV province: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
-                self.province_combo.clear()
-                self.province_combo.addItem(f"Errore: {str(e)}")
+            metrics = OperationMetrics("populate_province_combo", provinces_url)
+
+            # L'indice amministrativo locale evita ogni accesso alla rete
+            with metrics.phase("indice locale"):
+                provinces = self.admin_units(date_str, LEVEL_UTS)
+            if provinces:
+                provinces.sort(key=lambda unit: unit.code)
+                for unit in provinces:
+                    self.province_combo.addItem(f"{unit.alt_code or unit.code}-{unit.name}", str(unit.code))
+                metrics.finish("indice locale")
+                self.record_metrics(metrics, last_run=False)
+            else:
+                self.populate_provinces_from_api(provinces_url, metrics)
 
         except Exception as e:
             QgsMessageLog.logMessage(f"Errore generale nel caricare le province: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
@@ -1003,6 +1556,96 @@ class DownloaderDialog(QDialog):
                     'data': self.province_combo.itemData(i)
                 })
 
+    def populate_provinces_from_api(self, provinces_url, metrics):
+        """Popola il combo box delle province dalla tabella CSV delle API"""
+        self.province_combo.addItem("Caricamento province...")
+        QApplication.processEvents()
+        with metrics.phase("verifica URL"):
+            url_disponibile = self.check_url_exists(provinces_url)
+
+        if not url_disponibile:
+            metrics.finish("non disponibile")
+            self.record_metrics(metrics, last_run=False)
+            QgsMessageLog.logMessage(f"URL province non disponibile: {provinces_url}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+            self.province_combo.clear()
+            self.province_combo.addItem("Dati non disponibili per questa data")
+            return
+
+        province_from_api = []
+
+        try:
+            temp_file = self.fetch_lookup(provinces_url, metrics)
+
+            with open(temp_file, 'r', encoding='utf-8') as f:
+                header_line = next(f)
+                header = header_line.strip().split(',')
+
+                col_indices = {}
+                for i, col in enumerate(header):
+                    col_clean = col.strip('"')
+                    if col_clean in ['cod_prov', 'cod_ut', 'cod_provincia']:
+                        col_indices['cod_prov'] = i
+                    elif col_clean in ['cod_uts']:
+                        col_indices['cod_uts'] = i
+                    elif col_clean in ['den_prov', 'den_uts', 'den_provincia']:
+                        col_indices['den_prov'] = i
+                    elif col_clean in ['den_pcm', 'den_ita']:
+                        col_indices['den_pcm'] = i
+                    elif col_clean in ['sigla_prov', 'sigla', 'sigla_provincia']:
+                        col_indices['sigla'] = i
+
+                if 'cod_prov' not in col_indices:
+                    col_indices['cod_prov'] = 0
+
+                for line in f:
+                    parts = line.strip().split(',')
+                    if len(parts) <= col_indices['cod_prov']:
+                        continue
+
+                    cod_prov = parts[col_indices['cod_prov']].strip('"')
+                    # L'API usa cod_uts come chiave URL (diverso da cod_prov per le città metropolitane)
+                    uts_idx = col_indices.get('cod_uts', col_indices['cod_prov'])
+                    url_code = parts[uts_idx].strip('"') if len(parts) > uts_idx else cod_prov
+                    nome_prov = None
+
+                    if 'den_prov' in col_indices and len(parts) > col_indices['den_prov']:
+                        nome_temp = parts[col_indices['den_prov']].strip('"')
+                        if nome_temp and nome_temp != "-":
+                            nome_prov = nome_temp
+
+                    if (nome_prov is None or nome_prov == "-") and 'den_pcm' in col_indices and len(parts) > col_indices['den_pcm']:
+                        nome_temp = parts[col_indices['den_pcm']].strip('"')
+                        if nome_temp and nome_temp != "-":
+                            nome_prov = nome_temp
+
+                    if (nome_prov is None or nome_prov == "-") and 'sigla' in col_indices and len(parts) > col_indices['sigla']:
+                        nome_temp = parts[col_indices['sigla']].strip('"')
+                        if nome_temp and nome_temp != "-":
+                            nome_prov = nome_temp
+
+                    if nome_prov is None or nome_prov == "-":
+                        nome_prov = f"Provincia {cod_prov}"
+
+                    display_text = f"{cod_prov}-{nome_prov}"
+                    province_from_api.append((display_text, url_code))
+
+            if province_from_api:
+                self.province_combo.clear()
+                province_from_api.sort(key=lambda x: int(x[1]) if x[1].isdigit() else float('inf'))
+                for display_text, cod_prov in province_from_api:
+                    self.province_combo.addItem(display_text, cod_prov)
+            else:
+                self.province_combo.clear()
+                self.province_combo.addItem("Nessuna provincia trovata per questa data")
+
+            metrics.finish("completato")
+            self.record_metrics(metrics, last_run=False)
+
+        except Exception as e:
+            QgsMessageLog.logMessage(f"Errore nel processare CSV province: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
+            self.province_combo.clear()
+            self.province_combo.addItem(f"Errore: {str(e)}")
+
     def update_filters_on_date_change(self):
         """Aggiorna i filtri quando cambia la data"""
         if self.region_filter_container.isVisible():
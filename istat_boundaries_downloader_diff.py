@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Diff
+
+ Confronto tra due date di riferimento dell'archivio versionato: feature
+ aggiunte, rimosse, con attributi modificati e con geometria modificata.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import math
+import os
+
+from osgeo import ogr, osr
+
+from .istat_boundaries_downloader_store import META_FIELDS, PRESENCE_TABLE, VERSIONS_TABLE
+
+DIFF_LAYERS = ("aggiunti", "rimossi", "attributi_modificati", "geometria_modificata")
+
+
+class GridIndex:
+    """Indice spaziale a griglia regolare sugli inviluppi (minx, maxx, miny, maxy)"""
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cells(self, envelope):
+        minx, maxx, miny, maxy = envelope
+        for i in range(math.floor(minx / self.cell_size), math.floor(maxx / self.cell_size) + 1):
+            for j in range(math.floor(miny / self.cell_size), math.floor(maxy / self.cell_size) + 1):
+                yield i, j
+
+    def insert(self, item, envelope):
+        """Inserisce un elemento con il suo inviluppo"""
+        for cell in self._cells(envelope):
+            self.cells.setdefault(cell, []).append(item)
+
+    def query(self, envelope):
+        """Restituisce gli elementi le cui celle intersecano l'inviluppo"""
+        found = set()
+        for cell in self._cells(envelope):
+            found.update(self.cells.get(cell, ()))
+        return found
+
+
+# Sistema equivalente (ETRS89 / LAEA Europe) in cui si misurano le aree in metri quadrati
+AREA_EPSG = 3035
+# Prefisso delle chiavi delle versioni senza codice ISTAT, indicizzate per hash
+NO_CODE_PREFIX = "#"
+
+
+def date_versions(ds, date_str):
+    """Versioni presenti in una data, indicizzate per codice ISTAT
+
+    Le versioni senza codice sono indicizzate per hash (con prefisso NO_CODE_PREFIX).
+    """
+    result = ds.ExecuteSQL(
+        f"SELECT v.fid AS version_fid, v.code, v.version_hash, v.geom_hash, v.attr_hash FROM {VERSIONS_TABLE} v "
+        f"JOIN {PRESENCE_TABLE} p ON p.version_hash = v.version_hash WHERE p.ref_date = '{date_str}'")
+    try:
+        rows = {}
+        for feature in result:
+            code = feature.GetField("code")
+            key = code if code is not None else f"{NO_CODE_PREFIX}{feature.GetField('version_hash')}"
+            rows[key] = {
+                "fid": feature.GetField("version_fid"),
+                "version_hash": feature.GetField("version_hash"),
+                "geom_hash": feature.GetField("geom_hash"),
+                "attr_hash": feature.GetField("attr_hash"),
+            }
+        return rows
+    finally:
+        ds.ReleaseResultSet(result)
+
+
+def area_transform(srs):
+    """Trasformazione dal sistema dell'archivio a quello equivalente delle aree"""
+    source = srs.Clone() if srs is not None else osr.SpatialReference()
+    if srs is None:
+        source.ImportFromEPSG(4326)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(AREA_EPSG)
+    for ref in (source, target):
+        ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(source, target)
+
+
+def area_m2(geom, transform):
+    """Area in metri quadrati di una geometria del sistema dell'archivio"""
+    projected = geom.Clone()
+    projected.Transform(transform)
+    return projected.GetArea()
+
+
+def code_list(codes):
+    """Codici ISTAT separati da virgola, escluse le versioni senza codice"""
+    return ",".join(code for code in codes if not code.startswith(NO_CODE_PREFIX))
+
+
+def changed_fields(feature_a, feature_b):
+    """Campi sorgente con valori diversi tra due versioni"""
+    defn = feature_a.GetDefnRef()
+    changed = []
+    for i in range(defn.GetFieldCount()):
+        name = defn.GetFieldDefn(i).GetName()
+        if name in META_FIELDS:
+            continue
+        if feature_a.GetField(i) != feature_b.GetField(i):
+            changed.append(name)
+    return changed
+
+
+def spatial_matches(versions, sources, targets, cell_size=0.1):
+    """Associa tramite indice spaziale le feature rimosse e aggiunte (cambi di codice)"""
+    index = GridIndex(cell_size)
+    geometries = {}
+    for code, row in targets.items():
+        geom = versions.GetFeature(row["fid"]).GetGeometryRef().Clone()
+        geometries[code] = geom
+        index.insert(code, geom.GetEnvelope())
+
+    matches = {}
+    for code, row in sources.items():
+        geom = versions.GetFeature(row["fid"]).GetGeometryRef()
+        found = []
+        for candidate in index.query(geom.GetEnvelope()):
+            other = geometries[candidate]
+            if geom.Intersects(other):
+                overlap = geom.Intersection(other)
+                # Scarta i semplici contatti lungo i confini condivisi
+                if overlap is not None and overlap.GetArea() > 0.01 * min(geom.GetArea(), other.GetArea()):
+                    found.append(candidate)
+        matches[code] = sorted(found)
+    return matches
+
+
+def create_output_layer(out_ds, name, versions, extra_fields):
+    """Crea un layer di output con i campi delle versioni più i campi del confronto"""
+    layer = out_ds.CreateLayer(name, versions.GetSpatialRef(), ogr.wkbMultiPolygon)
+    versions_defn = versions.GetLayerDefn()
+    for i in range(versions_defn.GetFieldCount()):
+        layer.CreateField(versions_defn.GetFieldDefn(i))
+    for field_name, field_type in extra_fields:
+        layer.CreateField(ogr.FieldDefn(field_name, field_type))
+    return layer
+
+
+def write_feature(layer, source, values):
+    """Scrive una feature copiando la versione sorgente e i valori del confronto"""
+    out = ogr.Feature(layer.GetLayerDefn())
+    out.SetFrom(source)
+    for name, value in values.items():
+        out.SetField(name, value)
+    layer.CreateFeature(out)
+
+
+def diff_dates(store, boundary_type, date_a, date_b, out_path):
+    """Confronta due date dell'archivio e scrive i quattro insiemi di differenze in out_path
+
+    Solo le feature con hash diverso vengono confrontate geometricamente.
+    Restituisce il numero di feature per ciascun layer di output.
+    """
+    ds = ogr.Open(store.path(boundary_type))
+    if ds is None:
+        raise IOError(f"Archivio non disponibile per {boundary_type}")
+    versions = ds.GetLayerByName(VERSIONS_TABLE)
+
+    rows_a = date_versions(ds, date_a)
+    rows_b = date_versions(ds, date_b)
+    if not rows_a or not rows_b:
+        raise ValueError(f"Date non presenti nell'archivio: {date_a if not rows_a else date_b}")
+
+    removed = {code: row for code, row in rows_a.items() if code not in rows_b}
+    added = {code: row for code, row in rows_b.items() if code not in rows_a}
+    changed = [code for code in rows_a.keys() & rows_b.keys()
+               if rows_a[code]["version_hash"] != rows_b[code]["version_hash"]]
+
+    predecessors = spatial_matches(versions, added, removed)
+    successors = spatial_matches(versions, removed, added)
+
+    if os.path.exists(out_path):
+        ogr.GetDriverByName("GPKG").DeleteDataSource(out_path)
+    out_ds = ogr.GetDriverByName("GPKG").CreateDataSource(out_path)
+    layers = {
+        "aggiunti": create_output_layer(out_ds, "aggiunti", versions, [("codici_precedenti", ogr.OFTString)]),
+        "rimossi": create_output_layer(out_ds, "rimossi", versions, [("codici_successivi", ogr.OFTString)]),
+        "attributi_modificati": create_output_layer(out_ds, "attributi_modificati", versions, [("campi_modificati", ogr.OFTString)]),
+        "geometria_modificata": create_output_layer(out_ds, "geometria_modificata", versions, [
+            ("area_prima_m2", ogr.OFTReal), ("area_dopo_m2", ogr.OFTReal), ("area_differenza_m2", ogr.OFTReal)]),
+    }
+    counts = dict.fromkeys(DIFF_LAYERS, 0)
+    transform = area_transform(versions.GetSpatialRef())
+
+    out_ds.StartTransaction()
+    for code, row in added.items():
+        write_feature(layers["aggiunti"], versions.GetFeature(row["fid"]), {"codici_precedenti": code_list(predecessors[code])})
+        counts["aggiunti"] += 1
+    for code, row in removed.items():
+        write_feature(layers["rimossi"], versions.GetFeature(row["fid"]), {"codici_successivi": code_list(successors[code])})
+        counts["rimossi"] += 1
+    for code in changed:
+        feature_a = versions.GetFeature(rows_a[code]["fid"])
+        feature_b = versions.GetFeature(rows_b[code]["fid"])
+        if rows_a[code]["attr_hash"] != rows_b[code]["attr_hash"]:
+            fields = changed_fields(feature_a, feature_b)
+            if fields:
+                write_feature(layers["attributi_modificati"], feature_b, {"campi_modificati": ",".join(fields)})
+                counts["attributi_modificati"] += 1
+        if rows_a[code]["geom_hash"] != rows_b[code]["geom_hash"]:
+            geom_a = feature_a.GetGeometryRef()
+            geom_b = feature_b.GetGeometryRef()
+            write_feature(layers["geometria_modificata"], feature_b, {
+                "area_prima_m2": area_m2(geom_a, transform),
+                "area_dopo_m2": area_m2(geom_b, transform),
+                "area_differenza_m2": area_m2(geom_a.SymDifference(geom_b), transform),
+            })
+            counts["geometria_modificata"] += 1
+    out_ds.CommitTransaction()
+    out_ds = None
+    return counts
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Dissolve
+
+ Costruzione locale di ripartizioni, regioni e UTS dissolvendo i comuni per
+ codice, con gli attributi presi dalle tabelle CSV delle API.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import ogr
+
+from .istat_boundaries_downloader_join import normalize_code
+from .istat_boundaries_downloader_store import CODE_FIELD_BY_TYPE
+
+# Livelli ricavabili dai comuni, dal più aggregato al più dettagliato
+DERIVED_TYPES = ("ripartizioni-geografiche", "regioni", "unita-territoriali-sovracomunali")
+
+
+def derived_layer_name(boundary_type):
+    """Nome del layer di un livello derivato nel GeoPackage di output"""
+    return boundary_type.replace("-", "_")
+
+
+def read_lookup(path, code_field):
+    """Righe di una tabella CSV delle API indicizzate per codice normalizzato"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        fields = [name.strip('"').lower() for name in reader.fieldnames or []]
+        rows = {}
+        for values in reader:
+            row = dict(zip(fields, values.values()))
+            code = normalize_code(row.get(code_field))
+            if code is not None:
+                rows[code] = row
+        return fields, rows
+
+
+def dissolve(geometries):
+    """Unione dei poligoni dei comuni di un gruppo
+
+    I comuni ISTAT condividono esattamente i vertici dei confini comuni: l'unione
+    elimina i confini interni e conserva quelli esterni, identici a quelli dei comuni.
+    """
+    collection = ogr.Geometry(ogr.wkbMultiPolygon)
+    for geom in geometries:
+        geom = ogr.ForceToMultiPolygon(geom)
+        for i in range(geom.GetGeometryCount()):
+            collection.AddGeometry(geom.GetGeometryRef(i))
+    return ogr.ForceToMultiPolygon(collection.UnionCascaded())
+
+
+def open_source(uri):
+    """Apre il layer di un URI OGR (percorso, eventualmente con |layername=)"""
+    path, _, layer_name = uri.partition("|layername=")
+    ds = ogr.Open(path)
+    if ds is None:
+        raise IOError(f"Impossibile aprire {path}")
+    return ds, ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+
+
+def derive_levels(comuni_uri, out_path, lookup_paths=None, workers=None):
+    """Scrive in out_path un layer per ciascun livello di DERIVED_TYPES
+
+    Le unioni dei gruppi di comuni vengono eseguite in parallelo; lookup_paths
+    associa a ogni tipo di confine la tabella CSV da cui copiare gli attributi.
+    Restituisce il numero di feature per livello.
+    """
+    lookup_paths = lookup_paths or {}
+    ds, comuni = open_source(comuni_uri)
+    comuni_defn = comuni.GetLayerDefn()
+    code_indexes = {}
+    for boundary_type in DERIVED_TYPES:
+        index = comuni_defn.GetFieldIndex(CODE_FIELD_BY_TYPE[boundary_type])
+        if index < 0:
+            raise ValueError(f"Campo {CODE_FIELD_BY_TYPE[boundary_type]} non presente nei comuni")
+        code_indexes[boundary_type] = index
+
+    groups = {boundary_type: {} for boundary_type in DERIVED_TYPES}
+    for feature in comuni:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        for boundary_type, index in code_indexes.items():
+            groups[boundary_type].setdefault(feature.GetField(index), []).append(geom)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        dissolved = {boundary_type: {code: pool.submit(dissolve, geometries)
+                                     for code, geometries in codes.items()}
+                     for boundary_type, codes in groups.items()}
+
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(out_path):
+        driver.DeleteDataSource(out_path)
+    out_ds = driver.CreateDataSource(out_path)
+    counts = {}
+    out_ds.StartTransaction()
+    for boundary_type in DERIVED_TYPES:
+        code_field = CODE_FIELD_BY_TYPE[boundary_type]
+        layer = out_ds.CreateLayer(derived_layer_name(boundary_type), comuni.GetSpatialRef(), ogr.wkbMultiPolygon)
+        layer.CreateField(comuni_defn.GetFieldDefn(code_indexes[boundary_type]))
+        fields, rows = [], {}
+        if lookup_paths.get(boundary_type):
+            fields, rows = read_lookup(lookup_paths[boundary_type], code_field)
+            fields = [name for name in fields if name != code_field]
+            for name in fields:
+                layer.CreateField(ogr.FieldDefn(name, ogr.OFTString))
+        for code, future in sorted(dissolved[boundary_type].items(), key=lambda item: str(item[0])):
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField(code_field, code)
+            row = rows.get(normalize_code(code), {})
+            for name in fields:
+                if row.get(name) not in (None, ""):
+                    feature.SetField(name, row[name])
+            feature.SetGeometry(future.result())
+            layer.CreateFeature(feature)
+        counts[boundary_type] = len(dissolved[boundary_type])
+    out_ds.CommitTransaction()
+    out_ds = None
+    return counts
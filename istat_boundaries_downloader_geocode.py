@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Geocode
+
+ Assegnazione in blocco di punti (CSV o layer) a comune, provincia,
+ regione e ripartizione tramite un indice spaziale persistente dei comuni
+ di una data: STRtree di shapely se disponibile, altrimenti indice a griglia.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import csv
+import math
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import ogr, osr
+
+from .istat_boundaries_downloader_diff import GridIndex
+from .istat_boundaries_downloader_join import open_table
+from .istat_boundaries_downloader_store import view_name
+
+try:
+    import numpy as np
+    import shapely
+except ImportError:
+    shapely = None
+
+HIERARCHY_FIELDS = ("pro_com", "cod_uts", "cod_prov", "cod_reg", "cod_rip")
+CHUNK_SIZE = 100000
+INDEX_VERSION = 1
+
+
+class ComuniIndex:
+    """Indice spaziale dei comuni di una data con i codici gerarchici
+
+    Con shapely le geometrie sono preparate e interrogate in blocco con uno
+    STRtree (il GIL viene rilasciato, quindi i blocchi girano in parallelo);
+    senza shapely si usa un GridIndex con geometrie OGR.
+    """
+
+    def __init__(self, fields, codes, wkbs, srs_wkt):
+        self.fields = fields
+        self.codes = codes
+        self.wkbs = wkbs
+        self.srs_wkt = srs_wkt
+        if shapely is not None:
+            self.geometries = shapely.from_wkb(wkbs)
+            shapely.prepare(self.geometries)
+            self.tree = shapely.STRtree(self.geometries)
+        else:
+            self.geometries = [ogr.CreateGeometryFromWkb(wkb) for wkb in wkbs]
+            envelopes = [geom.GetEnvelope() for geom in self.geometries]
+            width = max(e[1] for e in envelopes) - min(e[0] for e in envelopes)
+            self.grid = GridIndex(width / 200.0)
+            for i, envelope in enumerate(envelopes):
+                self.grid.insert(i, envelope)
+
+    @classmethod
+    def from_store(cls, store, date_str):
+        """Costruisce l'indice dalla vista dei comuni di una data nell'archivio"""
+        ds = ogr.Open(store.path("comuni"))
+        layer = ds.GetLayerByName(view_name("comuni", date_str)) if ds is not None else None
+        if layer is None:
+            raise ValueError(f"Comuni del {date_str} non presenti nell'archivio")
+        defn = layer.GetLayerDefn()
+        fields = [name for name in HIERARCHY_FIELDS if defn.GetFieldIndex(name) >= 0]
+        codes, wkbs = [], []
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            codes.append(tuple(feature.GetField(name) for name in fields))
+            wkbs.append(bytes(geom.ExportToIsoWkb()))
+        return cls(fields, codes, wkbs, layer.GetSpatialRef().ExportToWkt())
+
+    @classmethod
+    def cached(cls, cache_dir, store, date_str):
+        """Indice salvato su disco per la data, costruito alla prima richiesta"""
+        path = os.path.join(cache_dir, f"comuni_{date_str}.pickle")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if data.get("version") == INDEX_VERSION:
+                return cls(data["fields"], data["codes"], data["wkbs"], data["srs"])
+        index = cls.from_store(store, date_str)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".part", "wb") as f:
+            pickle.dump({"version": INDEX_VERSION, "fields": index.fields, "codes": index.codes,
+                         "wkbs": index.wkbs, "srs": index.srs_wkt}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".part", path)
+        return index
+
+    def locate(self, xs, ys):
+        """Indice del comune che contiene ciascun punto (-1 se nessuno)"""
+        if shapely is not None:
+            points = shapely.points(np.asarray(xs, dtype="float64"), np.asarray(ys, dtype="float64"))
+            found = np.full(len(points), -1, dtype="int64")
+            point_idx, geom_idx = self.tree.query(points, predicate="intersects")
+            found[point_idx] = geom_idx
+            return found.tolist()
+        found = []
+        point = ogr.Geometry(ogr.wkbPoint)
+        for x, y in zip(xs, ys):
+            match = -1
+            if not (math.isfinite(x) and math.isfinite(y)):
+                found.append(match)
+                continue
+            point.SetPoint_2D(0, x, y)
+            for candidate in self.grid.query((x, x, y, y)):
+                if self.geometries[candidate].Contains(point):
+                    match = candidate
+                    break
+            found.append(match)
+        return found
+
+
+def read_points(path, layer_name, x_field, y_field, chunk_size):
+    """Restituisce a blocchi (righe, xs, ys) da un CSV o da un layer OGR
+
+    Per i CSV si usa il modulo csv; per gli altri formati, se x_field è vuoto,
+    le coordinate sono prese dalla geometria puntuale.
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            sample = f.read(65536)
+            f.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            reader = csv.reader(f, dialect)
+            header = next(reader)
+            yield header
+            x_index, y_index = header.index(x_field), header.index(y_field)
+            rows, xs, ys = [], [], []
+            for row in reader:
+                try:
+                    x, y = float(row[x_index].replace(",", ".")), float(row[y_index].replace(",", "."))
+                except (ValueError, IndexError):
+                    x = y = float("nan")
+                rows.append(row)
+                xs.append(x)
+                ys.append(y)
+                if len(rows) >= chunk_size:
+                    yield rows, xs, ys
+                    rows, xs, ys = [], [], []
+            if rows:
+                yield rows, xs, ys
+        return
+
+    ds = open_table(path)
+    layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+    defn = layer.GetLayerDefn()
+    header = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    yield header
+    rows, xs, ys = [], [], []
+    for feature in layer:
+        if x_field:
+            x, y = feature.GetFieldAsDouble(x_field), feature.GetFieldAsDouble(y_field)
+        else:
+            geom = feature.GetGeometryRef()
+            x, y = (geom.GetX(), geom.GetY()) if geom is not None else (float("nan"), float("nan"))
+        rows.append([feature.GetFieldAsString(i) for i in range(len(header))])
+        xs.append(x)
+        ys.append(y)
+        if len(rows) >= chunk_size:
+            yield rows, xs, ys
+            rows, xs, ys = [], [], []
+    if rows:
+        yield rows, xs, ys
+
+
+def point_transform(index, epsg):
+    """Trasformazione dalle coordinate dei punti al sistema dei comuni, o None"""
+    src = osr.SpatialReference()
+    src.ImportFromEPSG(int(epsg))
+    dst = osr.SpatialReference()
+    dst.ImportFromWkt(index.srs_wkt)
+    if src.IsSame(dst):
+        return None
+    for srs in (src, dst):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(src, dst)
+
+
+def geocode_points(index, path, layer_name, x_field, y_field, out_path, epsg=4326,
+                   chunk_size=CHUNK_SIZE, workers=None):
+    """Scrive in out_path (CSV) i punti con i codici gerarchici del comune che li contiene
+
+    I blocchi di punti sono localizzati in parallelo e scritti nell'ordine di
+    lettura, con al più due blocchi in attesa per thread.
+    Restituisce il numero di punti localizzati e non localizzati.
+    """
+    transform = point_transform(index, epsg)
+    workers = workers or os.cpu_count()
+    counts = {"localizzati": 0, "non_localizzati": 0}
+
+    def locate(chunk):
+        rows, xs, ys = chunk
+        if transform is not None:
+            points = transform.TransformPoints(list(zip(xs, ys)))
+            xs, ys = [p[0] for p in points], [p[1] for p in points]
+        return rows, index.locate(xs, ys)
+
+    chunks = read_points(path, layer_name, x_field, y_field, chunk_size)
+    header = next(chunks)
+    empty = [""] * len(index.fields)
+    with open(out_path, "w", encoding="utf-8", newline="") as f, ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = csv.writer(f)
+        writer.writerow(header + list(index.fields))
+
+        def write(future):
+            rows, found = future.result()
+            for row, match in zip(rows, found):
+                if match >= 0:
+                    codes = ["" if code is None else code for code in index.codes[match]]
+                    counts["localizzati"] += 1
+                else:
+                    codes = empty
+                    counts["non_localizzati"] += 1
+                writer.writerow(row + codes)
+
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(locate, chunk))
+            if len(pending) >= 2 * workers:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    return counts
@@ -76,19 +76,59 @@ Non tutte le combinazioni data/tipo sono disponibili: l'URL di anteprima viene a
   <tr><td>Shapefile (.zip)</td><td>Estratto automaticamente in sottocartella</td></tr>
   <tr><td>GeoPackage (.gpkg)</td><td>File unico, consigliato</td></tr>
   <tr><td>CSV (.csv)</td><td>Solo dati tabellari, senza geometrie</td></tr>
-  <tr><td>KML (.kml)</td><td>Compatibile con Google Earth</td></tr>
-  <tr><td>KMZ (.kmz)</td><td>Versione compressa del KML</td></tr>
+  <tr><td>KML (.kml)</td><td>Compatibile con Google Earth; in QGIS caricato da un GeoPackage convertito durante il download</td></tr>
+  <tr><td>KMZ (.kmz)</td><td>Versione compressa del KML; in QGIS caricato da un GeoPackage convertito in background</td></tr>
+  <tr><td>FlatGeobuf (.fgb)</td><td>Prodotto localmente dal GeoPackage, con indice spaziale incorporato: caricamento veloce</td></tr>
+  <tr><td>GeoParquet (.parquet)</td><td>Prodotto localmente dal GeoPackage, file compatti (richiede il driver GDAL Parquet)</td></tr>
 </table>
 
+<div class="tip">Dopo il download di Shapefile e GeoPackage vengono creati in background l'indice spaziale e gli indici sui codici ISTAT (<code>cod_reg</code>, <code>cod_uts</code>, <code>pro_com</code>, ...): interrogazioni, selezioni spaziali e join sono veloci da subito.</div>
+
 <h3>Opzioni di salvataggio</h3>
 <ul>
   <li><b>Salva in</b>: cartella dove verranno salvati i file (default: Documenti)</li>
   <li><b>Solo salvataggio locale</b>: scarica il file senza caricarlo automaticamente in QGIS</li>
+  <li><b>Archivia nell'archivio locale versionato</b>: salva i confini nazionali in un archivio deduplicato (un GeoPackage per tipo di confine); le date già archiviate vengono caricate senza accedere alla rete (formati GeoPackage, FlatGeobuf e GeoParquet)</li>
+  <li><b>Ricava anche regioni, province e ripartizioni</b>: scaricando i comuni nazionali, gli altri livelli vengono ottenuti localmente dissolvendo i comuni (file <code>ISTAT_livelli_&lt;data&gt;.gpkg</code>) invece di scaricarli separatamente</li>
+  <li><b>Genera anche tile vettoriali MBTiles</b>: crea un file <code>.mbtiles</code> (zoom 0-12) pubblicabile su web map e lo carica in QGIS come layer di tile vettoriali, veloce da visualizzare a scala nazionale</li>
+  <li><b>Anticipa in background il download</b>: dopo una breve pausa nella selezione scarica in cache, con banda limitata, l'URL in anteprima; premendo <b>Scarica</b> il file è spesso già disponibile</li>
+  <li><b>Riproietta in</b>: trasforma i confini una sola volta nel sistema di riferimento scelto (es. EPSG:32632, EPSG:6707) e carica la copia riproiettata; la copia resta in cache e viene riusata nelle sessioni successive senza rete né trasformazioni</li>
+  <li><b>Pacchetto completo della data</b>: scarica in parallelo ripartizioni, regioni, UTS e comuni in un solo GeoPackage (<code>ISTAT_pacchetto_&lt;data&gt;.gpkg</code>) con indici e relazioni tra i livelli, caricati nel progetto come un unico gruppo</li>
+  <li><b>Precalcola punti etichetta e centroidi</b>: salva per ogni confine il polo di inaccessibilità (il punto interno più lontano dal bordo) e il centroide come layer puntuali; in GeoPackage e Shapefile aggiunge i campi <code>label_x</code>/<code>label_y</code> e attiva le etichette posizionate su di essi</li>
+  <li><b>Calcola il grafo di adiacenza</b>: salva le unità confinanti come tabelle CSR indicizzate per codice ISTAT (<code>&lt;layer&gt;_adiacenza</code>) ed esporta il file di pesi <code>.gal</code> per le statistiche spaziali</li>
 </ul>
 
+<h3>Layer già caricati</h3>
+<p>Se la combinazione richiesta è già caricata nel progetto, il plugin propone di selezionare il layer esistente o di aggiungerne una copia che ne condivide la sorgente dati, invece di scaricarla di nuovo. Il riconoscimento usa l'URL e l'hash del contenuto salvati nelle proprietà del layer e funziona anche dopo aver salvato e riaperto il progetto.</p>
+
 <h3>URL di Download</h3>
 <p>Mostra l'URL che verrà usato per il download. Clicca l'icona di copia per copiarlo negli appunti.</p>
 
+<h3>Ultima esecuzione</h3>
+<p>Il pulsante <b>Ultima esecuzione</b> mostra i tempi per fase (verifica URL, trasferimento, copia, estrazione, elaborazioni in background, caricamento) e i byte trasferiti dell'ultimo download. Lo storico di tutte le operazioni è nel file <code>metrics.jsonl</code> della cartella <code>istat_boundaries_downloader</code> del profilo QGIS.</p>
+
+<h2>Strumenti</h2>
+<p>Il pulsante <b>Strumenti</b> apre il dialogo con gli strumenti di analisi.</p>
+
+<h3>Confronto date</h3>
+<p>Confronta due date di riferimento per un tipo di confine e produce un GeoPackage con i layer <code>aggiunti</code>, <code>rimossi</code>, <code>attributi_modificati</code> e <code>geometria_modificata</code>. Le date non ancora archiviate vengono scaricate e aggiunte all'archivio locale versionato.</p>
+
+<h3>Join tabella</h3>
+<p>Unisce ai confini di una data una tabella statistica (CSV, XLSX o GeoPackage) tramite la colonna con il codice ISTAT (<code>pro_com</code>, <code>cod_uts</code>, ...). I codici con e senza zeri iniziali vengono riconosciuti come uguali. I campi della tabella sono scritti fisicamente nel GeoPackage di output, più veloce da visualizzare ed esportare di un join virtuale; il layer <code>non_abbinati</code> elenca i codici senza corrispondenza.</p>
+
+<h3>Codici tra date</h3>
+<p>Ricodifica una tabella con i codici ISTAT di una data (es. <code>pro_com</code> del 2011) nei codici di un'altra data. Aggiunge le colonne <code>codice_&lt;data&gt;</code> e <code>corrispondenza</code> (identico, ricodificato, scorporato, soppresso). Le corrispondenze sono ricavate dalle tabelle degli attributi di tutte le date, salvate in cache e riusate senza accedere alla rete.</p>
+
+<h3>Geocodifica punti</h3>
+<p>Assegna a un CSV di coordinate (o a un layer puntuale) i codici <code>pro_com</code>, <code>cod_uts</code>, <code>cod_prov</code>, <code>cod_reg</code> e <code>cod_rip</code> del comune che contiene ogni punto alla data scelta. L'indice spaziale dei comuni è costruito una volta per data e salvato su disco; i punti sono elaborati a blocchi in parallelo. Con il modulo <code>shapely</code> installato la ricerca è molto più veloce.</p>
+
+<h3>Mirror offline</h3>
+<p>Sincronizza in una cartella locale tutte le date, i tipi e i formati delle API (facoltativamente anche i sottoinsiemi per regione e provincia), con manifest e checksum. Le sincronizzazioni successive trasferiscono solo i file nuovi o modificati. La cartella può essere impostata come <b>Sorgente dati</b> (<code>file:///percorso/</code> o server HTTP locale) per usare il plugin senza internet. Il pulsante <b>Aggiorna indice amministrativo</b> ricostruisce l'indice locale di regioni, province e comuni usato dai filtri, che così si aprono subito e funzionano anche senza rete.</p>
+<p>L'opzione <b>Servizio locale dei confini archiviati</b> avvia con il plugin un server HTTP su <code>127.0.0.1</code> che restituisce in GeoJSON le date archiviate, con gli stessi percorsi delle API (es. <code>/20240101/regioni/12/comuni</code>, <code>/20240101/comuni?bbox=12.4,41.8,12.6,42.0</code>). Le richieste sono servite in parallelo, e le risposte restano in una cache in memoria fino alla successiva archiviazione.</p>
+
+<h3>Diagnostica</h3>
+<p>Attiva il watchdog che registra nei messaggi di log ogni blocco dell'interfaccia oltre la soglia scelta (default 100 ms), con la durata e lo stack Python del thread principale. Utile per segnalare le operazioni che bloccano QGIS.</p>
+
 <h2>Compatibilità</h2>
 <div class="tip">Il plugin è compatibile con <b>QGIS 3.20+</b> e <b>QGIS 4.x</b> (Qt6/PyQt6).</div>
 
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - HTTP
+
+ Richieste alle API con compressione negoziata (gzip/deflate e brotli se
+ disponibile) e download in streaming con decompressione al volo.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import base64
+import hashlib
+import os
+import re
+import threading
+import time
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 65536
+ACCEPT_ENCODING = "br, gzip, deflate" if brotli else "gzip, deflate"
+# Download a segmenti: connessioni parallele e dimensione minima di file e segmento
+SEGMENTS = 4
+SEGMENTED_MIN_SIZE = 16 * 1024 * 1024
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+class DownloadCanceled(Exception):
+    """Download interrotto tramite TransferControl"""
+
+
+class SegmentError(Exception):
+    """Download a segmenti non possibile o non verificato: si ripiega sul flusso singolo"""
+
+
+class TransferControl:
+    """Limite di banda (byte/s) e annullamento modificabili durante un download"""
+
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.canceled = False
+
+
+class Decoder:
+    """Decompressione incrementale secondo il Content-Encoding della risposta"""
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "identity").strip().lower()
+        if self.encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.decompressor = None
+        elif self.encoding == "br" and brotli:
+            self.decompressor = brotli.Decompressor()
+        else:
+            self.decompressor = None
+
+    def decode(self, chunk):
+        if self.encoding == "deflate" and self.decompressor is None:
+            # "deflate" può essere zlib (RFC 1950) o deflate grezzo (RFC 1951)
+            raw = len(chunk) < 2 or (chunk[0] & 0x0F) != 8 or ((chunk[0] << 8) | chunk[1]) % 31 != 0
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS if raw else zlib.MAX_WBITS)
+        if self.decompressor is None:
+            return chunk
+        if self.encoding == "br":
+            return self.decompressor.process(chunk)
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        if self.decompressor is not None and self.encoding in ("gzip", "deflate"):
+            return self.decompressor.flush()
+        return b""
+
+
+def open_url(url, method=None, headers=None, timeout=60):
+    """Apre url chiedendo la compressione della risposta"""
+    request = urllib.request.Request(url, method=method)
+    request.add_header("Accept-Encoding", ACCEPT_ENCODING)
+    for name, value in (headers or {}).items():
+        request.add_header(name, value)
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def iter_content(response, stats=None, control=None):
+    """Legge la risposta a blocchi restituendo i dati già decompressi
+
+    stats, se indicato, riceve i byte trasferiti in rete ("wire_bytes") e la codifica;
+    control (TransferControl) limita la banda e permette di annullare il download.
+    """
+    decoder = Decoder(response.headers.get("Content-Encoding"))
+    if stats is not None:
+        stats["encoding"] = decoder.encoding
+        stats.setdefault("wire_bytes", 0)
+    start = time.monotonic()
+    received = 0
+    while True:
+        if control is not None and control.canceled:
+            raise DownloadCanceled(response.geturl())
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+        if stats is not None:
+            stats["wire_bytes"] += len(chunk)
+        if control is not None and control.max_rate:
+            delay = received / control.max_rate - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        data = decoder.decode(chunk)
+        if data:
+            yield data
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+
+def range_info(headers):
+    """Dimensione, validatore e checksum dichiarati se il server accetta richieste Range
+
+    Restituisce None se le intestazioni non dichiarano "Accept-Ranges: bytes" o la dimensione.
+    """
+    length = headers.get("Content-Length")
+    if headers.get("Accept-Ranges", "").lower() != "bytes" or not length or headers.get("Content-Encoding"):
+        return None
+    return {
+        "length": int(length),
+        "validator": headers.get("ETag") or headers.get("Last-Modified"),
+        "checksum": declared_checksum(headers),
+    }
+
+
+def probe_ranges(url):
+    """range_info() di una richiesta HEAD senza compressione a url"""
+    with open_url(url, method="HEAD", headers={"Accept-Encoding": "identity"}) as response:
+        return range_info(response.headers)
+
+
+def declared_checksum(headers):
+    """Checksum (algoritmo, digest) dichiarato dal server in Digest/Repr-Digest o Content-MD5"""
+    for name in ("Repr-Digest", "Digest"):
+        for item in (headers.get(name) or "").split(","):
+            algorithm, _, value = item.strip().partition("=")
+            algorithm = algorithm.strip().lower().replace("-", "")
+            if algorithm in ("sha256", "sha512", "md5") and value:
+                return algorithm, base64.b64decode(value.strip(":"))
+    if headers.get("Content-MD5"):
+        return "md5", base64.b64decode(headers["Content-MD5"])
+    return None
+
+
+def file_digest(path, algorithm):
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            hasher.update(chunk)
+    return hasher.digest()
+
+
+def fetch_segment(url, dest_path, start, end, validator, stats, control, lock, abort, parallel):
+    """Scarica i byte start-end (inclusi) di url nella stessa posizione di dest_path
+
+    abort (threading.Event) interrompe il segmento quando un altro non è riuscito;
+    il limite di banda di control è diviso tra i parallel segmenti.
+    """
+    headers = {"Accept-Encoding": "identity", "Range": f"bytes={start}-{end}"}
+    if validator:
+        # Se il file cambia durante il download il server risponde 200 e non 206
+        headers["If-Range"] = validator
+    with open_url(url, headers=headers) as response, open(dest_path, "r+b") as f:
+        content_range = re.match(r"bytes (\d+)-(\d+)/", response.headers.get("Content-Range", ""))
+        if response.status != 206 or content_range is None or \
+                (int(content_range.group(1)), int(content_range.group(2))) != (start, end):
+            raise SegmentError(f"Risposta non valida per il segmento {start}-{end}")
+        f.seek(start)
+        segment_started = time.monotonic()
+        received = 0
+        while True:
+            if control is not None and control.canceled:
+                raise DownloadCanceled(url)
+            if abort.is_set():
+                raise SegmentError(f"Segmento {start}-{end} interrotto")
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > end - start + 1:
+                raise SegmentError(f"Il segmento {start}-{end} supera la dimensione attesa")
+            f.write(chunk)
+            if stats is not None:
+                with lock:
+                    stats["wire_bytes"] += len(chunk)
+            if control is not None and control.max_rate:
+                delay = received * parallel / control.max_rate - (time.monotonic() - segment_started)
+                if delay > 0:
+                    time.sleep(delay)
+    if received != end - start + 1:
+        raise SegmentError(f"Segmento {start}-{end} incompleto: {received} byte")
+    return received
+
+
+def download_segmented(url, dest_path, info, segments=SEGMENTS, stats=None, control=None):
+    """Scarica url in dest_path con richieste Range parallele su un file preallocato
+
+    Verifica dimensione finale e, se dichiarato dal server, il checksum;
+    solleva SegmentError se il risultato non è affidabile.
+    """
+    length = info["length"]
+    count = max(1, min(segments, length // MIN_SEGMENT_SIZE))
+    size = -(-length // count)
+    ranges = [(start, min(start + size, length) - 1) for start in range(0, length, size)]
+    if stats is not None:
+        stats["segments"] = len(ranges)
+        stats.setdefault("wire_bytes", 0)
+        stats["encoding"] = "identity"
+    with open(dest_path, "wb") as f:
+        f.truncate(length)
+    lock = threading.Lock()
+    abort = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+        futures = [pool.submit(fetch_segment, url, dest_path, start, end, info.get("validator"), stats, control,
+                               lock, abort, len(ranges))
+                   for start, end in ranges]
+        try:
+            written = sum(future.result() for future in futures)
+        except BaseException:
+            # Interrompe gli altri segmenti prima di propagare l'errore
+            abort.set()
+            raise
+    if written != length or os.path.getsize(dest_path) != length:
+        raise SegmentError(f"Dimensione finale {os.path.getsize(dest_path)} diversa da quella attesa {length}")
+    if info.get("checksum"):
+        algorithm, expected = info["checksum"]
+        if file_digest(dest_path, algorithm) != expected:
+            raise SegmentError(f"Checksum {algorithm} del file riassemblato non corrispondente")
+        if stats is not None:
+            stats["checksum"] = algorithm
+    return written
+
+
+def download(url, dest_path, on_chunk=None, stats=None, control=None, segments=1, head=None):
+    """Scarica url in dest_path a blocchi e restituisce il numero di byte scritti
+
+    on_chunk, se indicata, riceve ogni blocco scritto (già decompresso).
+    Con segments > 1 i file grandi di server che accettano richieste Range sono
+    scaricati a segmenti paralleli; altrimenti, o se un segmento non è valido,
+    si usa un flusso singolo. head sono le intestazioni di una richiesta HEAD
+    senza compressione già fatta a url (es. per verificarne l'esistenza), che
+    evitano di ripeterla.
+    """
+    if segments > 1:
+        try:
+            info = range_info(head) if head is not None else probe_ranges(url)
+        except (OSError, ValueError):
+            info = None
+        if info is not None and info["length"] >= SEGMENTED_MIN_SIZE:
+            try:
+                written = download_segmented(url, dest_path, info, segments, stats, control)
+            except (SegmentError, OSError, ValueError) as e:
+                if stats is not None:
+                    stats["segments"] = 1
+                    stats["fallback"] = str(e)
+                    # Si contano solo i byte del flusso singolo che sostituisce i segmenti
+                    stats["wire_bytes"] = 0
+            else:
+                if on_chunk:
+                    with open(dest_path, "rb") as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                            on_chunk(chunk)
+                return written
+
+    written = 0
+    with open_url(url) as response, open(dest_path, "wb") as f:
+        for chunk in iter_content(response, stats, control):
+            f.write(chunk)
+            written += len(chunk)
+            if on_chunk:
+                on_chunk(chunk)
+    return written
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Indexes
+
+ Creazione degli indici spaziali e degli indici sugli attributi per i
+ file scaricati (Shapefile e GeoPackage).
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from osgeo import ogr
+
+# Campi codice ISTAT usati per join e filtri
+CODE_FIELDS = ("cod_rip", "cod_reg", "cod_uts", "cod_prov", "cod_cm", "pro_com", "pro_com_t")
+
+
+def code_fields(layer):
+    """Restituisce i nomi dei campi codice ISTAT presenti nel layer"""
+    layer_defn = layer.GetLayerDefn()
+    names = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+    return [name for name in names if name.lower() in CODE_FIELDS]
+
+
+def query_scalar(ds, sql):
+    """Esegue una query SQL e restituisce il primo valore del risultato"""
+    result = ds.ExecuteSQL(sql)
+    if result is None:
+        return None
+    try:
+        feature = result.GetNextFeature()
+        return feature.GetField(0) if feature is not None else None
+    finally:
+        ds.ReleaseResultSet(result)
+
+
+def index_shapefiles(ds):
+    """Crea i file .qix e gli indici attributi per gli shapefile del datasource"""
+    created = []
+    for i in range(ds.GetLayerCount()):
+        layer = ds.GetLayer(i)
+        name = layer.GetName()
+        if layer.GetGeomType() != ogr.wkbNone:
+            ds.ExecuteSQL(f'CREATE SPATIAL INDEX ON "{name}"')
+            created.append(f"{name}: spaziale")
+        for field in code_fields(layer):
+            ds.ExecuteSQL(f'CREATE INDEX ON "{name}" USING "{field}"')
+            created.append(f"{name}.{field}")
+    return created
+
+
+def index_geopackage(ds):
+    """Verifica l'R-tree e crea gli indici attributi per i layer del GeoPackage"""
+    created = []
+    for i in range(ds.GetLayerCount()):
+        layer = ds.GetLayer(i)
+        name = layer.GetName()
+        geom_column = layer.GetGeometryColumn()
+        if geom_column and not query_scalar(ds, f"SELECT HasSpatialIndex('{name}', '{geom_column}')"):
+            query_scalar(ds, f"SELECT CreateSpatialIndex('{name}', '{geom_column}')")
+            created.append(f"{name}: R-tree")
+        for field in code_fields(layer):
+            ds.ExecuteSQL(f'CREATE INDEX IF NOT EXISTS "idx_{name}_{field}" ON "{name}" ("{field}")')
+            created.append(f"{name}.{field}")
+    return created
+
+
+def build_indexes(path):
+    """Crea gli indici spaziali e sugli attributi per il file o la cartella indicati
+
+    Restituisce l'elenco degli indici creati.
+    """
+    ds = ogr.Open(path, 1)
+    if ds is None:
+        raise IOError(f"Impossibile aprire {path} in scrittura per creare gli indici")
+
+    try:
+        driver_name = ds.GetDriver().GetName()
+        if driver_name == "ESRI Shapefile":
+            return index_shapefiles(ds)
+        if driver_name == "GPKG":
+            return index_geopackage(ds)
+        return []
+    finally:
+        ds = None
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Join
+
+ Join fisico di tabelle statistiche (CSV, XLSX, GeoPackage) sui confini
+ tramite codice ISTAT, con indice hash sulla chiave e report dei codici
+ non abbinati.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+
+from osgeo import gdal, ogr
+
+from .istat_boundaries_downloader_store import META_FIELDS
+
+JOIN_LAYER = "confini"
+UNMATCHED_LAYER = "non_abbinati"
+# Prefisso dei campi della tabella che hanno lo stesso nome di un campo dei confini
+COLLISION_PREFIX = "t_"
+
+
+def normalize_code(value):
+    """Forma canonica di un codice ISTAT: "001001", "1001" e 1001.0 coincidono"""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    if text.isdigit():
+        return text.lstrip("0") or "0"
+    return text or None
+
+
+def open_table(path):
+    """Apre una tabella CSV, XLSX o GeoPackage con OGR"""
+    options = ["AUTODETECT_TYPE=YES"] if path.lower().endswith(".csv") else []
+    ds = gdal.OpenEx(path, gdal.OF_VECTOR, open_options=options)
+    if ds is None:
+        raise IOError(f"Impossibile aprire la tabella {path}")
+    return ds
+
+
+def table_layers(path):
+    """Nomi dei layer (fogli per gli XLSX) della tabella"""
+    ds = open_table(path)
+    return [ds.GetLayer(i).GetName() for i in range(ds.GetLayerCount())]
+
+
+def table_fields(path, layer_name=None):
+    """Nomi dei campi di un layer della tabella"""
+    ds = open_table(path)
+    layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+    defn = layer.GetLayerDefn()
+    return [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+
+def build_key_index(layer, key_field):
+    """Indice hash codice normalizzato -> feature; a parità di codice vale la prima riga
+
+    Restituisce l'indice e l'elenco dei codici duplicati.
+    """
+    key_index = layer.GetLayerDefn().GetFieldIndex(key_field)
+    if key_index < 0:
+        raise ValueError(f"Campo chiave {key_field} non trovato nella tabella")
+    index = {}
+    duplicates = []
+    for feature in layer:
+        code = normalize_code(feature.GetField(key_index))
+        if code is None:
+            continue
+        if code in index:
+            duplicates.append(code)
+        else:
+            index[code] = feature
+    return index, duplicates
+
+
+def join_table(src_path, src_layer_name, src_key, table_path, table_layer_name, table_key, out_path):
+    """Scrive in out_path i confini con i campi della tabella abbinati per codice
+
+    I campi sono copiati in blocco con SetFromWithMap; il layer "non_abbinati"
+    elenca i codici della tabella senza confine e i confini senza dati.
+    Restituisce i conteggi dell'abbinamento.
+    """
+    src_ds = ogr.Open(src_path)
+    if src_ds is None:
+        raise IOError(f"Impossibile aprire {src_path}")
+    src = src_ds.GetLayerByName(src_layer_name) if src_layer_name else src_ds.GetLayer(0)
+    src_key_index = src.GetLayerDefn().GetFieldIndex(src_key)
+    if src_key_index < 0:
+        raise ValueError(f"Campo codice {src_key} non trovato nei confini")
+
+    table_ds = open_table(table_path)
+    table = table_ds.GetLayerByName(table_layer_name) if table_layer_name else table_ds.GetLayer(0)
+    index, duplicates = build_key_index(table, table_key)
+
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(out_path):
+        driver.DeleteDataSource(out_path)
+    out_ds = driver.CreateDataSource(out_path)
+    out = out_ds.CreateLayer(JOIN_LAYER, src.GetSpatialRef(), src.GetGeomType())
+
+    # Mappe campo sorgente -> campo di output (-1 = non copiato)
+    names = set()
+    src_defn = src.GetLayerDefn()
+    src_map = []
+    for i in range(src_defn.GetFieldCount()):
+        field_defn = src_defn.GetFieldDefn(i)
+        if field_defn.GetName() in META_FIELDS:
+            src_map.append(-1)
+            continue
+        out.CreateField(field_defn)
+        names.add(field_defn.GetName().lower())
+        src_map.append(out.GetLayerDefn().GetFieldCount() - 1)
+    table_defn = table.GetLayerDefn()
+    table_map = []
+    for i in range(table_defn.GetFieldCount()):
+        field_defn = table_defn.GetFieldDefn(i)
+        if field_defn.GetName() == table_key:
+            table_map.append(-1)
+            continue
+        if field_defn.GetName().lower() in names:
+            field_defn = ogr.FieldDefn(COLLISION_PREFIX + field_defn.GetName(), field_defn.GetType())
+        out.CreateField(field_defn)
+        names.add(field_defn.GetName().lower())
+        table_map.append(out.GetLayerDefn().GetFieldCount() - 1)
+
+    out_defn = out.GetLayerDefn()
+    matched = set()
+    missing = []
+    out_ds.StartTransaction()
+    for feature in src:
+        out_feature = ogr.Feature(out_defn)
+        code = normalize_code(feature.GetField(src_key_index))
+        row = index.get(code)
+        if row is not None:
+            # Prima la tabella: SetFrom copia anche la geometria (vuota)
+            out_feature.SetFromWithMap(row, True, table_map)
+            matched.add(code)
+        else:
+            missing.append(code)
+        out_feature.SetFromWithMap(feature, True, src_map)
+        out.CreateFeature(out_feature)
+
+    unmatched = sorted(code for code in index if code not in matched)
+    report = out_ds.CreateLayer(UNMATCHED_LAYER, None, ogr.wkbNone)
+    report.CreateField(ogr.FieldDefn("codice", ogr.OFTString))
+    report.CreateField(ogr.FieldDefn("origine", ogr.OFTString))
+    for origin, codes in (("tabella", unmatched), ("confini", missing)):
+        for code in codes:
+            report_feature = ogr.Feature(report.GetLayerDefn())
+            report_feature.SetField("codice", code)
+            report_feature.SetField("origine", origin)
+            report.CreateFeature(report_feature)
+    out_ds.CommitTransaction()
+    out_ds = None
+
+    return {
+        "abbinati": len(matched),
+        "confini_senza_dati": len(missing),
+        "codici_non_abbinati": len(unmatched),
+        "codici_duplicati": len(duplicates),
+    }
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - KML
+
+ Conversione in streaming di KML/KMZ in un layer GeoPackage: il KML viene
+ analizzato a blocchi man mano che arriva e le feature sono scritte a lotti,
+ con memoria limitata indipendentemente dalla dimensione del file.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import hashlib
+import os
+import zipfile
+from xml.etree import ElementTree
+
+from osgeo import ogr, osr
+
+from .istat_boundaries_downloader_http import CHUNK_SIZE, download
+
+BATCH_SIZE = 1000
+FIELD_TYPES = {
+    "int": ogr.OFTInteger,
+    "uint": ogr.OFTInteger,
+    "short": ogr.OFTInteger,
+    "ushort": ogr.OFTInteger,
+    "float": ogr.OFTReal,
+    "double": ogr.OFTReal,
+}
+
+
+def local_name(tag):
+    """Nome dell'elemento senza namespace"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def ring_wkt(coordinates):
+    """Anello WKT dalle coordinate KML "lon,lat[,alt] ..." """
+    points = []
+    for token in coordinates.split():
+        parts = token.split(",")
+        points.append(f"{parts[0]} {parts[1]}")
+    return f"({', '.join(points)})"
+
+
+def placemark_geometry(placemark):
+    """MultiPolygon OGR dai Polygon di un Placemark, o None se non poligonale"""
+    polygons = []
+    for polygon in placemark.iter():
+        if local_name(polygon.tag) != "Polygon":
+            continue
+        rings = []
+        for boundary in polygon:
+            boundary_name = local_name(boundary.tag)
+            if boundary_name not in ("outerBoundaryIs", "innerBoundaryIs"):
+                continue
+            for coordinates in boundary.iter():
+                if local_name(coordinates.tag) == "coordinates" and coordinates.text:
+                    ring = ring_wkt(coordinates.text)
+                    if boundary_name == "outerBoundaryIs":
+                        rings.insert(0, ring)
+                    else:
+                        rings.append(ring)
+        if rings:
+            polygons.append(f"({', '.join(rings)})")
+    if not polygons:
+        return None
+    return ogr.CreateGeometryFromWkt(f"MULTIPOLYGON ({', '.join(polygons)})")
+
+
+def placemark_attributes(placemark):
+    """Attributi di un Placemark: name, SimpleData ed ExtendedData/Data"""
+    values = {}
+    for element in placemark.iter():
+        tag = local_name(element.tag)
+        if tag == "name" and element.text:
+            values.setdefault("name", element.text.strip())
+        elif tag == "SimpleData" and element.get("name"):
+            values[element.get("name")] = element.text
+        elif tag == "Data" and element.get("name"):
+            value = next((child.text for child in element if local_name(child.tag) == "value"), None)
+            values[element.get("name")] = value
+    return values
+
+
+class KmlToGeoPackage:
+    """Analizzatore KML incrementale che scrive le feature in un layer GeoPackage
+
+    feed() accetta i blocchi del KML (es. come on_chunk di download());
+    close() completa la scrittura e restituisce i conteggi.
+    """
+
+    def __init__(self, out_path, layer_name, batch_size=BATCH_SIZE):
+        self.out_path = out_path
+        self.layer_name = layer_name
+        self.batch_size = batch_size
+        self.parser = ElementTree.XMLPullParser(events=("start", "end"))
+        self.stack = []
+        self.schema = {}
+        self.ds = None
+        self.layer = None
+        self.fields = set()
+        self.pending = 0
+        self.count = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        self.parser.feed(data)
+        self.process_events()
+
+    def close(self):
+        self.parser.close()
+        self.process_events()
+        if self.layer is None:
+            self.create_layer()
+        self.ds.CommitTransaction()
+        self.ds = None
+        return {"feature": self.count, "scartate": self.skipped}
+
+    def abort(self):
+        """Annulla la conversione eliminando il GeoPackage parziale"""
+        if self.ds is not None:
+            self.ds.RollbackTransaction()
+            self.ds = None
+        self.layer = None
+        if os.path.exists(self.out_path):
+            ogr.GetDriverByName("GPKG").DeleteDataSource(self.out_path)
+
+    def process_events(self):
+        for event, element in self.parser.read_events():
+            if event == "start":
+                self.stack.append(element)
+                continue
+            self.stack.pop()
+            tag = local_name(element.tag)
+            if tag == "Schema":
+                for field in element:
+                    if local_name(field.tag) == "SimpleField" and field.get("name"):
+                        self.schema[field.get("name")] = FIELD_TYPES.get(field.get("type"), ogr.OFTString)
+            elif tag == "Placemark":
+                self.write_placemark(element)
+            else:
+                continue
+            # Libera l'elemento elaborato: in memoria resta solo il Placemark corrente
+            element.clear()
+            if self.stack:
+                self.stack[-1].remove(element)
+
+    def create_layer(self, attributes=()):
+        driver = ogr.GetDriverByName("GPKG")
+        if os.path.exists(self.out_path):
+            driver.DeleteDataSource(self.out_path)
+        self.ds = driver.CreateDataSource(self.out_path)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.layer = self.ds.CreateLayer(self.layer_name, srs, ogr.wkbMultiPolygon)
+        for name, field_type in self.schema.items():
+            self.add_field(name, field_type)
+        for name in attributes:
+            self.add_field(name)
+        self.ds.StartTransaction()
+
+    def add_field(self, name, field_type=ogr.OFTString):
+        if name not in self.fields:
+            self.layer.CreateField(ogr.FieldDefn(name, field_type))
+            self.fields.add(name)
+
+    def write_placemark(self, placemark):
+        geometry = placemark_geometry(placemark)
+        if geometry is None:
+            self.skipped += 1
+            return
+        attributes = placemark_attributes(placemark)
+        if self.layer is None:
+            self.create_layer(attributes)
+        for name in attributes:
+            self.add_field(name)
+        feature = ogr.Feature(self.layer.GetLayerDefn())
+        for name, value in attributes.items():
+            if value not in (None, ""):
+                feature.SetField(name, value)
+        feature.SetGeometry(geometry)
+        self.layer.CreateFeature(feature)
+        self.count += 1
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.ds.CommitTransaction()
+            self.ds.StartTransaction()
+            self.pending = 0
+
+
+def download_kml(url, dest_path, out_path, layer_name, control=None):
+    """Scarica un KML in dest_path convertendolo in out_path durante il trasferimento
+
+    Il trasferimento è sequenziale perché la conversione avanzi con i dati
+    ricevuti; in caso di errore il GeoPackage parziale viene eliminato.
+    Restituisce i conteggi della conversione, i byte e lo SHA-1 del KML.
+    """
+    ingest = KmlToGeoPackage(out_path, layer_name)
+    hasher = hashlib.sha1()
+
+    def on_chunk(chunk):
+        hasher.update(chunk)
+        ingest.feed(chunk)
+
+    try:
+        size = download(url, dest_path, on_chunk=on_chunk, control=control)
+        counts = ingest.close()
+    except BaseException:
+        ingest.abort()
+        raise
+    return dict(counts, bytes=size, hash=hasher.hexdigest())
+
+
+def ingest_kml_file(path, out_path, layer_name):
+    """Converte un file KML o KMZ già scaricato leggendolo a blocchi"""
+    ingest = KmlToGeoPackage(out_path, layer_name)
+    try:
+        return read_kml_file(path, ingest)
+    except BaseException:
+        ingest.abort()
+        raise
+
+
+def read_kml_file(path, ingest):
+    """Passa a ingest il contenuto del KML, o del KML nel KMZ, in path"""
+    if path.lower().endswith(".kmz"):
+        with zipfile.ZipFile(path) as kmz:
+            member = next((name for name in kmz.namelist() if name.lower().endswith(".kml")), None)
+            if member is None:
+                raise ValueError("Nessun file KML nell'archivio KMZ")
+            with kmz.open(member) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    ingest.feed(chunk)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                ingest.feed(chunk)
+    return ingest.close()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Labels
+
+ Punti etichetta precalcolati: polo di inaccessibilità (il punto interno
+ più lontano dal bordo) e centroide di ogni confine, scritti come layer
+ puntuali e come campi label_x/label_y per il posizionamento delle etichette.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import ogr
+
+from .istat_boundaries_downloader_crosswalk import NAME_FIELDS
+from .istat_boundaries_downloader_indexes import code_fields
+
+try:
+    import numpy as np
+    import shapely
+except ImportError:
+    shapely = None
+
+LABEL_LAYER = "punti_etichetta"
+CENTROID_LAYER = "centroidi"
+LABEL_FIELDS = ("label_x", "label_y")
+CHUNK_SIZE = 1000
+# Precisione del polo di inaccessibilità rispetto al lato maggiore dell'inviluppo
+POLE_PRECISION = 0.001
+
+
+def largest_polygon(geom):
+    """Parte più estesa di un multipoligono shapely"""
+    if geom.geom_type == "MultiPolygon":
+        return max(geom.geoms, key=lambda part: part.area)
+    return geom
+
+
+def label_points(wkbs):
+    """Poli di inaccessibilità e centroidi [(x, y), ...] delle geometrie WKB
+
+    Con shapely >= 2.1 il polo è il centro del massimo cerchio inscritto,
+    calcolato in blocco; con shapely 2.0 si usa polylabel sulla parte più
+    estesa; senza shapely il punto interno di OGR (PointOnSurface).
+    """
+    if shapely is not None:
+        geoms = shapely.from_wkb(wkbs)
+        centroids = shapely.get_coordinates(shapely.centroid(geoms))
+        bounds = shapely.bounds(geoms)
+        tolerance = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]) * POLE_PRECISION
+        if hasattr(shapely, "maximum_inscribed_circle"):
+            poles = shapely.get_point(shapely.maximum_inscribed_circle(geoms, tolerance), 0)
+        else:
+            from shapely.ops import polylabel
+            poles = [polylabel(largest_polygon(geom), tolerance=float(t)) for geom, t in zip(geoms, tolerance)]
+        return [tuple(p) for p in shapely.get_coordinates(poles)], [tuple(c) for c in centroids]
+
+    poles, centroids = [], []
+    for wkb in wkbs:
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        pole, centroid = geom.PointOnSurface(), geom.Centroid()
+        poles.append((pole.GetX(), pole.GetY()))
+        centroids.append((centroid.GetX(), centroid.GetY()))
+    return poles, centroids
+
+
+def write_point_layer(ds, name, srs, src_defn, fields, rows, points):
+    """Crea (sostituendolo) un layer puntuale con fid di origine, codici e nome"""
+    for i in range(ds.GetLayerCount()):
+        if ds.GetLayer(i).GetName() == name:
+            ds.DeleteLayer(i)
+            break
+    layer = ds.CreateLayer(name, srs, ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn("src_fid", ogr.OFTInteger64))
+    for field in fields:
+        layer.CreateField(src_defn.GetFieldDefn(src_defn.GetFieldIndex(field)))
+    defn = layer.GetLayerDefn()
+    for (fid, values), (x, y) in zip(rows, points):
+        feature = ogr.Feature(defn)
+        feature.SetField("src_fid", fid)
+        for field, value in zip(fields, values):
+            if value is not None:
+                feature.SetField(field, value)
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        feature.SetGeometry(point)
+        layer.CreateFeature(feature)
+
+
+def compute_label_points(src_uri, points_path=None, workers=None):
+    """Calcola i punti etichetta del layer src_uri
+
+    I layer puntuali "<layer>_punti_etichetta" e "<layer>_centroidi" sono scritti
+    nello stesso GeoPackage della sorgente o, per gli altri formati, in points_path.
+    Se la sorgente è modificabile (GeoPackage, Shapefile) riceve anche i campi
+    label_x/label_y usati per il posizionamento delle etichette.
+    """
+    path, _, layer_name = src_uri.partition("|layername=")
+    ds = ogr.Open(path, 1)
+    updatable = ds is not None
+    if ds is None:
+        ds = ogr.Open(path)
+    if ds is None:
+        raise IOError(f"Impossibile leggere {path}")
+    layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+    defn = layer.GetLayerDefn()
+    fields = code_fields(layer) + [name for name in NAME_FIELDS if defn.GetFieldIndex(name) >= 0][:1]
+
+    rows, wkbs = [], []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None or geom.IsEmpty():
+            continue
+        rows.append((feature.GetFID(), [feature.GetField(field) for field in fields]))
+        wkbs.append(bytes(geom.ExportToIsoWkb()))
+
+    chunks = [wkbs[i:i + CHUNK_SIZE] for i in range(0, len(wkbs), CHUNK_SIZE)]
+    poles, centroids = [], []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for chunk_poles, chunk_centroids in pool.map(label_points, chunks):
+            poles += chunk_poles
+            centroids += chunk_centroids
+
+    same_file = updatable and ds.GetDriver().GetName() == "GPKG"
+    if same_file:
+        out_ds = ds
+    else:
+        points_path = points_path or f"{os.path.splitext(path)[0]}_etichette.gpkg"
+        driver = ogr.GetDriverByName("GPKG")
+        out_ds = driver.Open(points_path, 1) if os.path.exists(points_path) else driver.CreateDataSource(points_path)
+    srs = layer.GetSpatialRef()
+    transactions = out_ds.TestCapability(ogr.ODsCTransactions)
+    if transactions:
+        out_ds.StartTransaction()
+    write_point_layer(out_ds, f"{layer.GetName()}_{LABEL_LAYER}", srs, defn, fields, rows, poles)
+    write_point_layer(out_ds, f"{layer.GetName()}_{CENTROID_LAYER}", srs, defn, fields, rows, centroids)
+    if transactions:
+        out_ds.CommitTransaction()
+    if not same_file:
+        out_ds = None
+
+    label_fields = updatable and layer.TestCapability(ogr.OLCCreateField) and layer.TestCapability(ogr.OLCRandomWrite)
+    if label_fields:
+        for name in LABEL_FIELDS:
+            if defn.GetFieldIndex(name) < 0:
+                layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+        if ds.TestCapability(ogr.ODsCTransactions):
+            ds.StartTransaction()
+        for (fid, _), (x, y) in zip(rows, poles):
+            feature = layer.GetFeature(fid)
+            feature.SetField(LABEL_FIELDS[0], x)
+            feature.SetField(LABEL_FIELDS[1], y)
+            layer.SetFeature(feature)
+        if ds.TestCapability(ogr.ODsCTransactions):
+            ds.CommitTransaction()
+    ds = None
+    return {"feature": len(rows), "campi": bool(label_fields), "percorso": path if same_file else points_path}
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Layers
+
+ Registrazione dei layer nel progetto in blocco, in gruppi per data e tipo
+ di confine, con il rendering della mappa sospeso durante l'inserimento.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.PyQt.QtCore import QObject, QTimer
+from qgis.core import QgsLayerTree, QgsPalLayerSettings, QgsProject, QgsProperty, QgsVectorLayerSimpleLabeling
+
+# Prefisso delle proprietà personalizzate salvate nel progetto con i layer del plugin
+PROPERTY_PREFIX = "istat_boundaries_downloader"
+
+
+def tag_layer(layer, **values):
+    """Registra nelle proprietà personalizzate del layer URL, hash, data e tipo"""
+    for key, value in values.items():
+        if value is not None:
+            layer.setCustomProperty(f"{PROPERTY_PREFIX}/{key}", value)
+
+
+def layer_tag(layer, key):
+    return layer.customProperty(f"{PROPERTY_PREFIX}/{key}")
+
+
+def find_layers(key, value):
+    """Layer del progetto caricati dal plugin con la proprietà key uguale a value"""
+    return [layer for layer in QgsProject.instance().mapLayers().values()
+            if layer_tag(layer, key) == value]
+
+
+def date_group_name(date_str):
+    """Nome del gruppo di una data di riferimento (es. "ISTAT 2026-01-01")"""
+    return f"ISTAT {date_str[:4]}-{date_str[4:6]}-{date_str[6:]}"
+
+
+def configure_label_placement(layer, text_fields, position_fields):
+    """Etichette sul primo campo di text_fields, posizionate sui campi (x, y) precalcolati
+
+    Restituisce False se il layer non ha i campi necessari.
+    """
+    names = layer.fields().names()
+    text_field = next((name for name in text_fields if name in names), None)
+    if text_field is None or not all(name in names for name in position_fields):
+        return False
+    settings = QgsPalLayerSettings()
+    settings.fieldName = text_field
+    properties = settings.dataDefinedProperties()
+    properties.setProperty(QgsPalLayerSettings.Property.PositionX, QgsProperty.fromField(position_fields[0]))
+    properties.setProperty(QgsPalLayerSettings.Property.PositionY, QgsProperty.fromField(position_fields[1]))
+    settings.setDataDefinedProperties(properties)
+    layer.setLabeling(QgsVectorLayerSimpleLabeling(settings))
+    layer.setLabelsEnabled(True)
+    return True
+
+
+def child_group(parent, name):
+    """Gruppo figlio diretto di parent con il nome indicato, creato se manca"""
+    for child in parent.children():
+        if QgsLayerTree.isGroup(child) and child.name() == name:
+            return child
+    return parent.insertGroup(0, name)
+
+
+class LayerLoader(QObject):
+    """Raccoglie i layer da caricare e li registra con una sola addMapLayers
+
+    I layer aggiunti nello stesso giro del ciclo di eventi vengono registrati
+    insieme; flush() forza la registrazione immediata.
+    """
+
+    def __init__(self, iface=None, parent=None):
+        super().__init__(parent)
+        self.iface = iface
+        self.pending = []
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(0)
+        self.timer.timeout.connect(self.flush)
+
+    def add(self, layer, group_path=()):
+        """Accoda layer da inserire nel gruppo group_path (tupla di nomi annidati)"""
+        self.pending.append((layer, tuple(group_path)))
+        self.timer.start()
+
+    def focus(self, layer):
+        """Rende visibile e seleziona un layer già presente nel progetto"""
+        node = QgsProject.instance().layerTreeRoot().findLayer(layer.id())
+        if node is not None:
+            node.setItemVisibilityChecked(True)
+        if self.iface is not None:
+            self.iface.setActiveLayer(layer)
+
+    def flush(self):
+        """Registra i layer in attesa e restituisce quelli aggiunti al progetto"""
+        self.timer.stop()
+        if not self.pending:
+            return []
+        pending, self.pending = self.pending, []
+        project = QgsProject.instance()
+        canvas = self.iface.mapCanvas() if self.iface else None
+        if canvas is not None:
+            canvas.freeze(True)
+        try:
+            added = project.addMapLayers([layer for layer, _ in pending], False)
+            root = project.layerTreeRoot()
+            groups = {}
+            for layer, group_path in pending:
+                if layer not in added:
+                    continue
+                if group_path not in groups:
+                    node = root
+                    for name in group_path:
+                        node = child_group(node, name)
+                    groups[group_path] = node
+                groups[group_path].insertLayer(0, layer)
+        finally:
+            if canvas is not None:
+                canvas.freeze(False)
+                canvas.refresh()
+        return added
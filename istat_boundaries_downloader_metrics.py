@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Metrics
+
+ Misura dei tempi per fase e dei byte trasferiti per ogni operazione.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from qgis.core import QgsMessageLog, Qgis
+
+
+class OperationMetrics:
+    """Tempi per fase (orologio monotono) e byte di una operazione"""
+
+    def __init__(self, operation, url=None):
+        self.operation = operation
+        self.url = url
+        self.timestamp = datetime.now().isoformat(timespec="seconds")
+        self.phases = []
+        self.outcome = None
+        self.total = None
+        self._start = time.monotonic()
+
+    @contextmanager
+    def phase(self, name):
+        """Misura il tempo del blocco; il dizionario restituito accetta il numero di byte"""
+        entry = {"name": name, "seconds": 0.0, "bytes": 0}
+        start = time.monotonic()
+        try:
+            yield entry
+        finally:
+            entry["seconds"] = time.monotonic() - start
+            self.phases.append(entry)
+
+    def add_phase(self, name, seconds, nbytes=0):
+        """Aggiunge una fase misurata altrove (es. nel task in background)"""
+        self.phases.append({"name": name, "seconds": seconds, "bytes": nbytes})
+
+    def finish(self, outcome):
+        """Chiude la misura con l'esito dell'operazione"""
+        self.outcome = outcome
+        self.total = time.monotonic() - self._start
+
+    def to_dict(self):
+        return {
+            "timestamp": self.timestamp,
+            "operation": self.operation,
+            "url": self.url,
+            "outcome": self.outcome,
+            "total_seconds": self.total,
+            "phases": self.phases,
+        }
+
+    def summary(self):
+        """Riepilogo testuale delle fasi"""
+        lines = [f"{self.operation}: {self.outcome or 'in corso'}"]
+        if self.url:
+            lines.append(self.url)
+        for entry in self.phases:
+            line = f"  {entry['name']:<24}{entry['seconds']:>8.3f} s"
+            if entry["bytes"]:
+                line += f"  {entry['bytes'] / 1048576:.2f} MB"
+                if entry["seconds"] > 0:
+                    line += f" ({entry['bytes'] / 1048576 / entry['seconds']:.2f} MB/s)"
+                if entry.get("encoding") not in (None, "identity"):
+                    line += f", {entry['wire_bytes'] / 1048576:.2f} MB in rete ({entry['encoding']})"
+            lines.append(line)
+        if self.total is not None:
+            lines.append(f"  {'totale':<24}{self.total:>8.3f} s")
+        return "\n".join(lines)
+
+    def log(self):
+        """Scrive il riepilogo nella scheda "ISTAT Downloader" dei messaggi di log"""
+        QgsMessageLog.logMessage(self.summary(), "ISTAT Downloader", Qgis.MessageLevel.Info)
+
+    def append_to(self, path):
+        """Aggiunge la misura come riga JSON al file delle metriche"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_dict(), ensure_ascii=False) + "\n")
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Mirror
+
+ Sincronizzazione incrementale e parallela del catalogo delle API in una
+ cartella locale, utilizzabile come base_url (file:// o server HTTP
+ locale) dalle postazioni senza accesso a internet.
+
+ Uso da riga di comando (non richiede QGIS):
+     python istat_boundaries_downloader_mirror.py DEST [--dates 20260101 20250101]
+            [--formats gpkg zip] [--regions all|1,3] [--provinces all|15,58] [--workers 8]
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import threading
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    from .istat_boundaries_downloader_http import iter_content, open_url
+except ImportError:
+    # Esecuzione da riga di comando fuori dal pacchetto del plugin
+    from istat_boundaries_downloader_http import iter_content, open_url
+
+DEFAULT_BASE_URL = "https://www.confini-amministrativi.it/api/v2/it/"
+# Chiave QSettings con la sorgente dati scelta (API pubbliche o mirror locale)
+BASE_URL_SETTING = "istat_boundaries_downloader/base_url"
+
+DATES = [
+    "20260101", "20250101", "20240101", "20230101", "20220101", "20210101", "20200101",
+    "20190101", "20180101", "20170101", "20160101", "20150101", "20140101", "20130101",
+    "20120101", "20111009", "20100101", "20060101", "20050101", "20040101", "20030101",
+    "20020101", "20011021", "19911020",
+]
+TYPES = ["ripartizioni-geografiche", "regioni", "unita-territoriali-sovracomunali", "comuni"]
+FORMATS = ["zip", "gpkg", "csv", "kml", "kmz"]
+REGION_CODES = [str(code) for code in range(1, 21)]
+
+MANIFEST_NAME = "manifest.json"
+CHECKSUMS_NAME = "SHA256SUMS"
+# Artefatti completati tra un salvataggio del manifest e il successivo
+SAVE_EVERY = 50
+
+
+class MirrorSync:
+    """Sincronizza gli artefatti delle API in una cartella con manifest e checksum
+
+    La struttura della cartella replica quella degli URL: la cartella può
+    essere usata come base_url con file:///percorso/ oppure servita in HTTP.
+    """
+
+    def __init__(self, dest_dir, base_url=DEFAULT_BASE_URL, workers=8, retry_missing=False, progress=None):
+        self.dest_dir = dest_dir
+        self.base_url = base_url
+        self.workers = workers
+        self.retry_missing = retry_missing
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.manifest = self.load_manifest()
+        self.stats = {"downloaded": 0, "unchanged": 0, "missing": 0, "errors": 0, "bytes": 0}
+        # Artefatti non sincronizzati: (URL, errore)
+        self.failures = []
+        self.canceled = False
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.dest_dir, MANIFEST_NAME)
+
+    def load_manifest(self):
+        """Legge il manifest della sincronizzazione precedente"""
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("files", {})
+        return {}
+
+    def save_manifest(self):
+        """Scrive il manifest e il file dei checksum"""
+        os.makedirs(self.dest_dir, exist_ok=True)
+        with self.lock:
+            files = dict(sorted(self.manifest.items()))
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"base_url": self.base_url, "updated": datetime.now().isoformat(timespec="seconds"),
+                       "files": files}, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+        with open(os.path.join(self.dest_dir, CHECKSUMS_NAME), "w", encoding="utf-8") as f:
+            for path, entry in files.items():
+                if entry.get("sha256"):
+                    f.write(f"{entry['sha256']}  {path}\n")
+
+    def fetch(self, relative_path):
+        """Scarica un artefatto se nuovo o modificato (richiesta condizionale)"""
+        if self.canceled:
+            return
+        entry = self.manifest.get(relative_path, {})
+        if entry.get("missing") and not self.retry_missing:
+            return
+
+        dest_path = os.path.join(self.dest_dir, *relative_path.split("/"))
+        headers = {}
+        if os.path.exists(dest_path):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            with open_url(self.base_url + relative_path, headers=headers) as response:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                temp_path = f"{dest_path}.part"
+                digest = hashlib.sha256()
+                size = 0
+                with open(temp_path, "wb") as f:
+                    for chunk in iter_content(response):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                sha256 = digest.hexdigest()
+                new_entry = {
+                    "size": size,
+                    "sha256": sha256,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+            if sha256 == entry.get("sha256") and os.path.exists(dest_path):
+                os.remove(temp_path)
+                key = "unchanged"
+            else:
+                os.replace(temp_path, dest_path)
+                key = "downloaded"
+            with self.lock:
+                self.manifest[relative_path] = new_entry
+                self.stats[key] += 1
+                if key == "downloaded":
+                    self.stats["bytes"] += size
+        except urllib.error.HTTPError as e:
+            with self.lock:
+                if e.code == 304:
+                    self.stats["unchanged"] += 1
+                elif e.code == 404:
+                    self.manifest[relative_path] = {"missing": True}
+                    self.stats["missing"] += 1
+                else:
+                    self.stats["errors"] += 1
+                    self.failures.append((self.base_url + relative_path, f"HTTP {e.code} {e.reason}"))
+        except Exception as e:
+            with self.lock:
+                self.stats["errors"] += 1
+                self.failures.append((self.base_url + relative_path, str(e) or type(e).__name__))
+            if os.path.exists(f"{dest_path}.part"):
+                os.remove(f"{dest_path}.part")
+
+    def run_all(self, relative_paths):
+        """Scarica in parallelo un insieme di artefatti salvando il manifest ogni SAVE_EVERY file"""
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(self.fetch, relative_paths):
+                done += 1
+                if self.progress:
+                    self.progress(done, len(relative_paths))
+                # Una sincronizzazione interrotta riparte dagli ETag dei file già scaricati
+                if done % SAVE_EVERY == 0:
+                    self.save_manifest()
+        self.save_manifest()
+
+    def province_codes(self, date_str):
+        """Codici UTS di una data letti dal CSV già sincronizzato"""
+        path = os.path.join(self.dest_dir, date_str, "unita-territoriali-sovracomunali.csv")
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            codes = {row["cod_uts"] for row in reader if row.get("cod_uts")}
+        # I codici non numerici vanno in fondo invece di interrompere la sincronizzazione
+        return sorted(codes, key=lambda code: (0, int(code), "") if code.isdigit() else (1, 0, code))
+
+    def sync(self, dates=DATES, types=TYPES, formats=FORMATS, regions=(), provinces=()):
+        """Sincronizza il catalogo: artefatti nazionali e sottoinsiemi per regione/provincia
+
+        regions e provinces accettano elenchi di codici oppure "all".
+        """
+        national = [f"{date}/{boundary_type}.{fmt}" for date in dates for boundary_type in types for fmt in formats]
+        # Le tabelle CSV servono ai filtri del plugin e all'elenco delle province
+        national += [f"{date}/{name}.csv" for date in dates
+                     for name in ("regioni", "unita-territoriali-sovracomunali") if "csv" not in formats]
+        try:
+            self.run_all(national)
+
+            subsets = []
+            for date in dates:
+                region_codes = REGION_CODES if regions == "all" else list(regions)
+                for code in region_codes:
+                    for child in ("comuni", "unita-territoriali-sovracomunali"):
+                        subsets += [f"{date}/regioni/{code}/{child}.{fmt}" for fmt in formats]
+                province_codes = self.province_codes(date) if provinces == "all" else list(provinces)
+                for code in province_codes:
+                    subsets += [f"{date}/unita-territoriali-sovracomunali/{code}.{fmt}" for fmt in formats]
+                    subsets += [f"{date}/unita-territoriali-sovracomunali/{code}/comuni.{fmt}" for fmt in formats]
+            if subsets:
+                self.run_all(subsets)
+        finally:
+            self.save_manifest()
+        return self.stats
+
+
+def parse_codes(value):
+    """Interpreta l'elenco dei codici da riga di comando"""
+    if not value:
+        return ()
+    if value == "all":
+        return "all"
+    return [code.strip() for code in value.split(",") if code.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mirror offline delle API confini-amministrativi.it")
+    parser.add_argument("dest_dir")
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL)
+    parser.add_argument("--dates", nargs="+", default=DATES)
+    parser.add_argument("--types", nargs="+", default=TYPES)
+    parser.add_argument("--formats", nargs="+", default=FORMATS)
+    parser.add_argument("--regions", help="Codici regione separati da virgola oppure 'all'")
+    parser.add_argument("--provinces", help="Codici UTS separati da virgola oppure 'all'")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--retry-missing", action="store_true", help="Riprova gli artefatti risultati non disponibili")
+    args = parser.parse_args()
+
+    def progress(done, total):
+        print(f"\r{done}/{total}", end="", flush=True)
+
+    mirror = MirrorSync(args.dest_dir, args.base_url, args.workers, args.retry_missing, progress)
+    stats = mirror.sync(args.dates, args.types, args.formats, parse_codes(args.regions), parse_codes(args.provinces))
+    print(f"\nScaricati: {stats['downloaded']} ({stats['bytes'] / 1048576:.1f} MB), invariati: {stats['unchanged']}, "
+          f"non disponibili: {stats['missing']}, errori: {stats['errors']}")
+    for url, error in mirror.failures:
+        print(f"Errore: {url}: {error}")
+    print(f"Usa come base_url: file:///{os.path.abspath(args.dest_dir).lstrip('/').replace(os.sep, '/')}/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Package
+
+ Pacchetto completo di una data di riferimento: ripartizioni, regioni, UTS
+ e comuni scaricati in parallelo e scritti come layer di un solo GeoPackage
+ in un'unica transazione, con indici e relazioni tra i livelli.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal, ogr
+
+from .istat_boundaries_downloader_http import SEGMENTS, download
+from .istat_boundaries_downloader_indexes import code_fields
+
+# Livelli del pacchetto dal più generale al più dettagliato
+PACKAGE_TYPES = ["ripartizioni-geografiche", "regioni", "unita-territoriali-sovracomunali", "comuni"]
+# Relazioni (livello, livello superiore, campo codice comune ai due)
+PACKAGE_RELATIONS = [
+    ("comuni", "unita-territoriali-sovracomunali", "cod_uts"),
+    ("unita-territoriali-sovracomunali", "regioni", "cod_reg"),
+    ("regioni", "ripartizioni-geografiche", "cod_rip"),
+]
+
+
+def package_layer_name(boundary_type):
+    """Nome del layer di un livello nel GeoPackage del pacchetto"""
+    return boundary_type.replace("-", "_")
+
+
+def relation_name(child_type, parent_type):
+    return f"{package_layer_name(child_type)}_{package_layer_name(parent_type)}"
+
+
+def fetch_sources(base_url, date_str, temp_dir, local_sources=None, workers=None):
+    """Scarica in parallelo i GeoPackage dei livelli non disponibili localmente
+
+    local_sources ({tipo: URI OGR}, es. le viste dell'archivio) evita il download
+    di quei livelli. Restituisce {tipo: URI OGR} per tutti i livelli.
+    """
+    sources = dict(local_sources or {})
+
+    def fetch(boundary_type):
+        path = os.path.join(temp_dir, f"{boundary_type}.gpkg")
+        download(f"{base_url}{date_str}/{boundary_type}.gpkg", path, segments=SEGMENTS)
+        return boundary_type, path
+
+    missing = [boundary_type for boundary_type in PACKAGE_TYPES if boundary_type not in sources]
+    if missing:
+        with ThreadPoolExecutor(max_workers=workers or len(missing)) as pool:
+            sources.update(pool.map(fetch, missing))
+    return sources
+
+
+def open_layer(uri):
+    path, _, layer_name = uri.partition("|layername=")
+    ds = ogr.Open(path)
+    if ds is None:
+        raise IOError(f"Impossibile leggere {path}")
+    layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+    return ds, layer
+
+
+def add_relationships(out_path):
+    """Dichiara nel GeoPackage le relazioni tra i livelli (GDAL >= 3.6)
+
+    Restituisce i nomi delle relazioni create; con GDAL più vecchi nessuna.
+    """
+    if not hasattr(gdal, "Relationship"):
+        return []
+    ds = gdal.OpenEx(out_path, gdal.OF_VECTOR | gdal.OF_UPDATE)
+    created = []
+    try:
+        for child_type, parent_type, field in PACKAGE_RELATIONS:
+            relationship = gdal.Relationship(relation_name(child_type, parent_type), package_layer_name(parent_type),
+                                             package_layer_name(child_type), gdal.GRC_ONE_TO_MANY)
+            relationship.SetLeftTableFields([field])
+            relationship.SetRightTableFields([field])
+            relationship.SetType(gdal.GRT_ASSOCIATION)
+            if ds.AddRelationship(relationship):
+                created.append(relationship.GetName())
+    finally:
+        ds = None
+    return created
+
+
+def build_package(sources, out_path):
+    """Scrive i livelli di sources ({tipo: URI OGR}) come layer di out_path
+
+    Tutti i layer e gli indici sui codici sono scritti in un'unica transazione;
+    restituisce il numero di feature per livello e le relazioni dichiarate.
+    """
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(out_path):
+        driver.DeleteDataSource(out_path)
+    out_ds = driver.CreateDataSource(out_path)
+    counts = {}
+    out_ds.StartTransaction()
+    try:
+        for boundary_type in PACKAGE_TYPES:
+            src_ds, src_layer = open_layer(sources[boundary_type])
+            layer = out_ds.CopyLayer(src_layer, package_layer_name(boundary_type))
+            if layer is None:
+                raise IOError(f"Scrittura di {boundary_type} nel pacchetto non riuscita: {gdal.GetLastErrorMsg()}")
+            counts[boundary_type] = layer.GetFeatureCount()
+            src_ds = None
+            # L'R-tree è creato da GDAL con il layer; qui gli indici sui codici
+            name = layer.GetName()
+            for field in code_fields(layer):
+                out_ds.ExecuteSQL(f'CREATE INDEX IF NOT EXISTS "idx_{name}_{field}" ON "{name}" ("{field}")')
+        out_ds.CommitTransaction()
+    except BaseException:
+        out_ds.RollbackTransaction()
+        raise
+    finally:
+        out_ds = None
+    return {"feature": counts, "relazioni": add_relationships(out_path)}
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Prefetch
+
+ Scarica in cache, in background e con banda limitata, l'URL mostrato
+ nell'anteprima dopo che la selezione è rimasta invariata per un breve tempo.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from qgis.PyQt.QtCore import QObject, QTimer
+from qgis.core import QgsApplication, QgsTask, QgsMessageLog, Qgis
+
+from .istat_boundaries_downloader_http import DownloadCanceled, TransferControl
+
+DWELL_MS = 1500
+MAX_RATE = 512 * 1024
+# Le fasi successive al download (priorità 0) hanno la precedenza
+PRIORITY = -1
+
+
+class PrefetchTask(QgsTask):
+    """Scarica un URL nella cache con banda limitata e annullabile"""
+
+    def __init__(self, cache, url, max_rate):
+        super().__init__(f"ISTAT Downloader: prefetch {url}")
+        self.cache = cache
+        self.url = url
+        self.control = TransferControl(max_rate)
+        self.error = None
+
+    def run(self):
+        try:
+            self.cache.fetch(self.url, control=self.control)
+        except DownloadCanceled:
+            return False
+        except Exception as e:
+            self.error = str(e)
+            return False
+        return True
+
+    def cancel(self):
+        self.control.canceled = True
+        super().cancel()
+
+    def finished(self, result):
+        if self.error:
+            QgsMessageLog.logMessage(f"Prefetch non riuscito per {self.url}: {self.error}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+
+
+class Prefetcher(QObject):
+    """Avvia un PrefetchTask per l'URL selezionato dopo DWELL_MS di inattività"""
+
+    def __init__(self, cache, parent=None, dwell_ms=DWELL_MS, max_rate=MAX_RATE):
+        super().__init__(parent)
+        self.cache = cache
+        self.max_rate = max_rate
+        self.url = None
+        self.task = None
+        # Funzione da chiamare al termine del prefetch reclamato da un download
+        self.on_claimed = None
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(dwell_ms)
+        self.timer.timeout.connect(self.start)
+
+    def schedule(self, url):
+        """Programma il prefetch di url annullando quello di una selezione precedente"""
+        # Un prefetch atteso da un download non viene annullato cambiando selezione
+        if self.on_claimed is not None:
+            return
+        if url == self.url and (self.task is not None or self.timer.isActive()):
+            return
+        self.cancel()
+        self.url = url
+        if url and not self.cache.get(url):
+            self.timer.start()
+
+    def start(self):
+        if not self.url or self.cache.get(self.url):
+            return
+        task = PrefetchTask(self.cache, self.url, self.max_rate)
+        task.taskCompleted.connect(lambda: self.release(task))
+        task.taskTerminated.connect(lambda: self.release(task))
+        self.task = task
+        QgsApplication.taskManager().addTask(task, PRIORITY)
+
+    def release(self, task):
+        if self.task is task:
+            self.task = None
+            on_claimed, self.on_claimed = self.on_claimed, None
+            if on_claimed is not None:
+                on_claimed()
+
+    def stop(self):
+        """Annulla il prefetch in corso se nessun download lo sta attendendo"""
+        # Come in schedule, un prefetch reclamato prosegue fino al termine
+        if self.on_claimed is None:
+            self.cancel()
+
+    def cancel(self):
+        """Ferma il timer e annulla il prefetch in corso"""
+        self.timer.stop()
+        self.on_claimed = None
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.url = None
+
+    def claim(self, url, on_claimed):
+        """Fa proseguire senza limite di banda un prefetch di url in corso
+
+        Restituisce True se il prefetch è in corso: on_claimed viene chiamata al
+        suo termine, riuscito o no, e il file va poi cercato nella cache.
+        Non attende mai sul thread principale.
+        """
+        self.timer.stop()
+        task = self.task if self.url == url else None
+        if task is None:
+            return False
+        if task.status() == QgsTask.TaskStatus.Running:
+            task.control.max_rate = None
+            self.on_claimed = on_claimed
+            return True
+        if task.status() in (QgsTask.TaskStatus.Queued, QgsTask.TaskStatus.OnHold):
+            self.cancel()
+        return False
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Reproject
+
+ Riproiezione una tantum dei confini scaricati in un GeoPackage nel sistema
+ di riferimento scelto: le geometrie sono trasformate a blocchi in parallelo
+ e scritte in un'unica transazione.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal, ogr, osr
+
+from .istat_boundaries_downloader_indexes import build_indexes
+
+# Sistemi di riferimento proposti nel dialogo: EPSG -> descrizione (None = dati originali)
+TARGET_CRS = {
+    None: "EPSG:4326 - WGS 84 (originale)",
+    32632: "EPSG:32632 - WGS 84 / UTM 32N",
+    6707: "EPSG:6707 - RDN2008 / UTM 32N",
+    3003: "EPSG:3003 - Monte Mario / Italy zone 1",
+    3857: "EPSG:3857 - WGS 84 / Pseudo-Mercator",
+}
+TARGET_CRS_SETTING = "istat_boundaries_downloader/target_crs"
+CHUNK_SIZE = 500
+
+
+def crs_variant(epsg):
+    """Variante di cache della copia riproiettata (GeoPackage) di un URL"""
+    return f"EPSG:{epsg}.gpkg"
+
+
+def open_source(uri):
+    """Apre un URI OGR (con eventuale "|layername=") e ne restituisce dataset e layer"""
+    path, _, layer_name = uri.partition("|layername=")
+    ds = gdal.OpenEx(path, gdal.OF_VECTOR)
+    if ds is None:
+        raise IOError(f"Impossibile leggere i dati da riproiettare: {path}")
+    layer = ds.GetLayerByName(layer_name) if layer_name else ds.GetLayer(0)
+    return ds, layer
+
+
+def wkb_of(feature):
+    """WKB della geometria di una feature, o None"""
+    geom = feature.GetGeometryRef()
+    return bytes(geom.ExportToIsoWkb()) if geom is not None else None
+
+
+def reproject(src_uri, out_path, epsg, workers=None, chunk_size=CHUNK_SIZE):
+    """Scrive in out_path il layer src_uri riproiettato in EPSG:epsg
+
+    La lettura e la scrittura restano nel thread chiamante, le trasformazioni
+    (che in GDAL rilasciano il GIL) girano su un pool di thread, ciascuno con
+    la propria CoordinateTransformation. Restituisce il numero di feature.
+    """
+    src_ds, src_layer = open_source(src_uri)
+    src_srs = src_layer.GetSpatialRef()
+    if src_srs is None:
+        src_srs = osr.SpatialReference()
+        src_srs.ImportFromEPSG(4326)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(int(epsg))
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    src_wkt, dst_wkt = src_srs.ExportToWkt(), dst_srs.ExportToWkt()
+    local = threading.local()
+
+    def transform(wkbs):
+        if not hasattr(local, "transformation"):
+            source, target = osr.SpatialReference(), osr.SpatialReference()
+            source.ImportFromWkt(src_wkt)
+            target.ImportFromWkt(dst_wkt)
+            for srs in (source, target):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            local.transformation = osr.CoordinateTransformation(source, target)
+        result = []
+        for wkb in wkbs:
+            if wkb is None:
+                result.append(None)
+                continue
+            geom = ogr.CreateGeometryFromWkb(wkb)
+            geom.Transform(local.transformation)
+            result.append(geom)
+        return result
+
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(out_path):
+        driver.DeleteDataSource(out_path)
+    out_ds = driver.CreateDataSource(out_path)
+    out_layer = out_ds.CreateLayer(src_layer.GetName(), dst_srs, src_layer.GetGeomType(), ["SPATIAL_INDEX=NO"])
+    src_defn = src_layer.GetLayerDefn()
+    for i in range(src_defn.GetFieldCount()):
+        out_layer.CreateField(src_defn.GetFieldDefn(i))
+    out_defn = out_layer.GetLayerDefn()
+    count = 0
+
+    def write(future, features):
+        nonlocal count
+        for feature, geom in zip(features, future.result()):
+            out_feature = ogr.Feature(out_defn)
+            out_feature.SetFrom(feature)
+            out_feature.SetGeometry(geom)
+            out_layer.CreateFeature(out_feature)
+            count += 1
+
+    workers = workers or os.cpu_count()
+    out_ds.StartTransaction()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        features = []
+        for feature in src_layer:
+            features.append(feature)
+            if len(features) >= chunk_size:
+                pending.append((pool.submit(transform, [wkb_of(f) for f in features]), features))
+                features = []
+                if len(pending) >= 2 * workers:
+                    write(*pending.popleft())
+        if features:
+            pending.append((pool.submit(transform, [wkb_of(f) for f in features]), features))
+        while pending:
+            write(*pending.popleft())
+    out_ds.CommitTransaction()
+    out_ds = None
+    src_ds = None
+    build_indexes(out_path)
+    return {"feature": count, "epsg": int(epsg)}
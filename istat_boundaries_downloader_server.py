@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Server
+
+ Servizio HTTP locale che risponde in GeoJSON dall'archivio versionato con
+ gli stessi percorsi delle API (es. /20240101/regioni/12/comuni), con
+ filtro per bbox sull'R-tree, cache delle risposte e richieste concorrenti.
+
+ Avvio da riga di comando:
+     python istat_boundaries_downloader_server.py <cartella archivio> --port 8765
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import argparse
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from osgeo import ogr
+
+try:
+    from .istat_boundaries_downloader_store import (CODE_FIELD_BY_TYPE, META_FIELDS, PRESENCE_TABLE, VERSIONS_TABLE,
+                                                    BoundaryStore)
+except ImportError:
+    # Esecuzione da riga di comando fuori dal pacchetto del plugin
+    from istat_boundaries_downloader_store import (CODE_FIELD_BY_TYPE, META_FIELDS, PRESENCE_TABLE, VERSIONS_TABLE,
+                                                   BoundaryStore)
+
+# Porta del servizio; 0 o assente = servizio disattivato
+SERVICE_SETTING = "istat_boundaries_downloader/local_service_port"
+DEFAULT_PORT = 8765
+CACHE_BYTES = 256 * 1024 * 1024
+GZIP_MIN_SIZE = 1024
+# Livelli figli interrogabili sotto un livello superiore, come nelle API
+CHILD_TYPES = {
+    "regioni": ("unita-territoriali-sovracomunali", "comuni"),
+    "unita-territoriali-sovracomunali": ("comuni",),
+}
+
+
+class ServiceError(Exception):
+    """Richiesta non valida o risorsa assente, con il codice HTTP da restituire"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    """Cache LRU delle risposte limitata in byte, condivisa tra i thread"""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """Memorizza entry ({"body", "gzip", ...}); le risposte oltre un quarto della cache non sono tenute"""
+        size = len(entry["body"]) + len(entry.get("gzip") or b"")
+        if size > self.max_bytes // 4:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous["body"]) + len(previous.get("gzip") or b"")
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted["body"]) + len(evicted.get("gzip") or b"")
+
+
+class DatasetPool:
+    """Connessioni in sola lettura ai GeoPackage dell'archivio, una per richiesta in corso"""
+
+    def __init__(self):
+        self.free = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def open(self, path):
+        with self.lock:
+            available = self.free.setdefault(path, [])
+            ds = available.pop() if available else None
+        if ds is None:
+            ds = ogr.Open(path)
+            if ds is None:
+                raise ServiceError(404, f"Archivio non disponibile: {os.path.basename(path)}")
+        try:
+            yield ds
+        finally:
+            with self.lock:
+                self.free[path].append(ds)
+
+    def close(self):
+        with self.lock:
+            self.free.clear()
+
+
+def parse_bbox(value):
+    """bbox=minx,miny,maxx,maxy nel sistema di riferimento dell'archivio"""
+    try:
+        minx, miny, maxx, maxy = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ServiceError(400, "bbox non valido: usare minx,miny,maxx,maxy")
+    if minx > maxx or miny > maxy:
+        raise ServiceError(400, "bbox non valido: minimo maggiore del massimo")
+    return minx, miny, maxx, maxy
+
+
+def feature_collection(result, bbox=None):
+    """GeoJSON delle feature di un risultato SQL, senza i campi interni dell'archivio"""
+    bbox_geom = None
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        bbox_geom = ogr.CreateGeometryFromWkt(
+            f"POLYGON (({minx} {miny}, {maxx} {miny}, {maxx} {maxy}, {minx} {maxy}, {minx} {miny}))")
+    features = []
+    for feature in result:
+        if bbox_geom is not None:
+            geom = feature.GetGeometryRef()
+            if geom is None or not geom.Intersects(bbox_geom):
+                continue
+        data = feature.ExportToJson(as_object=True)
+        data["properties"] = {key: value for key, value in data["properties"].items() if key not in META_FIELDS}
+        features.append(data)
+    return {"type": "FeatureCollection", "features": features}
+
+
+class FeatureService:
+    """Servizio HTTP locale sull'archivio versionato dei confini
+
+    Percorsi (estensione .geojson o .json facoltativa):
+        /                                   date archiviate per tipo
+        /{data}/{tipo}                      tutte le unità (?bbox=minx,miny,maxx,maxy)
+        /{data}/{tipo}/{codice}             una unità per codice ISTAT
+        /{data}/{tipo}/{codice}/{figli}     unità figlie (es. /20240101/regioni/12/comuni)
+    """
+
+    def __init__(self, store, host="127.0.0.1", port=DEFAULT_PORT, cache_bytes=CACHE_BYTES):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.cache = ResponseCache(cache_bytes)
+        self.datasets = DatasetPool()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/"
+
+    @property
+    def running(self):
+        return self.server is not None
+
+    def start(self):
+        """Avvia il server in un thread di supporto"""
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                service.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="ISTAT Downloader servizio locale", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.datasets.close()
+
+    def handle(self, request):
+        """Risponde a una richiesta GET dalla cache o interrogando l'archivio"""
+        parts = urlsplit(request.path)
+        try:
+            key = (parts.path, parts.query, self.store_version())
+            entry = self.cache.get(key)
+            if entry is None:
+                data = self.query(parts.path, parse_qs(parts.query))
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                entry = {"body": body, "gzip": gzip.compress(body, 6) if len(body) >= GZIP_MIN_SIZE else None,
+                         "geojson": isinstance(data, dict) and data.get("type") == "FeatureCollection"}
+                self.cache.put(key, entry)
+            status = 200
+        except ServiceError as e:
+            status, entry = e.status, {"body": json.dumps({"errore": str(e)}).encode("utf-8"), "gzip": None}
+        except Exception as e:
+            status, entry = 500, {"body": json.dumps({"errore": str(e)}).encode("utf-8"), "gzip": None}
+
+        body, encoding = entry["body"], None
+        if entry["gzip"] is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+            body, encoding = entry["gzip"], "gzip"
+        request.send_response(status)
+        request.send_header("Content-Type", "application/geo+json" if entry.get("geojson") else "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        if encoding:
+            request.send_header("Content-Encoding", encoding)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def store_version(self):
+        """Date di modifica dei GeoPackage dell'archivio: cambiano dopo ogni archiviazione"""
+        return tuple(os.path.getmtime(self.store.path(t)) if os.path.exists(self.store.path(t)) else 0
+                     for t in CODE_FIELD_BY_TYPE)
+
+    def query(self, path, params):
+        segments = [segment for segment in path.strip("/").split("/") if segment]
+        if segments:
+            last, ext = os.path.splitext(segments[-1])
+            if ext and ext not in (".geojson", ".json"):
+                raise ServiceError(400, f"Formato {ext} non supportato: il servizio restituisce GeoJSON")
+            segments[-1] = last
+        if not segments:
+            return {boundary_type: self.store.dates(boundary_type) for boundary_type in CODE_FIELD_BY_TYPE}
+
+        date_str = segments[0]
+        if len(date_str) != 8 or not date_str.isdigit():
+            raise ServiceError(404, f"Data non valida: {date_str}")
+        if len(segments) == 1:
+            return [boundary_type for boundary_type in CODE_FIELD_BY_TYPE if self.store.has_date(boundary_type, date_str)]
+
+        boundary_type = segments[1]
+        if boundary_type not in CODE_FIELD_BY_TYPE:
+            raise ServiceError(404, f"Tipo di confine sconosciuto: {boundary_type}")
+        bbox = parse_bbox(params["bbox"][0]) if "bbox" in params else None
+        code = segments[2] if len(segments) > 2 else None
+        if code is not None and not code.isdigit():
+            raise ServiceError(404, f"Codice non valido: {code}")
+
+        if len(segments) == 2:
+            return self.select(boundary_type, date_str, [], bbox)
+        if len(segments) == 3:
+            result = self.select(boundary_type, date_str, [f"v.code = '{int(code)}'"], bbox)
+            if not result["features"]:
+                raise ServiceError(404, f"Codice {code} non presente in {boundary_type} al {date_str}")
+            return result
+        if len(segments) == 4 and segments[3] in CHILD_TYPES.get(boundary_type, ()):
+            parent_field = CODE_FIELD_BY_TYPE[boundary_type]
+            return self.select(segments[3], date_str, [f'v."{parent_field}" = {int(code)}'], bbox)
+        raise ServiceError(404, f"Percorso non supportato: {path}")
+
+    def select(self, boundary_type, date_str, conditions, bbox=None):
+        """Unità di una data che soddisfano le condizioni SQL, prefiltrate sull'R-tree per bbox"""
+        sql = (f"SELECT v.* FROM {VERSIONS_TABLE} v JOIN {PRESENCE_TABLE} p ON p.version_hash = v.version_hash "
+               f"WHERE p.ref_date = '{date_str}'")
+        for condition in conditions:
+            sql += f" AND {condition}"
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            sql += (f' AND v.fid IN (SELECT id FROM "rtree_{VERSIONS_TABLE}_geom" '
+                    f"WHERE minx <= {maxx} AND maxx >= {minx} AND miny <= {maxy} AND maxy >= {miny})")
+        with self.datasets.open(self.store.path(boundary_type)) as ds:
+            result = ds.ExecuteSQL(sql)
+            if result is None:
+                raise ServiceError(500, f"Interrogazione di {boundary_type} non riuscita")
+            try:
+                return feature_collection(result, bbox)
+            finally:
+                ds.ReleaseResultSet(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servizio locale dei confini ISTAT archiviati dal plugin")
+    parser.add_argument("store_dir", help="Cartella dell'archivio (istat_boundaries_downloader/store nel profilo QGIS)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    service = FeatureService(BoundaryStore(args.store_dir), args.host, args.port)
+    service.start()
+    print(f"Servizio attivo su {service.url} (Ctrl+C per terminare)")
+    try:
+        service.thread.join()
+    except KeyboardInterrupt:
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Store
+
+ Archivio locale versionato dei confini: un GeoPackage per tipo di confine
+ in cui ogni versione di una feature (geometria normalizzata + attributi) è
+ salvata una sola volta con il suo intervallo di validità. Ogni data di
+ riferimento è ricostruita come vista.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import hashlib
+import json
+import os
+
+from osgeo import ogr
+
+# Campo codice ISTAT che identifica le feature di ogni tipo di confine
+CODE_FIELD_BY_TYPE = {
+    "ripartizioni-geografiche": "cod_rip",
+    "regioni": "cod_reg",
+    "unita-territoriali-sovracomunali": "cod_uts",
+    "comuni": "pro_com",
+}
+
+VERSIONS_TABLE = "versions"
+PRESENCE_TABLE = "presence"
+META_FIELDS = ("version_hash", "geom_hash", "attr_hash", "code", "valid_from", "valid_to")
+
+
+def geometry_hash(geom):
+    """Hash della geometria normalizzata (multi-parte, ordine dei vertici canonico)"""
+    if geom is None:
+        return ""
+    normalized = ogr.ForceToMultiPolygon(geom.Clone()) if geom.GetDimension() == 2 else geom.Clone()
+    if hasattr(normalized, "Normalize"):
+        normalized.Normalize()
+    return hashlib.sha1(normalized.ExportToIsoWkb()).hexdigest()
+
+
+def feature_attributes(feature):
+    """Attributi della feature come dizionario con chiavi in minuscolo"""
+    defn = feature.GetDefnRef()
+    return {defn.GetFieldDefn(i).GetName().lower(): feature.GetField(i) for i in range(defn.GetFieldCount())}
+
+
+def attributes_hash(attributes):
+    """Hash degli attributi indipendente dall'ordine dei campi"""
+    payload = json.dumps(attributes, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def view_name(boundary_type, date_str):
+    """Nome della vista che ricostruisce una data di riferimento"""
+    return f"{boundary_type.replace('-', '_')}_{date_str}"
+
+
+class BoundaryStore:
+    """Archivio versionato e deduplicato dei confini scaricati"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def path(self, boundary_type):
+        """Percorso del GeoPackage del tipo di confine"""
+        return os.path.join(self.store_dir, f"{boundary_type}.gpkg")
+
+    def layer_uri(self, boundary_type, date_str):
+        """URI OGR della vista di una data di riferimento"""
+        return f"{self.path(boundary_type)}|layername={view_name(boundary_type, date_str)}"
+
+    def export(self, boundary_type, date_str, out_path):
+        """Copia la vista di una data in un GeoPackage autonomo e modificabile
+
+        Restituisce l'URI OGR del layer copiato, con lo stesso nome della vista.
+        """
+        name = view_name(boundary_type, date_str)
+        ds = ogr.Open(self.path(boundary_type))
+        view = ds.GetLayerByName(name) if ds is not None else None
+        if view is None:
+            raise ValueError(f"Data {date_str} non presente nell'archivio {boundary_type}")
+        driver = ogr.GetDriverByName("GPKG")
+        if os.path.exists(out_path):
+            driver.DeleteDataSource(out_path)
+        out_ds = driver.CreateDataSource(out_path)
+        out_ds.StartTransaction()
+        out_ds.CopyLayer(view, name)
+        out_ds.CommitTransaction()
+        out_ds = None
+        ds = None
+        return f"{out_path}|layername={name}"
+
+    def dates(self, boundary_type):
+        """Date di riferimento presenti nell'archivio per il tipo di confine"""
+        if not os.path.exists(self.path(boundary_type)):
+            return []
+        ds = ogr.Open(self.path(boundary_type))
+        if ds is None or ds.GetLayerByName(PRESENCE_TABLE) is None:
+            return []
+        result = ds.ExecuteSQL(f"SELECT DISTINCT ref_date FROM {PRESENCE_TABLE} ORDER BY ref_date")
+        try:
+            return [feature.GetField(0) for feature in result]
+        finally:
+            ds.ReleaseResultSet(result)
+
+    def has_date(self, boundary_type, date_str):
+        """Verifica se una data è già presente nell'archivio"""
+        return date_str in self.dates(boundary_type)
+
+    def open(self, boundary_type, src_layer):
+        """Apre (creandolo se necessario) il GeoPackage del tipo di confine"""
+        path = self.path(boundary_type)
+        if os.path.exists(path):
+            return ogr.Open(path, 1)
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        ds = ogr.GetDriverByName("GPKG").CreateDataSource(path)
+        versions = ds.CreateLayer(VERSIONS_TABLE, src_layer.GetSpatialRef(), ogr.wkbMultiPolygon,
+                                  ["FID=fid", "GEOMETRY_NAME=geom"])
+        for name in META_FIELDS:
+            versions.CreateField(ogr.FieldDefn(name, ogr.OFTString))
+        presence = ds.CreateLayer(PRESENCE_TABLE, None, ogr.wkbNone)
+        presence.CreateField(ogr.FieldDefn("version_hash", ogr.OFTString))
+        presence.CreateField(ogr.FieldDefn("ref_date", ogr.OFTString))
+        ds.ExecuteSQL(f"CREATE UNIQUE INDEX idx_versions_hash ON {VERSIONS_TABLE} (version_hash)")
+        ds.ExecuteSQL(f"CREATE INDEX idx_versions_code ON {VERSIONS_TABLE} (code)")
+        ds.ExecuteSQL(f"CREATE INDEX idx_presence_date ON {PRESENCE_TABLE} (ref_date, version_hash)")
+        return ds
+
+    def ensure_fields(self, versions, src_layer):
+        """Aggiunge alla tabella delle versioni i campi sorgente non ancora presenti"""
+        existing = {versions.GetLayerDefn().GetFieldDefn(i).GetName().lower()
+                    for i in range(versions.GetLayerDefn().GetFieldCount())}
+        src_defn = src_layer.GetLayerDefn()
+        for i in range(src_defn.GetFieldCount()):
+            field_defn = src_defn.GetFieldDefn(i)
+            if field_defn.GetName().lower() not in existing:
+                versions.CreateField(ogr.FieldDefn(field_defn.GetName().lower(), field_defn.GetType()))
+
+    def ingest(self, src_path, boundary_type, date_str):
+        """Archivia una data di riferimento salvando solo le versioni nuove
+
+        Restituisce un dizionario con il numero di versioni nuove e riusate.
+        """
+        src_ds = ogr.Open(src_path)
+        if src_ds is None or src_ds.GetLayerCount() == 0:
+            raise IOError(f"Impossibile leggere i dati da archiviare: {src_path}")
+        # Shapefile e KML cambiano nomi e tipi dei campi: gli hash non sarebbero confrontabili
+        if src_ds.GetDriver().GetName() != "GPKG":
+            raise ValueError(f"L'archivio accetta solo i GeoPackage delle API, non {src_ds.GetDriver().GetName()}")
+        src_layer = src_ds.GetLayer(0)
+        code_field = CODE_FIELD_BY_TYPE.get(boundary_type)
+
+        ds = self.open(boundary_type, src_layer)
+        versions = ds.GetLayerByName(VERSIONS_TABLE)
+        presence = ds.GetLayerByName(PRESENCE_TABLE)
+        self.ensure_fields(versions, src_layer)
+
+        result = ds.ExecuteSQL(f"SELECT version_hash FROM {VERSIONS_TABLE}")
+        known = {feature.GetField(0) for feature in result}
+        ds.ReleaseResultSet(result)
+
+        stats = {"new": 0, "reused": 0}
+        ds.StartTransaction()
+        try:
+            ds.ExecuteSQL(f"DELETE FROM {PRESENCE_TABLE} WHERE ref_date = '{date_str}'")
+            versions_defn = versions.GetLayerDefn()
+            presence_defn = presence.GetLayerDefn()
+            for feature in src_layer:
+                geom = feature.GetGeometryRef()
+                attributes = feature_attributes(feature)
+                geom_hash = geometry_hash(geom)
+                attr_hash = attributes_hash(attributes)
+                version_hash = hashlib.sha1(f"{geom_hash}{attr_hash}".encode("ascii")).hexdigest()
+
+                if version_hash in known:
+                    stats["reused"] += 1
+                else:
+                    out = ogr.Feature(versions_defn)
+                    for name, value in attributes.items():
+                        if value is not None:
+                            out.SetField(name, value)
+                    out.SetField("version_hash", version_hash)
+                    out.SetField("geom_hash", geom_hash)
+                    out.SetField("attr_hash", attr_hash)
+                    if code_field and attributes.get(code_field) is not None:
+                        out.SetField("code", str(attributes[code_field]))
+                    if geom is not None:
+                        out.SetGeometry(ogr.ForceToMultiPolygon(geom.Clone()))
+                    versions.CreateFeature(out)
+                    known.add(version_hash)
+                    stats["new"] += 1
+
+                link = ogr.Feature(presence_defn)
+                link.SetField("version_hash", version_hash)
+                link.SetField("ref_date", date_str)
+                presence.CreateFeature(link)
+
+            # Intervallo di validità: prima e ultima data di riferimento in cui compare la versione
+            ds.ExecuteSQL(
+                f"UPDATE {VERSIONS_TABLE} SET "
+                f"valid_from = (SELECT MIN(ref_date) FROM {PRESENCE_TABLE} p WHERE p.version_hash = {VERSIONS_TABLE}.version_hash), "
+                f"valid_to = (SELECT MAX(ref_date) FROM {PRESENCE_TABLE} p WHERE p.version_hash = {VERSIONS_TABLE}.version_hash)")
+            ds.CommitTransaction()
+        except Exception:
+            ds.RollbackTransaction()
+            raise
+
+        # Le viste di tutte le date espongono le stesse colonne sorgente
+        for ref_date in self.dates(boundary_type):
+            self.create_view(ds, boundary_type, ref_date)
+        return stats
+
+    def create_view(self, ds, boundary_type, date_str):
+        """Registra (o ricrea) nel GeoPackage la vista che ricostruisce la data di riferimento
+
+        La vista elenca solo fid, geometria e campi sorgente, senza i campi interni dell'archivio.
+        """
+        name = view_name(boundary_type, date_str)
+        versions_defn = ds.GetLayerByName(VERSIONS_TABLE).GetLayerDefn()
+        columns = [versions_defn.GetFieldDefn(i).GetName() for i in range(versions_defn.GetFieldCount())]
+        select = ", ".join(f'v."{column}"' for column in columns if column not in META_FIELDS)
+        ds.ExecuteSQL(f'DROP VIEW IF EXISTS "{name}"')
+        ds.ExecuteSQL(
+            f'CREATE VIEW "{name}" AS SELECT v.fid AS fid, v.geom AS geom, {select} FROM {VERSIONS_TABLE} v '
+            f"JOIN {PRESENCE_TABLE} p ON p.version_hash = v.version_hash WHERE p.ref_date = '{date_str}'")
+        ds.ExecuteSQL(
+            f"INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) "
+            f"SELECT '{name}', 'features', '{name}', min_x, min_y, max_x, max_y, srs_id "
+            f"FROM gpkg_contents WHERE table_name = '{VERSIONS_TABLE}'")
+        ds.ExecuteSQL(
+            f"INSERT OR IGNORE INTO gpkg_geometry_columns (table_name, column_name, geometry_type_name, srs_id, z, m) "
+            f"SELECT '{name}', column_name, geometry_type_name, srs_id, z, m "
+            f"FROM gpkg_geometry_columns WHERE table_name = '{VERSIONS_TABLE}'")
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Tasks
+
+ Task in background eseguiti dopo il download dei confini.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import time
+
+from qgis.core import QgsTask, QgsMessageLog, Qgis
+
+# Terzo elemento di una fase: il suo errore è registrato come avviso senza interrompere il task
+OPTIONAL = True
+
+
+class PostDownloadTask(QgsTask):
+    """Esegue in sequenza le fasi successive al download misurandone i tempi
+
+    Ogni fase è una coppia (nome, funzione) o una terna (nome, funzione, OPTIONAL);
+    le funzioni girano nel thread del task e non devono toccare oggetti
+    dell'interfaccia. Una fase facoltativa non riuscita ha risultato None.
+    """
+
+    def __init__(self, description, stages, on_finished=None):
+        super().__init__(description)
+        self.stages = stages
+        self.on_finished = on_finished
+        self.timings = []
+        self.results = {}
+        self.error = None
+        self.warnings = []
+
+    def run(self):
+        """Esegue le fasi nel thread del task"""
+        total = len(self.stages)
+        for i, (name, stage, *optional) in enumerate(self.stages):
+            if self.isCanceled():
+                return False
+            start = time.monotonic()
+            try:
+                self.results[name] = stage()
+            except Exception as e:
+                if not optional or not optional[0]:
+                    self.error = f"{name}: {str(e)}"
+                    return False
+                self.results[name] = None
+                self.warnings.append(f"{name}: {str(e)}")
+                self.setProgress(100.0 * (i + 1) / total)
+                continue
+            self.timings.append((name, time.monotonic() - start))
+            self.setProgress(100.0 * (i + 1) / total)
+        return True
+
+    def finished(self, result):
+        """Riporta i tempi delle fasi e richiama la callback nel thread principale"""
+        for name, elapsed in self.timings:
+            details = f": {self.results[name]}" if self.results.get(name) else ""
+            QgsMessageLog.logMessage(f"Fase '{name}' completata in {elapsed:.2f} s{details}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+        for warning in self.warnings:
+            QgsMessageLog.logMessage(f"Fase facoltativa non riuscita, {warning}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+        if self.error:
+            QgsMessageLog.logMessage(f"Errore nella fase {self.error}", "ISTAT Downloader", Qgis.MessageLevel.Critical)
+        if self.on_finished:
+            self.on_finished(result, self)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Tiles
+
+ Generazione di tile vettoriali MBTiles dai confini scaricati: ogni livello
+ di zoom è prodotto in parallelo dal driver MVT di GDAL con semplificazione
+ propria e i risultati sono uniti in un unico file.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+MIN_ZOOM = 0
+MAX_ZOOM = 12
+# Tolleranza di semplificazione in unità della griglia del tile (4096 per lato)
+SIMPLIFICATION = 1.0
+
+
+def tiles_available():
+    """Verifica che GDAL possa scrivere tile vettoriali in MBTiles"""
+    return gdal.GetDriverByName("MBTiles") is not None and gdal.GetDriverByName("MVT") is not None
+
+
+def build_zoom(src_path, src_layer, out_path, zoom, layer_name):
+    """Scrive i tile di un solo livello di zoom in un MBTiles separato"""
+    options = gdal.VectorTranslateOptions(
+        format="MBTiles",
+        layers=[src_layer] if src_layer else None,
+        layerName=layer_name,
+        datasetCreationOptions=[
+            f"MINZOOM={zoom}",
+            f"MAXZOOM={zoom}",
+            f"SIMPLIFICATION={SIMPLIFICATION}",
+            f"NAME={layer_name}",
+        ],
+    )
+    ds = gdal.VectorTranslate(out_path, src_path, options=options)
+    if ds is None:
+        raise RuntimeError(f"Generazione dei tile non riuscita per lo zoom {zoom}: {gdal.GetLastErrorMsg()}")
+    ds = None
+    return out_path
+
+
+def merge_mbtiles(parts, out_path, min_zoom, max_zoom):
+    """Unisce gli MBTiles dei singoli zoom aggiornando i metadati"""
+    shutil.copyfile(parts[0], out_path)
+    con = sqlite3.connect(out_path)
+    try:
+        for part in parts[1:]:
+            con.execute("ATTACH DATABASE ? AS part", (part,))
+            con.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) "
+                        "SELECT zoom_level, tile_column, tile_row, tile_data FROM part.tiles")
+            con.commit()
+            con.execute("DETACH DATABASE part")
+        metadata = dict(con.execute("SELECT name, value FROM metadata"))
+        updates = {"minzoom": str(min_zoom), "maxzoom": str(max_zoom)}
+        if "json" in metadata:
+            info = json.loads(metadata["json"])
+            for layer in info.get("vector_layers", []):
+                layer["minzoom"] = min_zoom
+                layer["maxzoom"] = max_zoom
+            updates["json"] = json.dumps(info)
+        for name, value in updates.items():
+            con.execute("DELETE FROM metadata WHERE name = ?", (name,))
+            con.execute("INSERT INTO metadata (name, value) VALUES (?, ?)", (name, value))
+        con.commit()
+        tiles = con.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+    finally:
+        con.close()
+    return tiles
+
+
+def build_mbtiles(src_uri, out_path, layer_name, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, workers=None):
+    """Genera out_path con i tile da min_zoom a max_zoom del layer src_uri
+
+    Gli zoom sono prodotti in parallelo (GDAL rilascia il GIL durante la
+    conversione) e poi uniti. Restituisce il numero di tile.
+    """
+    src_path, _, src_layer = src_uri.partition("|layername=")
+    temp_dir = tempfile.mkdtemp()
+    try:
+        zooms = range(min_zoom, max_zoom + 1)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            # Gli zoom più dettagliati sono i più lenti: partono per primi
+            futures = {zoom: pool.submit(build_zoom, src_path, src_layer, os.path.join(temp_dir, f"z{zoom}.mbtiles"),
+                                         zoom, layer_name)
+                       for zoom in reversed(zooms)}
+        parts = [futures[zoom].result() for zoom in zooms]
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return {"tile": merge_mbtiles(parts, out_path, min_zoom, max_zoom)}
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,728 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Tools Dialog
+
+ Strumenti di analisi sui confini scaricati e archiviati.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import shutil
+import tempfile
+
+from qgis.PyQt.QtCore import Qt, QSettings
+from qgis.PyQt.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QLabel,
+                                 QComboBox, QPushButton, QProgressBar, QMessageBox,
+                                 QFileDialog, QWidget, QGridLayout, QTabWidget, QLineEdit,
+                                 QCheckBox, QSpinBox)
+from qgis.core import QgsApplication, QgsVectorLayer, Qgis, QgsMessageLog
+
+from .istat_boundaries_downloader_admindex import INDEX_NAME, build_admin_index
+from .istat_boundaries_downloader_crosswalk import cached_crosswalk, remap_table
+from .istat_boundaries_downloader_diff import DIFF_LAYERS, diff_dates
+from .istat_boundaries_downloader_geocode import ComuniIndex, geocode_points, shapely
+from .istat_boundaries_downloader_http import SEGMENTS, download
+from .istat_boundaries_downloader_join import JOIN_LAYER, join_table, table_fields, table_layers
+from .istat_boundaries_downloader_layers import date_group_name
+from .istat_boundaries_downloader_mirror import BASE_URL_SETTING, DEFAULT_BASE_URL, MirrorSync
+from .istat_boundaries_downloader_server import DEFAULT_PORT, SERVICE_SETTING
+from .istat_boundaries_downloader_store import CODE_FIELD_BY_TYPE, view_name
+from .istat_boundaries_downloader_tasks import PostDownloadTask
+from .istat_boundaries_downloader_watchdog import DEFAULT_THRESHOLD_MS, WATCHDOG_SETTING
+
+
+class ToolsDialog(QDialog):
+    def __init__(self, boundary_types, dates, base_url, store, cache, download_path, layer_loader, parent=None,
+                 install_admin_index=None):
+        super().__init__(parent)
+        self.boundary_types = {label: value for label, value in boundary_types.items()
+                               if value in CODE_FIELD_BY_TYPE}
+        self.dates = dates
+        self.base_url = base_url
+        self.store = store
+        self.cache = cache
+        self.download_path = download_path
+        self.layer_loader = layer_loader
+        # install_admin_index(nuovo, indice) sostituisce l'indice amministrativo in uso
+        self.install_admin_index = install_admin_index or os.replace
+        self.task = None
+        self.setWindowTitle("Strumenti — ISTAT Boundaries Downloader")
+        self.resize(520, 320)
+        self.setup_ui()
+
+    def setup_ui(self):
+        """Configura le schede degli strumenti"""
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(12, 12, 12, 12)
+        layout.setSpacing(10)
+
+        self.tabs = QTabWidget()
+        self.tabs.addTab(self.create_diff_tab(), "Confronto date")
+        self.tabs.addTab(self.create_join_tab(), "Join tabella")
+        self.tabs.addTab(self.create_crosswalk_tab(), "Codici tra date")
+        self.tabs.addTab(self.create_geocode_tab(), "Geocodifica punti")
+        self.tabs.addTab(self.create_mirror_tab(), "Mirror offline")
+        self.tabs.addTab(self.create_diagnostics_tab(), "Diagnostica")
+        layout.addWidget(self.tabs)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setVisible(False)
+        layout.addWidget(self.progress_bar)
+
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addStretch(1)
+        close_button = QPushButton("Chiudi")
+        close_button.clicked.connect(self.reject)
+        buttons_layout.addWidget(close_button)
+        layout.addLayout(buttons_layout)
+
+    def create_type_combo(self):
+        """Combo dei tipi di confine gestiti dall'archivio"""
+        combo = QComboBox()
+        for label in self.boundary_types:
+            combo.addItem(label)
+        return combo
+
+    def create_output_row(self, default_name, file_filter="GeoPackage (*.gpkg)"):
+        """Riga con campo e pulsante per scegliere il file di output"""
+        row = QHBoxLayout()
+        edit = QLineEdit(os.path.join(self.download_path, default_name))
+        button = QPushButton("Sfoglia")
+        button.clicked.connect(lambda: self.browse_output(edit, file_filter))
+        row.addWidget(edit)
+        row.addWidget(button)
+        return row, edit
+
+    def browse_output(self, edit, file_filter="GeoPackage (*.gpkg)"):
+        """Sceglie il file di output"""
+        path, _ = QFileDialog.getSaveFileName(self, "File di output", edit.text(), file_filter)
+        if path:
+            edit.setText(path)
+
+    def create_diff_tab(self):
+        """Scheda per il confronto tra due date di riferimento"""
+        tab = QWidget()
+        grid = QGridLayout(tab)
+        grid.setVerticalSpacing(10)
+
+        self.diff_type_combo = self.create_type_combo()
+        self.diff_date_a_combo = QComboBox()
+        self.diff_date_b_combo = QComboBox()
+        for date in self.dates:
+            self.diff_date_a_combo.addItem(date)
+            self.diff_date_b_combo.addItem(date)
+        if len(self.dates) > 1:
+            self.diff_date_a_combo.setCurrentIndex(1)
+
+        output_row, self.diff_output_edit = self.create_output_row("ISTAT_confronto.gpkg")
+
+        labels = ["Tipo di confine:", "Data iniziale:", "Data finale:", "Output:"]
+        for row, text in enumerate(labels):
+            label = QLabel(text)
+            label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+            grid.addWidget(label, row, 0)
+        grid.addWidget(self.diff_type_combo, 0, 1)
+        grid.addWidget(self.diff_date_a_combo, 1, 1)
+        grid.addWidget(self.diff_date_b_combo, 2, 1)
+        grid.addLayout(output_row, 3, 1)
+
+        note = QLabel("Le date mancanti vengono scaricate (GeoPackage) e aggiunte all'archivio locale versionato.")
+        note.setWordWrap(True)
+        note.setStyleSheet("font-style: italic;")
+        grid.addWidget(note, 4, 0, 1, 2)
+
+        self.diff_button = QPushButton("Confronta")
+        self.diff_button.clicked.connect(self.run_diff)
+        grid.addWidget(self.diff_button, 5, 1, Qt.AlignmentFlag.AlignRight)
+        grid.setRowStretch(6, 1)
+        return tab
+
+    def create_join_tab(self):
+        """Scheda per il join di una tabella statistica sui confini per codice ISTAT"""
+        tab = QWidget()
+        grid = QGridLayout(tab)
+        grid.setVerticalSpacing(10)
+
+        self.join_type_combo = self.create_type_combo()
+        self.join_date_combo = QComboBox()
+        for date in self.dates:
+            self.join_date_combo.addItem(date)
+
+        table_row, self.join_table_edit, self.join_layer_combo, self.join_key_combo = \
+            self.create_table_inputs(self.join_type_combo)
+
+        output_row, self.join_output_edit = self.create_output_row("ISTAT_join.gpkg")
+
+        labels = ["Tipo di confine:", "Data:", "Tabella:", "Layer / foglio:", "Colonna chiave:", "Output:"]
+        for row, text in enumerate(labels):
+            label = QLabel(text)
+            label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+            grid.addWidget(label, row, 0)
+        grid.addWidget(self.join_type_combo, 0, 1)
+        grid.addWidget(self.join_date_combo, 1, 1)
+        grid.addLayout(table_row, 2, 1)
+        grid.addWidget(self.join_layer_combo, 3, 1)
+        grid.addWidget(self.join_key_combo, 4, 1)
+        grid.addLayout(output_row, 5, 1)
+
+        note = QLabel("I codici sono confrontati senza zeri iniziali (\"001001\" = 1001). Il layer "
+                      "\"non_abbinati\" dell'output elenca i codici senza corrispondenza.")
+        note.setWordWrap(True)
+        note.setStyleSheet("font-style: italic;")
+        grid.addWidget(note, 6, 0, 1, 2)
+
+        self.join_button = QPushButton("Esegui join")
+        self.join_button.clicked.connect(self.run_join)
+        grid.addWidget(self.join_button, 7, 1, Qt.AlignmentFlag.AlignRight)
+        grid.setRowStretch(8, 1)
+        return tab
+
+    def create_crosswalk_tab(self):
+        """Scheda per ricodificare una tabella dai codici di una data a quelli di un'altra"""
+        tab = QWidget()
+        grid = QGridLayout(tab)
+        grid.setVerticalSpacing(10)
+
+        self.crosswalk_type_combo = self.create_type_combo()
+        self.crosswalk_type_combo.setCurrentText("Comuni")
+        self.crosswalk_from_combo = QComboBox()
+        self.crosswalk_to_combo = QComboBox()
+        for date in self.dates:
+            self.crosswalk_from_combo.addItem(date)
+            self.crosswalk_to_combo.addItem(date)
+        self.crosswalk_from_combo.setCurrentText("20111009")
+
+        table_row, self.crosswalk_table_edit, self.crosswalk_layer_combo, self.crosswalk_key_combo = \
+            self.create_table_inputs(self.crosswalk_type_combo)
+
+        output_row, self.crosswalk_output_edit = self.create_output_row("ISTAT_ricodificata.csv", "CSV (*.csv)")
+
+        labels = ["Tipo di confine:", "Codici della data:", "Ricodifica alla data:", "Tabella:",
+                  "Layer / foglio:", "Colonna codice:", "Output:"]
+        for row, text in enumerate(labels):
+            label = QLabel(text)
+            label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+            grid.addWidget(label, row, 0)
+        grid.addWidget(self.crosswalk_type_combo, 0, 1)
+        grid.addWidget(self.crosswalk_from_combo, 1, 1)
+        grid.addWidget(self.crosswalk_to_combo, 2, 1)
+        grid.addLayout(table_row, 3, 1)
+        grid.addWidget(self.crosswalk_layer_combo, 4, 1)
+        grid.addWidget(self.crosswalk_key_combo, 5, 1)
+        grid.addLayout(output_row, 6, 1)
+
+        note = QLabel("Le corrispondenze sono ricavate una sola volta dalle tabelle degli attributi di "
+                      "tutte le date e salvate in cache; le ricodifiche successive non usano la rete. "
+                      "Le fusioni sono riconosciute per sovrapposizione se le date sono nell'archivio locale.")
+        note.setWordWrap(True)
+        note.setStyleSheet("font-style: italic;")
+        grid.addWidget(note, 7, 0, 1, 2)
+
+        self.crosswalk_button = QPushButton("Ricodifica")
+        self.crosswalk_button.clicked.connect(self.run_crosswalk)
+        grid.addWidget(self.crosswalk_button, 8, 1, Qt.AlignmentFlag.AlignRight)
+        grid.setRowStretch(9, 1)
+        return tab
+
+    def create_geocode_tab(self):
+        """Scheda per assegnare a punti (CSV o layer) i codici ISTAT del comune che li contiene"""
+        tab = QWidget()
+        grid = QGridLayout(tab)
+        grid.setVerticalSpacing(10)
+
+        self.geocode_date_combo = QComboBox()
+        for date in self.dates:
+            self.geocode_date_combo.addItem(date)
+
+        table_row = QHBoxLayout()
+        self.geocode_table_edit = QLineEdit()
+        self.geocode_table_edit.setPlaceholderText("Punti in CSV, XLSX o GeoPackage...")
+        table_browse = QPushButton("Sfoglia")
+        table_row.addWidget(self.geocode_table_edit)
+        table_row.addWidget(table_browse)
+        self.geocode_layer_combo = QComboBox()
+        self.geocode_x_combo = QComboBox()
+        self.geocode_y_combo = QComboBox()
+        self.geocode_epsg_edit = QLineEdit("4326")
+        self.geocode_epsg_edit.setToolTip("Codice EPSG delle coordinate dei punti")
+
+        update_layers = lambda: self.update_table_layers(self.geocode_table_edit, self.geocode_layer_combo)  # noqa: E731
+        self.geocode_table_edit.editingFinished.connect(update_layers)
+        table_browse.clicked.connect(lambda: self.browse_table(self.geocode_table_edit) and update_layers())
+        self.geocode_layer_combo.currentIndexChanged.connect(self.update_geocode_fields)
+
+        output_row, self.geocode_output_edit = self.create_output_row("ISTAT_geocodifica.csv", "CSV (*.csv)")
+
+        labels = ["Comuni alla data:", "Punti:", "Layer / foglio:", "Colonna X (lon):", "Colonna Y (lat):",
+                  "EPSG coordinate:", "Output:"]
+        for row, text in enumerate(labels):
+            label = QLabel(text)
+            label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+            grid.addWidget(label, row, 0)
+        grid.addWidget(self.geocode_date_combo, 0, 1)
+        grid.addLayout(table_row, 1, 1)
+        grid.addWidget(self.geocode_layer_combo, 2, 1)
+        grid.addWidget(self.geocode_x_combo, 3, 1)
+        grid.addWidget(self.geocode_y_combo, 4, 1)
+        grid.addWidget(self.geocode_epsg_edit, 5, 1)
+        grid.addLayout(output_row, 6, 1)
+
+        engine = "STRtree (shapely)" if shapely is not None else "indice a griglia (shapely non disponibile)"
+        note = QLabel("Ogni punto riceve pro_com, cod_uts, cod_prov, cod_reg e cod_rip del comune che lo "
+                      "contiene. L'indice dei comuni è costruito una volta per data e salvato su disco; "
+                      f"motore: {engine}. Per i layer puntuali lascia le colonne su \"(geometria)\".")
+        note.setWordWrap(True)
+        note.setStyleSheet("font-style: italic;")
+        grid.addWidget(note, 7, 0, 1, 2)
+
+        self.geocode_button = QPushButton("Geocodifica")
+        self.geocode_button.clicked.connect(self.run_geocode)
+        grid.addWidget(self.geocode_button, 8, 1, Qt.AlignmentFlag.AlignRight)
+        grid.setRowStretch(9, 1)
+        return tab
+
+    def update_geocode_fields(self):
+        """Aggiorna le colonne delle coordinate proponendo quelle con nomi noti"""
+        self.geocode_x_combo.clear()
+        self.geocode_y_combo.clear()
+        path = self.geocode_table_edit.text()
+        if not os.path.isfile(path) or self.geocode_layer_combo.count() == 0:
+            return
+        try:
+            fields = table_fields(path, self.geocode_layer_combo.currentText())
+        except Exception as e:
+            QgsMessageLog.logMessage(f"Errore nel leggere la tabella: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+            return
+        for combo, guesses in ((self.geocode_x_combo, ("x", "lon", "long", "lng", "longitude", "longitudine")),
+                               (self.geocode_y_combo, ("y", "lat", "latitude", "latitudine"))):
+            if not path.lower().endswith(".csv"):
+                combo.addItem("(geometria)", "")
+            for name in fields:
+                combo.addItem(name, name)
+            for name in fields:
+                if name.lower() in guesses:
+                    combo.setCurrentIndex(combo.findData(name))
+                    break
+
+    def geocode_index_dir(self):
+        """Cartella degli indici spaziali dei comuni per la geocodifica"""
+        return os.path.join(os.path.dirname(self.store.store_dir), "geocode")
+
+    def run_geocode(self):
+        """Assegna ai punti i codici dei comuni della data selezionata"""
+        date_str = self.geocode_date_combo.currentText()
+        table_path = self.geocode_table_edit.text()
+        table_layer = self.geocode_layer_combo.currentText()
+        x_field = self.geocode_x_combo.currentData()
+        y_field = self.geocode_y_combo.currentData()
+        out_path = self.geocode_output_edit.text()
+        if x_field is None or y_field is None or bool(x_field) != bool(y_field):
+            QMessageBox.warning(self, "Geocodifica punti", "Seleziona i punti e le colonne delle coordinate.")
+            return
+        try:
+            epsg = int(self.geocode_epsg_edit.text())
+        except ValueError:
+            QMessageBox.warning(self, "Geocodifica punti", "Il codice EPSG deve essere un numero.")
+            return
+
+        stages = [
+            (f"archivio {date_str}", self.archive_stage("comuni", date_str)),
+            ("indice comuni", lambda: ComuniIndex.cached(self.geocode_index_dir(), self.store, date_str)),
+            ("geocodifica", lambda: geocode_points(self.task.results["indice comuni"], table_path, table_layer,
+                                                   x_field, y_field, out_path, epsg)),
+        ]
+        slow_engine = ""
+        if shapely is None:
+            slow_engine = ("\n\nshapely non è installato: è stato usato l'indice a griglia con geometrie OGR, "
+                           "molto più lento. Con milioni di punti installa shapely 2.x.")
+            QgsMessageLog.logMessage("Geocodifica senza shapely: indice a griglia OGR, molto più lento dello STRtree",
+                                     "ISTAT Downloader", Qgis.MessageLevel.Warning)
+
+        def on_success(task):
+            counts = task.results["geocodifica"]
+            QgsMessageLog.logMessage(f"Geocodifica {os.path.basename(table_path)} sui comuni {date_str} completata: {counts}",
+                                     "ISTAT Downloader", Qgis.MessageLevel.Info)
+            QMessageBox.information(
+                self, "Geocodifica completata",
+                f"Punti localizzati: {counts['localizzati']}\nPunti fuori dai comuni o senza coordinate: "
+                f"{counts['non_localizzati']}\n\nRisultato salvato in:\n{out_path}{slow_engine}")
+
+        self.run_stages(f"ISTAT Downloader: geocodifica {os.path.basename(table_path)}", stages, on_success)
+
+    def create_table_inputs(self, type_combo):
+        """Campo della tabella con layer e colonna del codice; propone la colonna del tipo di confine"""
+        table_row = QHBoxLayout()
+        table_edit = QLineEdit()
+        table_edit.setPlaceholderText("Tabella CSV, XLSX o GeoPackage...")
+        table_browse = QPushButton("Sfoglia")
+        table_row.addWidget(table_edit)
+        table_row.addWidget(table_browse)
+        layer_combo = QComboBox()
+        key_combo = QComboBox()
+
+        update_layers = lambda: self.update_table_layers(table_edit, layer_combo)  # noqa: E731
+        update_fields = lambda: self.update_table_fields(table_edit, layer_combo, key_combo, type_combo)  # noqa: E731
+        table_edit.editingFinished.connect(update_layers)
+        table_browse.clicked.connect(lambda: self.browse_table(table_edit) and update_layers())
+        layer_combo.currentIndexChanged.connect(update_fields)
+        type_combo.currentIndexChanged.connect(update_fields)
+        return table_row, table_edit, layer_combo, key_combo
+
+    def browse_table(self, edit):
+        """Sceglie una tabella CSV, XLSX o GeoPackage"""
+        path, _ = QFileDialog.getOpenFileName(self, "Tabella", self.download_path,
+                                              "Tabelle (*.csv *.xlsx *.gpkg);;Tutti i file (*)")
+        if path:
+            edit.setText(path)
+        return bool(path)
+
+    def update_table_layers(self, edit, layer_combo):
+        """Aggiorna l'elenco dei layer (fogli) della tabella scelta"""
+        layer_combo.clear()
+        path = edit.text()
+        if not os.path.isfile(path):
+            return
+        try:
+            layer_combo.addItems(table_layers(path))
+        except Exception as e:
+            QgsMessageLog.logMessage(f"Errore nel leggere la tabella: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+
+    def update_table_fields(self, edit, layer_combo, key_combo, type_combo):
+        """Aggiorna le colonne della tabella proponendo quella col codice del tipo di confine"""
+        key_combo.clear()
+        path = edit.text()
+        if not os.path.isfile(path) or layer_combo.count() == 0:
+            return
+        try:
+            fields = table_fields(path, layer_combo.currentText())
+        except Exception as e:
+            QgsMessageLog.logMessage(f"Errore nel leggere la tabella: {str(e)}", "ISTAT Downloader", Qgis.MessageLevel.Warning)
+            return
+        key_combo.addItems(fields)
+        code_field = CODE_FIELD_BY_TYPE[self.boundary_types[type_combo.currentText()]]
+        for i, name in enumerate(fields):
+            if name.lower() == code_field:
+                key_combo.setCurrentIndex(i)
+                break
+
+    def create_mirror_tab(self):
+        """Scheda per sincronizzare un mirror locale e sceglierlo come sorgente dati"""
+        tab = QWidget()
+        grid = QGridLayout(tab)
+        grid.setVerticalSpacing(10)
+
+        source_label = QLabel("Sorgente dati:")
+        source_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.source_edit = QLineEdit(QSettings().value(BASE_URL_SETTING, DEFAULT_BASE_URL))
+        self.source_edit.setToolTip("URL delle API, di un mirror HTTP locale o di una cartella (file:///percorso/)")
+        source_buttons = QHBoxLayout()
+        save_source_button = QPushButton("Salva")
+        save_source_button.clicked.connect(self.save_source)
+        reset_source_button = QPushButton("API pubbliche")
+        reset_source_button.clicked.connect(lambda: self.source_edit.setText(DEFAULT_BASE_URL))
+        source_buttons.addWidget(self.source_edit)
+        source_buttons.addWidget(reset_source_button)
+        source_buttons.addWidget(save_source_button)
+        grid.addWidget(source_label, 0, 0)
+        grid.addLayout(source_buttons, 0, 1)
+
+        mirror_label = QLabel("Cartella mirror:")
+        mirror_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        mirror_row = QHBoxLayout()
+        self.mirror_dir_edit = QLineEdit(os.path.join(self.download_path, "ISTAT_mirror"))
+        mirror_browse = QPushButton("Sfoglia")
+        mirror_browse.clicked.connect(self.browse_mirror_dir)
+        mirror_row.addWidget(self.mirror_dir_edit)
+        mirror_row.addWidget(mirror_browse)
+        grid.addWidget(mirror_label, 1, 0)
+        grid.addLayout(mirror_row, 1, 1)
+
+        self.mirror_subsets_check = QCheckBox("Includi i sottoinsiemi per regione e provincia")
+        grid.addWidget(self.mirror_subsets_check, 2, 1)
+
+        note = QLabel("La sincronizzazione scarica in parallelo tutte le date, i tipi e i formati, "
+                      "trasferendo solo i file nuovi o modificati. Al termine la cartella può essere "
+                      "usata come sorgente dati.")
+        note.setWordWrap(True)
+        note.setStyleSheet("font-style: italic;")
+        grid.addWidget(note, 3, 0, 1, 2)
+
+        self.mirror_button = QPushButton("Sincronizza")
+        self.mirror_button.clicked.connect(self.run_mirror_sync)
+        grid.addWidget(self.mirror_button, 4, 1, Qt.AlignmentFlag.AlignRight)
+
+        index_note = QLabel("I filtri per regione e provincia usano un indice amministrativo locale, senza rete. "
+                            "L'aggiornamento lo ricostruisce dalle tabelle della sorgente dati per tutte le date.")
+        index_note.setWordWrap(True)
+        index_note.setStyleSheet("font-style: italic;")
+        grid.addWidget(index_note, 5, 0, 1, 2)
+
+        self.admin_index_button = QPushButton("Aggiorna indice amministrativo")
+        self.admin_index_button.clicked.connect(self.run_admin_index_refresh)
+        grid.addWidget(self.admin_index_button, 6, 1, Qt.AlignmentFlag.AlignRight)
+
+        port = int(QSettings().value(SERVICE_SETTING, 0) or 0)
+        self.service_check = QCheckBox("Servizio locale dei confini archiviati (GeoJSON per altri programmi)")
+        self.service_check.setChecked(port > 0)
+        grid.addWidget(self.service_check, 7, 1)
+
+        port_label = QLabel("Porta:")
+        port_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.service_port_spin = QSpinBox()
+        self.service_port_spin.setRange(1024, 65535)
+        self.service_port_spin.setValue(port or DEFAULT_PORT)
+        grid.addWidget(port_label, 8, 0)
+        grid.addWidget(self.service_port_spin, 8, 1)
+
+        self.service_check.toggled.connect(self.save_service)
+        self.service_port_spin.valueChanged.connect(self.save_service)
+
+        service_note = QLabel("Il servizio risponde solo da questo computer (127.0.0.1) con gli stessi percorsi delle API, "
+                              "ad esempio /20240101/regioni/12/comuni o /20240101/comuni?bbox=12.4,41.8,12.6,42.0, "
+                              "leggendo l'archivio locale. L'impostazione ha effetto alla chiusura del plugin.")
+        service_note.setWordWrap(True)
+        service_note.setStyleSheet("font-style: italic;")
+        grid.addWidget(service_note, 9, 0, 1, 2)
+        grid.setRowStretch(10, 1)
+        return tab
+
+    def create_diagnostics_tab(self):
+        """Scheda per attivare il watchdog dei blocchi dell'interfaccia"""
+        tab = QWidget()
+        grid = QGridLayout(tab)
+        grid.setVerticalSpacing(10)
+
+        threshold_ms = int(QSettings().value(WATCHDOG_SETTING, 0) or 0)
+        self.watchdog_check = QCheckBox("Registra i blocchi dell'interfaccia con lo stack Python")
+        self.watchdog_check.setChecked(threshold_ms > 0)
+        grid.addWidget(self.watchdog_check, 0, 1)
+
+        threshold_label = QLabel("Soglia:")
+        threshold_label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.watchdog_spin = QSpinBox()
+        self.watchdog_spin.setRange(20, 10000)
+        self.watchdog_spin.setSuffix(" ms")
+        self.watchdog_spin.setValue(threshold_ms or DEFAULT_THRESHOLD_MS)
+        grid.addWidget(threshold_label, 1, 0)
+        grid.addWidget(self.watchdog_spin, 1, 1)
+
+        self.watchdog_check.toggled.connect(self.save_watchdog)
+        self.watchdog_spin.valueChanged.connect(self.save_watchdog)
+
+        note = QLabel("I blocchi del thread principale oltre la soglia vengono scritti, con durata e stack, "
+                      "nella scheda \"ISTAT Downloader\" dei messaggi di log. L'impostazione ha effetto "
+                      "alla prossima apertura del plugin.")
+        note.setWordWrap(True)
+        note.setStyleSheet("font-style: italic;")
+        grid.addWidget(note, 2, 0, 1, 2)
+        grid.setRowStretch(3, 1)
+        return tab
+
+    def save_watchdog(self):
+        """Salva la soglia del watchdog (0 = disattivato)"""
+        QSettings().setValue(WATCHDOG_SETTING, self.watchdog_spin.value() if self.watchdog_check.isChecked() else 0)
+
+    def save_service(self):
+        """Salva la porta del servizio locale (0 = disattivato)"""
+        QSettings().setValue(SERVICE_SETTING, self.service_port_spin.value() if self.service_check.isChecked() else 0)
+
+    def browse_mirror_dir(self):
+        """Sceglie la cartella del mirror"""
+        folder = QFileDialog.getExistingDirectory(self, "Cartella del mirror", self.mirror_dir_edit.text())
+        if folder:
+            self.mirror_dir_edit.setText(folder)
+
+    def save_source(self):
+        """Salva la sorgente dati usata dal plugin"""
+        base_url = self.source_edit.text().strip()
+        if not base_url.endswith("/"):
+            base_url += "/"
+        QSettings().setValue(BASE_URL_SETTING, base_url)
+        QMessageBox.information(self, "Sorgente dati", f"Sorgente dati salvata:\n{base_url}\n\nVerrà usata alla prossima apertura del plugin.")
+
+    def run_mirror_sync(self):
+        """Avvia la sincronizzazione del mirror offline"""
+        dest_dir = self.mirror_dir_edit.text()
+        subsets = "all" if self.mirror_subsets_check.isChecked() else ()
+        mirror = MirrorSync(dest_dir, DEFAULT_BASE_URL,
+                            progress=lambda done, total: self.task and self.task.setProgress(100.0 * done / total))
+
+        def on_success(task):
+            stats = task.results["mirror"]
+            for failed_url, error in mirror.failures:
+                QgsMessageLog.logMessage(f"Mirror: {failed_url} non sincronizzato: {error}", "ISTAT Downloader",
+                                         Qgis.MessageLevel.Warning)
+            mirror_url = "file:///" + os.path.abspath(dest_dir).lstrip("/").replace(os.sep, "/") + "/"
+            self.source_edit.setText(mirror_url)
+            QMessageBox.information(
+                self, "Mirror sincronizzato",
+                f"Scaricati: {stats['downloaded']} ({stats['bytes'] / 1048576:.1f} MB)\n"
+                f"Invariati: {stats['unchanged']}\nNon disponibili: {stats['missing']}\nErrori: {stats['errors']}"
+                f"{' (dettagli nei messaggi di log)' if stats['errors'] else ''}\n\n"
+                f"Premi \"Salva\" per usare il mirror come sorgente dati:\n{mirror_url}")
+
+        self.run_stages("ISTAT Downloader: sincronizzazione mirror",
+                        [("mirror", lambda: mirror.sync(regions=subsets, provinces=subsets))], on_success)
+
+    def run_admin_index_refresh(self):
+        """Ricostruisce l'indice amministrativo nella cartella dati del plugin"""
+        out_path = os.path.join(os.path.dirname(self.store.store_dir), INDEX_NAME)
+        # L'indice in uso resta mappato durante la costruzione e viene sostituito a task concluso
+        new_path = f"{out_path}.new"
+        dates = list(self.dates)
+
+        def on_success(task):
+            stats = task.results["indice"]
+            self.install_admin_index(new_path, out_path)
+            QgsMessageLog.logMessage(f"Indice amministrativo aggiornato: {stats}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+            QMessageBox.information(self, "Indice amministrativo",
+                                    f"Date indicizzate: {stats['date']}\nUnità amministrative: {stats['unita']}\n\n"
+                                    f"Indice salvato in:\n{out_path}")
+
+        self.run_stages("ISTAT Downloader: indice amministrativo",
+                        [("indice", lambda: build_admin_index(new_path, self.base_url, dates, fetch=self.cache.fetch))],
+                        on_success)
+
+    def archive_stage(self, boundary_type, date_str):
+        """Fase che scarica e archivia una data non ancora presente nell'archivio"""
+        def stage():
+            if self.store.has_date(boundary_type, date_str):
+                return None
+            temp_dir = tempfile.mkdtemp()
+            try:
+                temp_path = os.path.join(temp_dir, f"{boundary_type}.gpkg")
+                download(f"{self.base_url}{date_str}/{boundary_type}.gpkg", temp_path, segments=SEGMENTS)
+                return self.store.ingest(temp_path, boundary_type, date_str)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        return stage
+
+    def run_stages(self, description, stages, on_success):
+        """Esegue le fasi in un task in background e gestisce l'esito"""
+        def finish(result, task):
+            self.task = None
+            self.progress_bar.setVisible(False)
+            self.tabs.setEnabled(True)
+            if result:
+                on_success(task)
+            else:
+                QMessageBox.critical(self, "Error", f"Operazione non riuscita: {task.error or 'operazione annullata'}")
+
+        self.task = PostDownloadTask(description, stages, finish)
+        self.task.progressChanged.connect(lambda progress: self.progress_bar.setValue(int(progress)))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.tabs.setEnabled(False)
+        QgsApplication.taskManager().addTask(self.task)
+
+    def run_diff(self):
+        """Avvia il confronto tra le due date selezionate"""
+        boundary_type = self.boundary_types[self.diff_type_combo.currentText()]
+        date_a = self.diff_date_a_combo.currentText()
+        date_b = self.diff_date_b_combo.currentText()
+        out_path = self.diff_output_edit.text()
+        if date_a == date_b:
+            QMessageBox.warning(self, "Confronto date", "Seleziona due date di riferimento diverse.")
+            return
+
+        stages = [
+            (f"archivio {date_a}", self.archive_stage(boundary_type, date_a)),
+            (f"archivio {date_b}", self.archive_stage(boundary_type, date_b)),
+            ("confronto", lambda: diff_dates(self.store, boundary_type, date_a, date_b, out_path)),
+        ]
+
+        def on_success(task):
+            counts = task.results["confronto"]
+            group_path = (f"ISTAT confronto {boundary_type} {date_a}-{date_b}",)
+            for name in reversed(DIFF_LAYERS):
+                layer = QgsVectorLayer(f"{out_path}|layername={name}", f"{name} ({counts[name]})", "ogr")
+                if layer.isValid():
+                    self.layer_loader.add(layer, group_path)
+            self.layer_loader.flush()
+            QgsMessageLog.logMessage(f"Confronto {date_a}-{date_b} completato: {counts}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+            summary = "\n".join(f"{name.replace('_', ' ')}: {counts[name]}" for name in DIFF_LAYERS)
+            QMessageBox.information(self, "Confronto completato", f"{summary}\n\nRisultati salvati in:\n{out_path}")
+
+        self.run_stages(f"ISTAT Downloader: confronto {date_a}-{date_b}", stages, on_success)
+
+    def run_join(self):
+        """Avvia il join della tabella sui confini della data selezionata"""
+        boundary_type = self.boundary_types[self.join_type_combo.currentText()]
+        date_str = self.join_date_combo.currentText()
+        table_path = self.join_table_edit.text()
+        table_layer = self.join_layer_combo.currentText()
+        table_key = self.join_key_combo.currentText()
+        out_path = self.join_output_edit.text()
+        if not table_key:
+            QMessageBox.warning(self, "Join tabella", "Seleziona una tabella e la colonna con il codice ISTAT.")
+            return
+
+        stages = [
+            (f"archivio {date_str}", self.archive_stage(boundary_type, date_str)),
+            ("join", lambda: join_table(self.store.path(boundary_type), view_name(boundary_type, date_str),
+                                        CODE_FIELD_BY_TYPE[boundary_type], table_path,
+                                        table_layer, table_key, out_path)),
+        ]
+
+        def on_success(task):
+            counts = task.results["join"]
+            name = os.path.splitext(os.path.basename(table_path))[0]
+            layer = QgsVectorLayer(f"{out_path}|layername={JOIN_LAYER}", f"{boundary_type} + {name}", "ogr")
+            if layer.isValid():
+                self.layer_loader.add(layer, (date_group_name(date_str), boundary_type))
+                self.layer_loader.flush()
+            QgsMessageLog.logMessage(f"Join {name} su {boundary_type} {date_str} completato: {counts}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+            QMessageBox.information(
+                self, "Join completato",
+                f"Confini abbinati: {counts['abbinati']}\nConfini senza dati: {counts['confini_senza_dati']}\n"
+                f"Codici della tabella non abbinati: {counts['codici_non_abbinati']}\n"
+                f"Codici duplicati (usata la prima riga): {counts['codici_duplicati']}\n\nRisultato salvato in:\n{out_path}")
+
+        self.run_stages(f"ISTAT Downloader: join {os.path.basename(table_path)}", stages, on_success)
+
+    def crosswalk_path(self, boundary_type):
+        """File di cache del crosswalk del tipo di confine"""
+        return os.path.join(os.path.dirname(self.store.store_dir), "crosswalk", f"{boundary_type}.json")
+
+    def run_crosswalk(self):
+        """Ricodifica la tabella scelta ai codici della data di destinazione"""
+        boundary_type = self.boundary_types[self.crosswalk_type_combo.currentText()]
+        date_from = self.crosswalk_from_combo.currentText()
+        date_to = self.crosswalk_to_combo.currentText()
+        table_path = self.crosswalk_table_edit.text()
+        table_layer = self.crosswalk_layer_combo.currentText()
+        table_key = self.crosswalk_key_combo.currentText()
+        out_path = self.crosswalk_output_edit.text()
+        if not table_key:
+            QMessageBox.warning(self, "Codici tra date", "Seleziona una tabella e la colonna con il codice ISTAT.")
+            return
+
+        dates = list(self.dates)
+        stages = [
+            ("crosswalk", lambda: cached_crosswalk(self.crosswalk_path(boundary_type), boundary_type, dates,
+                                                   self.base_url, self.cache, self.store)),
+            ("ricodifica", lambda: remap_table(self.task.results["crosswalk"], table_path, table_layer, table_key,
+                                               date_from, date_to, out_path)),
+        ]
+
+        def on_success(task):
+            counts = task.results["ricodifica"]
+            summary = "\n".join(f"{kind}: {count}" for kind, count in sorted(counts.items()))
+            QgsMessageLog.logMessage(f"Ricodifica {date_from}-{date_to} completata: {counts}", "ISTAT Downloader", Qgis.MessageLevel.Info)
+            QMessageBox.information(self, "Ricodifica completata",
+                                    f"Codici {date_from} -> {date_to}\n\n{summary}\n\nRisultato salvato in:\n{out_path}")
+
+        self.run_stages(f"ISTAT Downloader: ricodifica {date_from}-{date_to}", stages, on_success)
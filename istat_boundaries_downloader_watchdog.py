@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Watchdog
+
+ Rileva i blocchi del ciclo di eventi del thread principale oltre una
+ soglia e ne registra durata e stack Python nei messaggi di log.
+                              -------------------
+        begin                : 2025-03-02
+        email                : pigrecoinfinito@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import sys
+import threading
+import time
+import traceback
+
+from qgis.PyQt.QtCore import QObject, QSettings, QTimer
+from qgis.core import QgsMessageLog, Qgis
+
+# Soglia in millisecondi; 0 o assente = watchdog disattivato
+WATCHDOG_SETTING = "istat_boundaries_downloader/stall_watchdog_ms"
+DEFAULT_THRESHOLD_MS = 100
+
+
+class StallWatchdog(QObject):
+    """Heartbeat con QTimer nel thread principale controllato da un thread di supporto
+
+    Se il heartbeat tarda oltre la soglia, il thread di supporto cattura lo stack
+    del thread principale; alla ripresa del ciclo di eventi il blocco viene
+    registrato con la sua durata. Va creato nel thread principale.
+    """
+
+    def __init__(self, threshold_ms=DEFAULT_THRESHOLD_MS, parent=None):
+        super().__init__(parent)
+        self.threshold = threshold_ms / 1000.0
+        self.main_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stall = None
+        self.stalls = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.timer = QTimer(self)
+        self.timer.setInterval(max(10, threshold_ms // 4))
+        self.timer.timeout.connect(self.beat)
+
+    @classmethod
+    def from_settings(cls, parent=None):
+        """Watchdog avviato se abilitato nelle impostazioni, altrimenti None"""
+        threshold_ms = int(QSettings().value(WATCHDOG_SETTING, 0) or 0)
+        if threshold_ms <= 0:
+            return None
+        watchdog = cls(threshold_ms, parent)
+        watchdog.start()
+        return watchdog
+
+    def start(self):
+        self.last_beat = time.monotonic()
+        self.stop_event.clear()
+        self.timer.start()
+        self.thread = threading.Thread(target=self.monitor, name="ISTAT Downloader watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def beat(self):
+        """Heartbeat nel thread principale; chiude e registra un blocco in corso"""
+        now = time.monotonic()
+        with self.lock:
+            stall, self.stall = self.stall, None
+            started = self.last_beat
+            self.last_beat = now
+        if stall is not None:
+            stall["seconds"] = now - started
+            self.stalls.append(stall)
+            QgsMessageLog.logMessage(
+                f"Interfaccia bloccata per {stall['seconds'] * 1000:.0f} ms. "
+                f"Stack del thread principale dopo {self.threshold * 1000:.0f} ms:\n{stall['stack']}",
+                "ISTAT Downloader", Qgis.MessageLevel.Warning)
+
+    def monitor(self):
+        """Thread di supporto: cattura lo stack del thread principale se il heartbeat tarda"""
+        while not self.stop_event.wait(self.threshold / 4):
+            with self.lock:
+                if self.stall is not None or time.monotonic() - self.last_beat < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.main_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                self.stall = {"timestamp": time.time(), "stack": stack}
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ISTAT Boundaries Downloader - Test delle corrispondenze dei codici
+
+ Fusioni di comuni in un codice nuovo e incorporazioni in un comune che
+ mantiene il proprio codice, su un archivio locale costruito con OGR.
+
+ Uso:
+     python -m pytest tests
+ ***************************************************************************/
+"""
+
+import importlib
+import os
+import sys
+
+import pytest
+
+ogr = pytest.importorskip("osgeo.ogr")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(REPO_DIR))
+
+# I moduli del plugin usano import relativi: si importano dal pacchetto
+crosswalk = importlib.import_module(f"{os.path.basename(REPO_DIR)}.istat_boundaries_downloader_crosswalk")
+store_module = importlib.import_module(f"{os.path.basename(REPO_DIR)}.istat_boundaries_downloader_store")
+
+
+def rectangle(minx, miny, maxx, maxy):
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in ((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)):
+        ring.AddPoint_2D(x, y)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+    return ogr.ForceToMultiPolygon(polygon)
+
+
+def build(tmp_path, comuni_by_date):
+    """Archivia le date (codice, denominazione, geometria) e costruisce le corrispondenze"""
+    store = store_module.BoundaryStore(str(tmp_path / "store"))
+    table_paths = {}
+    for date_str, comuni in comuni_by_date.items():
+        gpkg_path = str(tmp_path / f"comuni_{date_str}.gpkg")
+        ds = ogr.GetDriverByName("GPKG").CreateDataSource(gpkg_path)
+        layer = ds.CreateLayer("comuni", None, ogr.wkbMultiPolygon)
+        layer.CreateField(ogr.FieldDefn("pro_com", ogr.OFTInteger))
+        layer.CreateField(ogr.FieldDefn("comune", ogr.OFTString))
+        for code, name, geom in comuni:
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField("pro_com", code)
+            feature.SetField("comune", name)
+            feature.SetGeometry(geom)
+            layer.CreateFeature(feature)
+        ds = None
+        store.ingest(gpkg_path, "comuni", date_str)
+
+        table_paths[date_str] = str(tmp_path / f"comuni_{date_str}.csv")
+        with open(table_paths[date_str], "w", encoding="utf-8", newline="") as f:
+            f.write("pro_com,comune\n")
+            f.writelines(f"{code},{name}\n" for code, name, _ in comuni)
+    return crosswalk.build_crosswalk("comuni", list(comuni_by_date), table_paths, store)
+
+
+def test_fusione_in_un_nuovo_codice(tmp_path):
+    result = build(tmp_path, {
+        "20250101": [(1, "Alfa", rectangle(0, 0, 1, 1)),
+                     (2, "Beta", rectangle(1, 0, 2, 1)),
+                     (3, "Gamma", rectangle(5, 5, 6, 6))],
+        "20260101": [(4, "Alfabeta", rectangle(0, 0, 2, 1)),
+                     (3, "Gamma", rectangle(5, 5, 6, 6))],
+    })
+    assert result.mapping("20250101", "20260101") == {"1": ("4",), "2": ("4",), "3": ("3",)}
+    assert result.mapping("20260101", "20250101") == {"4": ("1", "2"), "3": ("3",)}
+
+
+def test_incorporazione_in_un_codice_esistente(tmp_path):
+    result = build(tmp_path, {
+        "20250101": [(1, "Alfa", rectangle(0, 0, 1, 1)),
+                     (2, "Beta", rectangle(1, 0, 2, 1))],
+        "20260101": [(1, "Alfa", rectangle(0, 0, 2, 1))],
+    })
+    assert result.step("20250101", "20260101") == {"2": ["1"]}
+    assert result.mapping("20250101", "20260101") == {"1": ("1",), "2": ("1",)}
+    assert result.mapping("20260101", "20250101") == {"1": ("1", "2")}